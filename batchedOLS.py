@@ -0,0 +1,133 @@
+# function batchedResiduals
+# regresses one shared set of covariates out of every gene at once
+# genes with the same NaN pattern share a single least-squares solve, so a matrix with no NaNs
+# is one solve rather than one sklearn LinearRegression fit per gene
+# prepared design matrices and their factorisations are cached by sample set and covariate list,
+# so repeat regressions over the same samples skip covariate setup and factorisation
+
+
+# prepared designs, keyed by designKey
+design_cache = {}
+
+
+def designKey(samples, covariates, sources=()):
+
+  # """
+  # samples: sample ids the design is built for
+  # covariates: covariate names in the design
+  # sources: metadata files the covariates are read from - their checksums are part of the key, so a design is not
+  # reused, from memory or cache_dir, once its metadata file has changed
+  # returns a hash identifying the design
+  # """
+
+  import hashlib
+  from stageCache import fileChecksum
+
+  h = hashlib.sha1()
+  h.update("\x1f".join([str(s) for s in samples]).encode("utf-8"))
+  h.update(b"\x1e")
+  h.update("\x1f".join([str(c) for c in covariates]).encode("utf-8"))
+  h.update(b"\x1e")
+  h.update("\x1f".join([fileChecksum(p) for p in sources]).encode("utf-8"))
+
+  return(h.hexdigest())
+
+
+def cachedDesign(key, build_fn, cache_dir=None):
+
+  # """
+  # key: designKey of the design
+  # build_fn: function returning (sample index, covariate DataFrame), only called on a cache miss
+  # cache_dir: directory to also persist designs in, so they survive between runs. Default None keeps them in memory only
+  # returns a dict of index, covs and factors - factors holds the factorisations batchedResiduals has made
+  # for this design, and is filled in as it is used
+  # """
+
+  import os
+  import pickle
+  from pipelineLog import stageLogger
+
+  log = stageLogger("batchedOLS")
+
+  if key in design_cache:
+    log.debug("using cached design %s", key)
+    return(design_cache[key])
+
+  path = None if cache_dir == None else os.path.join(cache_dir, "design_" + key + ".pkl")
+
+  if path != None and os.path.exists(path):
+    log.info("loading cached design %s", key)
+    with open(path, "rb") as f:
+      design = pickle.load(f)
+  else:
+    index, covs = build_fn()
+    design = {"index": index, "covs": covs, "factors": {}}
+
+  design_cache[key] = design
+
+  return(design)
+
+
+def saveDesign(key, design, cache_dir):
+
+  # """
+  # key: designKey of the design
+  # design: design dict from cachedDesign, including any factorisations made since
+  # cache_dir: directory to write the design to
+  # """
+
+  import os
+  import pickle
+
+  with open(os.path.join(cache_dir, "design_" + key + ".pkl"), "wb") as f:
+    pickle.dump(design, f)
+
+
+def batchedResiduals(Y, X, factors=None):
+
+  # """
+  # Y: 2d array, rows=samples, cols=genes - may contain NaNs (i.e. masked outliers)
+  # X: 2d array, rows=samples, cols=covariates - no NaNs, rows in the same order as Y
+  # factors: optional dict of factorisations of X keyed by NaN pattern, as kept by cachedDesign. Patterns
+  # already in it are not refactorised. New ones are added if they have no NaNs or are shared by more than
+  # one gene - one-off outlier patterns would only bloat the cache
+  # returns the residuals of each gene from an intercept + X linear model fit over that gene's non-NaN samples,
+  # as LinearRegression().fit(X[mask], y[mask]), NaN where Y is NaN
+  # """
+
+  import numpy as np
+
+  Y = np.asarray(Y, dtype=np.float64)
+  X = np.asarray(X, dtype=np.float64)
+
+  obs = ~np.isnan(Y)
+  residuals = np.full(Y.shape, np.nan)
+
+  # group genes by NaN pattern - usually one big group of complete genes plus small masked groups
+  patterns, group = np.unique(obs.T, axis=0, return_inverse=True)
+  group = group.ravel()
+
+  for g in range(0, len(patterns)):
+
+    rows = patterns[g]
+    cols = np.where(group == g)[0]
+    if rows.sum() == 0:
+      continue
+
+    # centring X and y fits the intercept, as LinearRegression does. The pseudo-inverse gives
+    # the same least-squares fit as lstsq and can be reused for any genes with this pattern
+    pattern = np.packbits(rows).tobytes()
+    Xg = X[rows] - X[rows].mean(axis=0)
+    if factors != None and pattern in factors:
+      Xg_pinv = factors[pattern]
+    else:
+      Xg_pinv = np.linalg.pinv(Xg)
+      if factors != None and (rows.all() or len(cols) > 1):
+        factors[pattern] = Xg_pinv
+
+    Yg = Y[np.ix_(rows, cols)]
+    Yg = Yg - Yg.mean(axis=0)
+
+    residuals[np.ix_(rows, cols)] = Yg - Xg @ (Xg_pinv @ Yg)
+
+  return(residuals)
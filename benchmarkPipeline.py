@@ -0,0 +1,298 @@
+# function runBenchmarks
+# times each pipeline stage's entry point on synthetic GTEx-like and ROS/MAP-like expression matrices and covariate
+# tables of a chosen number of samples, genes and NaN fraction, and compares the timings with a stored baseline
+# every measurement runs in a fresh process, so its peak memory is the stage's own, and on one core, so timings do not
+# depend on how busy the machine's other cores are
+
+
+# stages benchmarked, in pipeline order
+bench_stages = ["filter", "normalise", "mask", "regress", "corrs"]
+
+
+def makeGtexLike(case_dir, n_samples=100, n_genes=2000, nan_frac=0, seed=0):
+
+  # """
+  # case_dir: directory to write the files to
+  # n_samples: number of samples, one per donor
+  # n_genes: number of genes, including the 13 mt genes
+  # nan_frac: fraction of the expression values set to NaN
+  # seed: random seed
+  # writes gtex_tpm.csv (rows=samples with R-style dotted GTEx ids, cols=genes) of log-normal TPMs, plus a sample
+  # attributes table (meta.txt) and phenotype table (pheno.txt) with the columns gtex_regress_covariates uses
+  # """
+
+  import os
+  import numpy as np
+  import pandas as pd
+  from genCorrs import mito_genes
+
+  rng = np.random.default_rng(seed)
+  os.makedirs(case_dir, exist_ok=True)
+
+  donors = ["GTEX-{:05X}".format(4096 + i) for i in range(n_samples)]
+  samples = [d + "-0011-R10A-SM-{:04d}".format(i) for i, d in enumerate(donors)]
+
+  meta = pd.DataFrame({"SMRIN": rng.normal(7, 1, n_samples),
+                       "SMNABTCHT": rng.choice(["RNA isolation_PAXgene Tissue miRNA", "RNA Extraction from Paxgene-derived Lysate"], n_samples),
+                       "SMNABTCH": rng.choice(["BP-{}".format(i) for i in range(10)], n_samples),
+                       "SMGEBTCH": rng.choice(["LCSET-{}".format(i) for i in range(10)], n_samples),
+                       "SMGEBTCHD": rng.choice(["0{}/15/2013".format(i) for i in range(1, 10)], n_samples),
+                       "SMCENTER": rng.choice(["B1", "C1", "D1"], n_samples)},
+                      index=pd.Index(samples, name="SAMPID"))
+  meta.to_csv(os.path.join(case_dir, "meta.txt"), sep="\t")
+
+  pheno = pd.DataFrame({"GENDER": rng.integers(1, 3, n_samples),
+                        "AGE": rng.choice(["20-29", "30-39", "40-49", "50-59", "60-69", "70-79"], n_samples),
+                        "DTHHRDY": rng.integers(0, 5, n_samples).astype(float)},
+                       index=pd.Index(donors, name="SUBJID"))
+  pheno.to_csv(os.path.join(case_dir, "pheno.txt"), sep="\t")
+
+  genes = mito_genes + ["ENSG{:011d}".format(i) for i in range(n_genes - len(mito_genes))]
+  a = np.exp(rng.normal(2, 1, (n_samples, len(genes))))
+  a[rng.random(a.shape) < nan_frac] = np.nan
+  pd.DataFrame(a, index=[s.replace("-", ".") for s in samples], columns=genes).to_csv(os.path.join(case_dir, "gtex_tpm.csv"))
+
+
+def makeRosmapLike(case_dir, n_samples=100, n_genes=2000, nan_frac=0, seed=0):
+
+  # """
+  # case_dir: directory to write the files to
+  # n_samples: number of samples
+  # n_genes: number of genes, including the 13 mt genes
+  # nan_frac: fraction of the expression values set to NaN
+  # seed: random seed
+  # writes rosmap_tpm.csv (rows=genes, cols=samples with the X R adds to numeric ids) of log-normal TPMs, plus a
+  # preprocessed metadata table (meta.csv) with the covariates rosmap_regress_covariates uses
+  # """
+
+  import os
+  import numpy as np
+  import pandas as pd
+  from genCorrs import mito_genes
+  from rosmap_regress_covariates import rosmap_cov_names
+
+  rng = np.random.default_rng(seed)
+  os.makedirs(case_dir, exist_ok=True)
+
+  samples = ["{}_120216".format(100 + i) for i in range(n_samples)]
+
+  meta = pd.DataFrame(rng.normal(size=(n_samples, len(rosmap_cov_names))), index=samples, columns=rosmap_cov_names)
+  for col in ["library_batch", "race", "msex", "study"]:
+    meta[col] = rng.integers(0, 3, n_samples)
+  meta.to_csv(os.path.join(case_dir, "meta.csv"))
+
+  genes = mito_genes + ["ENSG{:011d}".format(i) for i in range(n_genes - len(mito_genes))]
+  a = np.exp(rng.normal(2, 1, (len(genes), n_samples)))
+  a[rng.random(a.shape) < nan_frac] = np.nan
+  pd.DataFrame(a, index=genes, columns=["X" + s for s in samples]).to_csv(os.path.join(case_dir, "rosmap_tpm.csv"))
+
+
+def runStage(stage, dataset, case_dir, out_dir):
+
+  # """
+  # stage: stage name, one of bench_stages
+  # dataset: gtex or rosmap
+  # case_dir: directory written by makeGtexLike or makeRosmapLike
+  # out_dir: directory for the stage outputs
+  # calls the stage's entry point on the case's TPM file with one core
+  # """
+
+  import os
+
+  case_dir = os.path.join(case_dir, "")
+  pattern = dataset + "_tpm.csv"
+
+  if stage == "filter":
+    from filterNullGenesAndSamps import filterNullGenesAndSamps
+    filterNullGenesAndSamps(case_dir, pattern, ",", out_dir, "")
+
+  elif stage == "normalise":
+    from log10MedNormalise import log10MedNormalise
+    log10MedNormalise(case_dir, pattern, ",", out_dir, "", n_cores=1)
+
+  elif stage == "mask":
+    from maskGeneOutliers import maskGeneOutliers
+    maskGeneOutliers(case_dir, pattern, ",", out_dir, "", n_cores=1)
+
+  elif stage == "regress" and dataset == "gtex":
+    from gtex_regress_covariates import gtex_regress_covariates
+    gtex_regress_covariates(case_dir, pattern, case_dir + "meta.txt", case_dir + "pheno.txt", out_dir, "", diagnostics=False, n_cores=1)
+
+  elif stage == "regress":
+    from rosmap_regress_covariates import rosmap_regress_covariates
+    rosmap_regress_covariates(case_dir, pattern, case_dir + "meta.csv", out_dir, "", diagnostics=False, n_cores=1)
+
+  elif stage == "corrs":
+    from genCorrs import genCorrs
+    genCorrs(case_dir, pattern, out_dir, "", "spearman", n_cores=1)
+
+  else:
+    raise ValueError("unknown stage '{}', use one of {}".format(stage, ", ".join(bench_stages)))
+
+
+def timeStage(stage, dataset, case_dir, out_dir):
+
+  # """
+  # runs runStage in the calling process and returns its wall time, cpu time (this process and any it started) and
+  # peak RSS - base_rss_mb is the peak before the stage, once its modules are imported
+  # """
+
+  import time
+  import resource
+  import importlib
+  from pipelineLog import stageLogger
+
+  # imports are not timed
+  for module in ["numpy", "pandas", "scipy.stats", "sklearn.preprocessing", "joblib", "matrixIO", "genCorrs", "batchedOLS"]:
+    importlib.import_module(module)
+
+  base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  cpu, wall = time.process_time(), time.perf_counter()
+
+  # stage output is not part of the benchmark
+  pipeline_log = stageLogger("benchmarkPipeline").logger.parent
+  level = pipeline_log.level
+  pipeline_log.setLevel("WARNING")
+  try:
+    runStage(stage, dataset, case_dir, out_dir)
+  finally:
+    pipeline_log.setLevel(level)
+
+  wall = time.perf_counter() - wall
+  cpu = time.process_time() - cpu
+  children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+  cpu += (children_after.ru_utime - children.ru_utime) + (children_after.ru_stime - children.ru_stime)
+
+  # ru_maxrss is in KB on linux
+  return({"wall_s": wall, "cpu_s": cpu, "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+          "base_rss_mb": base_rss / 1024})
+
+
+def timeStageFresh(stage, dataset, case_dir, out_dir):
+
+  # """
+  # runs timeStage in a newly spawned process, so the peak RSS is not carried over from earlier measurements
+  # """
+
+  import multiprocessing
+  from concurrent.futures import ProcessPoolExecutor
+
+  with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+    return(pool.submit(timeStage, stage, dataset, case_dir, out_dir).result())
+
+
+def compareBaseline(results, baseline, tolerance=0.25):
+
+  # """
+  # results: DataFrame from runBenchmarks, one row per case
+  # baseline: dict of case -> {"wall_s", "stage_rss_mb"} from an earlier run
+  # tolerance: fraction a case may be slower, or use more memory above its base RSS, before it is flagged
+  # returns results with the baseline values, their ratios and a regression flag added
+  # """
+
+  import numpy as np
+
+  results = results.copy()
+  results["baseline_wall_s"] = [baseline.get(c, {}).get("wall_s", np.nan) for c in results["case"]]
+  results["baseline_stage_rss_mb"] = [baseline.get(c, {}).get("stage_rss_mb", np.nan) for c in results["case"]]
+  results["wall_ratio"] = results["wall_s"] / results["baseline_wall_s"]
+  results["rss_ratio"] = results["stage_rss_mb"] / results["baseline_stage_rss_mb"]
+  results["regression"] = (results["wall_ratio"] > 1 + tolerance) | (results["rss_ratio"] > 1 + tolerance)
+
+  return(results)
+
+
+def runBenchmarks(bench_dir, datasets=("gtex", "rosmap"), stages=None, n_samples=(100,), n_genes=(2000,), nan_fracs=(0, 0.05),
+                  repeats=3, baseline_path=None, save_baseline=False, tolerance=0.25, seed=0):
+
+  # """
+  # bench_dir: directory for the synthetic data, stage outputs and results
+  # datasets: gtex and/or rosmap - the layout, ids and covariates of the synthetic data, and the regression module used
+  # stages: stages to time, default is all of bench_stages
+  # n_samples: sample counts to benchmark
+  # n_genes: gene counts to benchmark
+  # nan_fracs: fractions of NaN expression values to benchmark
+  # repeats: times each case is run - the fastest wall time and largest peak memory are kept
+  # baseline_path: json of an earlier run's results to compare with, default is bench_dir/benchmark_baseline.json
+  # save_baseline: write this run's results to baseline_path instead of comparing with it
+  # tolerance: fraction a case may be slower, or use more memory, than the baseline before it is flagged
+  # seed: random seed of the synthetic data
+  # every combination of dataset, samples, genes and NaN fraction is generated once and each stage's entry point
+  # timed on it. Throughput is values (samples x genes) a second, mt-nuc gene pairs a second for corrs.
+  # A case whose stage raises is kept as a row with the error and no timings, and left out of a saved baseline.
+  # Writes benchmark_results.csv to bench_dir and returns the results, with the comparison to the baseline if one exists
+  # """
+
+  import os
+  import json
+  import itertools
+  import platform
+  import numpy as np
+  import pandas as pd
+  from genCorrs import mito_genes
+  from pipelineLog import stageLogger
+
+  log = stageLogger("benchmarkPipeline")
+
+  if stages == None:
+    stages = bench_stages
+  if baseline_path == None:
+    baseline_path = os.path.join(bench_dir, "benchmark_baseline.json")
+
+  rows = []
+  for dataset, n_s, n_g, nan_frac in itertools.product(datasets, n_samples, n_genes, nan_fracs):
+
+    case_dir = os.path.join(bench_dir, "{}_{}x{}_nan{}".format(dataset, n_s, n_g, nan_frac))
+    out_dir = os.path.join(case_dir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+    if dataset == "gtex":
+      makeGtexLike(case_dir, n_s, n_g, nan_frac, seed)
+    else:
+      makeRosmapLike(case_dir, n_s, n_g, nan_frac, seed)
+
+    for stage in stages:
+      row = {"case": "{}|{}|{}x{}|nan{}".format(stage, dataset, n_s, n_g, nan_frac), "stage": stage, "dataset": dataset,
+             "n_samples": n_s, "n_genes": n_g, "nan_frac": nan_frac, "wall_s": np.nan, "cpu_s": np.nan,
+             "peak_rss_mb": np.nan, "stage_rss_mb": np.nan, "error": None}
+
+      # a failing stage is recorded and the other cases still run
+      try:
+        runs = [timeStageFresh(stage, dataset, case_dir, out_dir) for r in range(repeats)]
+      except Exception as e:
+        log.error("%s failed: %r", row["case"], e)
+        row["error"] = repr(e)
+        rows.append(row)
+        continue
+
+      wall = min(r["wall_s"] for r in runs)
+      row.update({"wall_s": wall,
+                  "cpu_s": min(r["cpu_s"] for r in runs),
+                  "peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+                  "stage_rss_mb": max(r["peak_rss_mb"] - r["base_rss_mb"] for r in runs)})
+      if stage == "corrs":
+        row["throughput"], row["unit"] = len(mito_genes) * n_g / wall, "pairs/s"
+      else:
+        row["throughput"], row["unit"] = n_s * n_g / wall, "values/s"
+      log.info("{:40s} {:8.3f}s {:10.0f} {} {:8.1f} MB".format(row["case"], wall, row["throughput"], row["unit"], row["stage_rss_mb"]))
+      rows.append(row)
+
+  results = pd.DataFrame(rows)
+
+  if save_baseline == True:
+    baseline = {r["case"]: {"wall_s": r["wall_s"], "stage_rss_mb": r["stage_rss_mb"]} for r in rows if r["error"] == None}
+    with open(baseline_path, "w", encoding="utf-8") as f:
+      json.dump({"machine": platform.platform(), "python": platform.python_version(), "cases": baseline}, f, indent=1)
+    log.info("saved baseline to %s", baseline_path)
+
+  elif os.path.exists(baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+      results = compareBaseline(results, json.load(f)["cases"], tolerance)
+    flagged = results[results["regression"]]
+    log.info("%d of %d cases slower or larger than the baseline by more than %s", len(flagged), len(results), tolerance)
+    for i in flagged.index:
+      log.warning("%s wall x%.2f memory x%.2f", flagged.loc[i, "case"], flagged.loc[i, "wall_ratio"], flagged.loc[i, "rss_ratio"])
+
+  results.to_csv(os.path.join(bench_dir, "benchmark_results.csv"), index=False)
+
+  return(results)
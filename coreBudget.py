@@ -0,0 +1,137 @@
+# functions to share one core budget between files and the gene blocks within each file
+# files run in joblib worker processes, blocks within a file run in threads, and BLAS is limited
+# in each so that processes x threads x BLAS threads never exceeds the budget
+# blocks can instead run in worker processes attached to memory-mapped copies of the matrix, so nothing is pickled
+
+
+def splitCores(n_files, n_cores=None):
+
+  # """
+  # n_files: number of files to process
+  # n_cores: total core budget, default is all cores on the machine
+  # returns the number of files to run at once and the number of cores each of them gets
+  # """
+
+  import os
+
+  if n_cores == None:
+    n_cores = os.cpu_count()
+
+  n_outer = max(1, min(n_files, n_cores))
+  n_inner = max(1, n_cores // n_outer)
+
+  return(n_outer, n_inner)
+
+
+def runFiles(fn, files, n_cores=None):
+
+  # """
+  # fn: function called as fn(file, n_threads) - n_threads is that file's share of the budget
+  # files: list of files
+  # n_cores: total core budget, default is all cores on the machine
+  # runs fn over all files, as many at once as the budget allows, with BLAS in each limited to its share
+  # """
+
+  from joblib import Parallel, delayed
+
+  n_outer, n_inner = splitCores(len(files), n_cores)
+
+  def doFile(f):
+    from threadpoolctl import threadpool_limits
+    with threadpool_limits(limits=n_inner, user_api='blas'):
+      return(fn(f, n_inner))
+
+  return(Parallel(n_jobs=n_outer)(delayed(doFile)(f) for f in files))
+
+
+def runTasks(fn, tasks, n_threads=1):
+
+  # """
+  # fn: function called as fn(*task)
+  # tasks: list of argument tuples
+  # n_threads: number of threads to run tasks on
+  # runs the tasks on a thread pool, BLAS is limited to one thread per task when more than one runs at once.
+  # Returns the results in task order
+  # """
+
+  from joblib import Parallel, delayed
+  from threadpoolctl import threadpool_limits
+
+  if n_threads == 1 or len(tasks) <= 1:
+    return([fn(*task) for task in tasks])
+
+  with threadpool_limits(limits=1, user_api='blas'):
+    return(Parallel(n_jobs=n_threads, backend="threading")(delayed(fn)(*task) for task in tasks))
+
+
+def colBlocks(n_cols, n_blocks, min_block=256):
+
+  # """
+  # n_cols: number of columns to split
+  # n_blocks: number of blocks wanted, i.e. the threads available
+  # min_block: smallest block worth a task of its own
+  # returns (start, end) col ranges covering all columns
+  # """
+
+  size = max(min_block, -(-n_cols // max(1, n_blocks)))
+
+  return([(j0, min(j0 + size, n_cols)) for j0 in range(0, n_cols, size)])
+
+
+def sharedArray(a, path):
+
+  # """
+  # a: array to share with worker processes
+  # path: .npy file to hold it, i.e. under /dev/shm to keep it in shared memory rather than on disk
+  # writes a to path once and returns it memory-mapped - workers that open path map the same pages rather than
+  # receiving a pickled copy
+  # """
+
+  import numpy as np
+
+  out = np.lib.format.open_memmap(path, mode='w+', dtype=a.dtype, shape=a.shape)
+  out[:] = a
+  out.flush()
+
+  return(out)
+
+
+def sharedBlock(fn, inputs, outputs, j0, j1):
+
+  # """
+  # runs fn on one block inside a worker process, see runSharedBlocks
+  # """
+
+  import numpy as np
+  from threadpoolctl import threadpool_limits
+
+  ins = {k: np.load(inputs[k], mmap_mode='r') for k in inputs}
+  outs = {k: np.load(outputs[k], mmap_mode='r+') for k in outputs}
+
+  with threadpool_limits(limits=1, user_api='blas'):
+    res = fn(ins, outs, j0, j1)
+
+  for k in outs:
+    outs[k].flush()
+
+  return(res)
+
+
+def runSharedBlocks(fn, inputs, outputs, blocks, n_procs=1):
+
+  # """
+  # fn: module-level function called as fn(ins, outs, start, end) - ins and outs are dicts of memory-mapped arrays
+  # inputs: dict of name -> .npy path of the read-only inputs, i.e. from sharedArray
+  # outputs: dict of name -> .npy path of the outputs, each block writes only its own slice of them
+  # blocks: list of (start, end) ranges, i.e. from colBlocks
+  # n_procs: number of worker processes
+  # runs the blocks in worker processes that attach to the mapped files zero-copy - only paths and block ranges are
+  # sent to the workers. BLAS is limited to one thread per worker. Returns fn's results in block order
+  # """
+
+  from joblib import Parallel, delayed
+
+  if n_procs == 1 or len(blocks) <= 1:
+    return([sharedBlock(fn, inputs, outputs, j0, j1) for j0, j1 in blocks])
+
+  return(Parallel(n_jobs=n_procs, backend="loky")(delayed(sharedBlock)(fn, inputs, outputs, j0, j1) for j0, j1 in blocks))
@@ -0,0 +1,151 @@
+# functions to run a graph of dependent tasks under one core and memory budget
+# each task declares the tasks it needs, the cores it uses and an estimate of its peak memory - a task starts as soon
+# as its dependencies are done and it fits in what is left of the budget, so independent chains (i.e. the stages of
+# different tissues) overlap rather than running file by file
+# tasks run in worker processes, with BLAS in each limited to the task's cores
+
+
+class Task:
+
+  # """
+  # name: unique name of the task, i.e. (tissue, stage)
+  # fn: module-level function called as fn(*args, n_threads=cores) in a worker process
+  # args: tuple of arguments for fn, must be picklable
+  # deps: names of the tasks that must finish first
+  # cores: cores the task uses, fn gets them as n_threads
+  # mem: estimate of the task's peak memory in bytes
+  # """
+
+  def __init__(self, name, fn, args=(), deps=(), cores=1, mem=0):
+
+    self.name = name
+    self.fn = fn
+    self.args = tuple(args)
+    self.deps = list(deps)
+    self.cores = max(1, int(cores))
+    self.mem = max(0, int(mem))
+
+
+def taskOrder(tasks):
+
+  # """
+  # tasks: list of Task
+  # returns the task names in an order where every task comes after its dependencies - raises ValueError on unknown
+  # dependencies, repeated names or cycles
+  # """
+
+  names = [t.name for t in tasks]
+  if len(set(names)) != len(names):
+    raise ValueError("task names must be unique")
+
+  deps = {t.name: t.deps for t in tasks}
+  for name in deps:
+    missing = [d for d in deps[name] if d not in deps]
+    if len(missing) > 0:
+      raise ValueError("task {} depends on unknown tasks {}".format(name, missing))
+
+  order = []
+  done = set()
+  while len(order) < len(names):
+    ready = [name for name in names if name not in done and all(d in done for d in deps[name])]
+    if len(ready) == 0:
+      raise ValueError("tasks {} form a cycle".format([name for name in names if name not in done]))
+    order.extend(ready)
+    done.update(ready)
+
+  return(order)
+
+
+def machineMemory():
+
+  # """
+  # returns the physical memory of the machine in bytes
+  # """
+
+  import os
+
+  return(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+
+
+def runTask(fn, args, cores):
+
+  # """
+  # runs one task inside a worker process, see runDag
+  # """
+
+  from threadpoolctl import threadpool_limits
+
+  with threadpool_limits(limits=cores, user_api='blas'):
+    return(fn(*args, n_threads=cores))
+
+
+def runDag(tasks, max_cores=None, max_mem=None):
+
+  # """
+  # tasks: list of Task
+  # max_cores: total cores shared by all running tasks, default is all cores on the machine
+  # max_mem: total bytes shared by the memory estimates of all running tasks, default is the machine's physical memory
+  # runs every task once its dependencies are done, starting ready tasks in list order while their cores and memory
+  # fit in the budget. A task asking for more than the whole budget runs on its own with at most max_cores cores.
+  # If a task fails, no further tasks are started and the error is raised once the running tasks finish.
+  # Returns a dict of task name -> fn's result
+  # """
+
+  import os
+  import time
+  from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+  from pipelineLog import stageLogger
+
+  log = stageLogger("dagScheduler")
+
+  if max_cores == None:
+    max_cores = os.cpu_count()
+  if max_mem == None:
+    max_mem = machineMemory()
+
+  # validates the graph before anything starts
+  order = taskOrder(tasks)
+  pending = [t for t in tasks]
+
+  results = {}
+  running = {}
+  used_cores, used_mem = 0, 0
+  error = None
+  start = time.time()
+
+  with ProcessPoolExecutor(max_workers=max_cores) as pool:
+
+    while len(pending) > 0 or len(running) > 0:
+
+      # start every ready task that fits, in list order
+      if error == None:
+        for t in [t for t in pending if all(d in results for d in t.deps)]:
+          cores = min(t.cores, max_cores)
+          fits = used_cores + cores <= max_cores and used_mem + t.mem <= max_mem
+          if fits or len(running) == 0:
+            log.info("starting %s cores: %d mem: %.2f GB", t.name, cores, t.mem / 1e9)
+            running[pool.submit(runTask, t.fn, t.args, cores)] = (t, cores)
+            pending.remove(t)
+            used_cores += cores
+            used_mem += t.mem
+
+      if len(running) == 0:
+        break
+
+      finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+      for future in finished:
+        t, cores = running.pop(future)
+        used_cores -= cores
+        used_mem -= t.mem
+        try:
+          results[t.name] = future.result()
+          log.info("finished %s after %.1fs", t.name, time.time() - start)
+        except Exception as e:
+          log.error("failed %s %r", t.name, e)
+          if error == None:
+            error = e
+
+  if error != None:
+    raise error
+
+  return({name: results[name] for name in order})
@@ -3,50 +3,79 @@
 # outputs filtered files
 # AFB 16/01/2020
 
-def filterNullGenesAndSamps(file_dir="", pattern=".csv", filesep=",", outdir=None, outlabel=""):
+def filterNullGenesAndSamps(file_dir="", pattern=".csv", filesep=",", outdir=None, outlabel="", out_format="csv", incremental=False,
+                            report_dir=None, profile=False):
   
   # """
   # file_dir: directory containing the rpkms
-  # pattern: pattern to search for, default is all .csv files
+  # pattern: pattern to search for, default is all .csv files. Input format is taken from the file suffix (see matrixIO)
   # outdir: where should the files go, default is file_dir
-  # filesep: file separating char, default is comma
+  # filesep: file separating char of text input, default is comma
   # outlabel: add label to output files
+  # out_format: output file suffix - csv, parquet, feather or npy
+  # incremental: skip files whose input, parameters and code are unchanged since the last run, keeping their outputs (see stageCache)
+  # report_dir: record each file's time, memory, bytes and genes a second in a run report in this directory (see runReport)
+  # profile: with report_dir, also keep a cProfile of each file
   # """
   
   import os 
-  import pandas as pd
+  from matrixIO import matrixFiles, matrixPaths, readMatrix, writeMatrix
+  from stageCache import stageManifest, saveManifest
+  from runReport import newRunId, stageReport, writeRunReport
+  from pipelineLog import stageLogger
+  
+  log = stageLogger("filterNullGenesAndSamps")
+  run = newRunId()
   
   if outdir == None:
     outdir = file_dir
+  outdir = os.path.abspath(outdir)
   
   # get all file paths
-  file_paths = [file_dir+file for file in os.listdir(file_dir) if pattern in file]
-  file_names = [file for file in os.listdir(file_dir) if pattern in file]
-  print(file_names)
+  file_names = matrixFiles(file_dir, pattern)
+  file_paths = [file_dir+file for file in file_names]
+  log.info("files: %s", file_names)
   
   for i in range(0,len(file_paths)):
     
-    print(file_names[i])
+    log.info(file_names[i])
+    
+    out_path = os.path.join(outdir, os.path.splitext(file_names[i])[0] + "_" + outlabel + "_0filtered." + out_format)
+    
+    if incremental == True:
+      up_to_date, manifest = stageManifest(outdir, "filterNullGenesAndSamps", file_names[i], [file_paths[i]],
+                                           {"pattern": pattern, "filesep": filesep, "outlabel": outlabel, "out_format": out_format},
+                                           ["filterNullGenesAndSamps", "matrixIO"], matrixPaths(out_path))
+      if up_to_date:
+        log.info("unchanged since the last run - keeping %s", out_path)
+        continue
     
-    # import df
-    df = pd.read_csv(open(file_paths[i]), sep=filesep, encoding="utf-8", engine='python', index_col=0, header=0) # genes cols, samples rows
+    with stageReport(report_dir, "filterNullGenesAndSamps", file_names[i], [file_paths[i]], matrixPaths(out_path), profile, run) as rec:
+      
+      # import df
+      df = readMatrix(file_paths[i], sep=filesep) # genes cols, samples rows
     
-    # genes to cols 
-    if len(df.index.values) > len(df.columns.values):
-      df = df.transpose()
+      # genes to cols 
+      if len(df.index.values) > len(df.columns.values):
+        df = df.transpose()
+      rec["samples"], rec["genes"] = df.shape
     
-    # removing samples with all vals = 0
-    df = df.loc[~(df==0).all(axis=1)]
+      # removing samples with all vals = 0
+      df = df.loc[~(df==0).all(axis=1)]
 
-    # removing genes with all 0s
-    df = df.loc[:, ~(df==0).all(axis=0)] 
+      # removing genes with all 0s
+      df = df.loc[:, ~(df==0).all(axis=0)] 
     
-    # retaining cols where all vals are not equal to 0
-    df = df.loc[:, (df!=0).all(axis=0)]
+      # retaining cols where all vals are not equal to 0
+      df = df.loc[:, (df!=0).all(axis=0)]
     
-    # export filtered file
-    os.chdir(outdir)
-    df.to_csv(file_names[i].replace('.csv', '') + "_" + outlabel + "_0filtered.csv", index=True, header=True)
+      # export filtered file
+      writeMatrix(df, out_path)
+    
+    if incremental == True:
+      saveManifest(outdir, "filterNullGenesAndSamps", file_names[i], manifest)
+  
+  writeRunReport(report_dir, run)
   
 # def filterGenesInAllFiles(file_dir="", pattern=".csv", filesep=",", outdir=None, outlabel="", med_fill_na=False):
 #   
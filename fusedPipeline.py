@@ -0,0 +1,345 @@
+# function runPipeline
+# runs filter -> log10 median normalise -> mask outliers -> regress covariates -> mt-nuc corrs per tissue in one process,
+# passing LabelledMatrix objects between the stages instead of writing and re-reading a csv after each one
+# takes in a matrix of TPMs, rows=samples , cols=genes
+# writing the intermediate files is opt-in
+
+
+def filterStage(m):
+
+  # """
+  # m: LabelledMatrix, rows=samples, cols=genes
+  # as filterNullGenesAndSamps - removes samples with all vals = 0, then retains genes where no val is 0
+  # """
+
+  m = m.subset(rows=~(m.values == 0).all(axis=1))
+
+  return(m.subset(cols=(m.values != 0).all(axis=0)))
+
+
+def normaliseStage(m, med_norm=True):
+
+  # """
+  # m: LabelledMatrix, rows=samples, cols=genes
+  # med_norm: can disable median normalisation by setting this to False
+  # as log10MedNormaliseMatrix - drops samples with no reads and genes without reads in every sample, log10(x+1)
+  # transforms and median normalises so all samples share the same median
+  # """
+
+  import numpy as np
+  from log10MedNormalise import medianNormalise
+  from labelledMatrix import LabelledMatrix
+
+  # remove individuals that have zero reads
+  m = m.subset(rows=(m.values > 0).any(axis=1))
+
+  # remove genes that have zero reads - also removes genes with NAs
+  m = m.subset(cols=(m.values > 0).all(axis=0))
+
+  # log10 normalising
+  a = np.log10(m.values + 1)
+
+  # medianNormalise works on samples as cols
+  if med_norm == True:
+    a = medianNormalise(a.T).T
+
+  return(LabelledMatrix(a, m.rows, m.cols))
+
+
+def maskStage(m, n_threads=1, shared_dir=None):
+
+  # """
+  # m: LabelledMatrix, rows=samples, cols=genes
+  # n_threads: number of threads, genes are split into one col block per thread
+  # shared_dir: mask in worker processes attached to a memory-mapped copy of the matrix, see maskMatrix
+  # as maskGeneOutliers - returns a masked copy of m and the per-gene mask counts DataFrame
+  # """
+
+  from maskGeneOutliers import maskMatrix
+  from labelledMatrix import LabelledMatrix
+
+  a = m.values.copy()
+  counts = maskMatrix(a, m.cols, n_threads, shared_dir)
+
+  return(LabelledMatrix(a, m.rows, m.cols), counts)
+
+
+def regressStage(m, design, sample_ids=None):
+
+  # """
+  # m: LabelledMatrix, rows=samples, cols=genes
+  # design: design dict from cachedDesign, i.e. from gtexDesign or rosmapDesign
+  # sample_ids: ids of the rows of m as they appear in the design index, default is the row labels
+  # regresses the design covs out of every gene, returns the residuals with rows in the design's sample order
+  # """
+
+  import pandas as pd
+  from batchedOLS import batchedResiduals
+  from labelledMatrix import LabelledMatrix
+
+  ids = m.rows if sample_ids is None else pd.Index(sample_ids)
+
+  # order rows the same as the covs
+  order = ids.get_indexer(design["index"])
+  if (order < 0).any():
+    raise ValueError("{} design samples are missing from the expression matrix".format(int((order < 0).sum())))
+
+  residuals = batchedResiduals(m.values[order], design["covs"].values, factors=design["factors"])
+
+  return(LabelledMatrix(residuals, design["index"], m.cols))
+
+
+def corrStage(m, method="pearson", all_corrs=False, n_threads=1, shared_dir=None):
+
+  # """
+  # m: LabelledMatrix, rows=samples, cols=genes
+  # method: correlation method - spearman or pearson
+  # all_corrs: correlate all gene pairs rather than the 13 mt genes against all genes
+  # n_threads: number of threads, genes are split into one col block per thread
+  # shared_dir: correlate in worker processes attached to memory-mapped copies of the matrix, see blockCorrs
+  # as genCorrs with the matrix engine - returns a dict of corrs, pvals and nobs LabelledMatrix objects
+  # """
+
+  from genCorrs import mito_genes, matrixCorrs
+  from labelledMatrix import LabelledMatrix
+
+  # remove gene version numbers
+  genes = m.cols.str.replace("\\..*", "", regex=True)
+
+  rows = genes if all_corrs == True else mito_genes
+  r, p, n_obs = matrixCorrs(m.values, [genes.get_loc(g) for g in rows], method=method, n_threads=n_threads, shared_dir=shared_dir)
+
+  return({"corrs": LabelledMatrix(r, rows, genes),
+          "pvals": LabelledMatrix(p, rows, genes),
+          "nobs": LabelledMatrix(n_obs, rows, genes)})
+
+
+def readTissue(path, filesep=","):
+
+  # """
+  # path: TPM matrix file of one tissue, any format matrixIO reads
+  # filesep: file separating char of text input
+  # returns the matrix as a LabelledMatrix with genes as cols, without the ROS/MAP brain_region col
+  # """
+
+  from labelledMatrix import LabelledMatrix
+  from matrixIO import readMatrix
+
+  df = readMatrix(path, sep=filesep)
+
+  # genes to cols
+  if len(df.index) > len(df.columns):
+    df = df.T
+
+  if 'brain_region' in df.columns.values:
+    df = df.drop('brain_region', axis='columns')
+
+  return(LabelledMatrix.fromDf(df))
+
+
+def tissueRegressFn(regress=None, meta_path=None, cache_dir=None, meta=None, pheno=None, pheno_path=None):
+
+  # """
+  # regress: covariates to regress out - gtex, rosmap or None
+  # meta_path: preprocessed ROS/MAP metadata file, or the GTEx sample attributes file meta was parsed from
+  # cache_dir: optional directory to persist covariate designs in, see gtex_regress_covariates
+  # meta, pheno: GTEx metadata and phenotypes from loadGtexMeta
+  # pheno_path: GTEx phenotype file pheno was parsed from
+  # returns the regress_fn fusedPipeline takes - builds the tissue's design and regresses it out - or None to skip
+  # """
+
+  from batchedOLS import saveDesign
+
+  if regress == "gtex":
+    from gtex_regress_covariates import gtexDesign
+    from gtexMetadata import gtexShortIds
+
+    def regress_fn(m):
+      long_ids = m.rows.str.replace(r'\.', '-', regex=True)
+      design_key, design = gtexDesign(long_ids, meta, pheno, cache_dir, [p for p in [meta_path, pheno_path] if p != None])
+      residuals = regressStage(m, design, sample_ids=gtexShortIds(long_ids))
+      if cache_dir != None:
+        saveDesign(design_key, design, cache_dir)
+      return(residuals)
+
+  elif regress == "rosmap":
+    from rosmap_regress_covariates import rosmapDesign, rosmapSampleIds
+
+    def regress_fn(m):
+      sample_ids = rosmapSampleIds(m.rows)
+      design_key, design = rosmapDesign(sample_ids, meta_path, cache_dir)
+      residuals = regressStage(m, design, sample_ids=sample_ids)
+      if cache_dir != None:
+        saveDesign(design_key, design, cache_dir)
+      return(residuals)
+
+  else:
+    regress_fn = None
+
+  return(regress_fn)
+
+
+def fusedPipeline(m, regress_fn=None, method="pearson", all_corrs=False, med_norm=True, n_threads=1, intermediates=None, shared_dir=None):
+
+  # """
+  # m: LabelledMatrix of TPMs, rows=samples, cols=genes
+  # regress_fn: function taking the masked LabelledMatrix and returning the residuals, i.e. regressStage with a
+  # tissue's design. Default None skips the covariate regression
+  # method: correlation method - spearman or pearson
+  # all_corrs: correlate all gene pairs rather than the 13 mt genes against all genes
+  # med_norm: can disable median normalisation by setting this to False
+  # n_threads: threads for the masking and correlation stages
+  # intermediates: optional dict - each stage's output is added to it under the stage name (filtered, normalised,
+  # masked, mask_counts, residuals). Default None keeps nothing but the corrs
+  # shared_dir: run the masking and correlation blocks in worker processes attached to memory-mapped copies of the
+  # matrix, i.e. under /dev/shm, rather than in threads
+  # returns the dict of corrs, pvals and nobs from corrStage
+  # """
+
+  from pipelineLog import stageLogger
+
+  log = stageLogger("fusedPipeline")
+  keep = intermediates is not None
+
+  log.info("filtering genes")
+  m = filterStage(m)
+  if keep:
+    intermediates["filtered"] = m
+
+  log.info("log10 median normalising")
+  m = normaliseStage(m, med_norm=med_norm)
+  if keep:
+    intermediates["normalised"] = m
+
+  log.info("masking outliers")
+  m, counts = maskStage(m, n_threads, shared_dir)
+  log.info("masked: %d genes with masked values: %d", counts['n_masked'].sum(), (counts['n_masked'] > 0).sum())
+  if keep:
+    intermediates["masked"] = m
+    intermediates["mask_counts"] = counts
+
+  if regress_fn != None:
+    log.info("regressing out covariates")
+    m = regress_fn(m)
+    if keep:
+      intermediates["residuals"] = m
+
+  log.info("generating mt-nuc correlations")
+
+  return(corrStage(m, method=method, all_corrs=all_corrs, n_threads=n_threads, shared_dir=shared_dir))
+
+
+def runPipeline(file_dir="", pattern=".csv", filesep=",", outdir=None, outlabel="", regress=None, meta_path=None, pheno_path=None,
+                cache_dir=None, method="pearson", all_corrs=False, med_norm=True, write_intermediates=False, n_cores=None, out_format="csv",
+                shared_dir=None, incremental=False, report_dir=None, profile=False):
+
+  # """
+  # file_dir: directory containing the TPM files
+  # pattern: pattern to search for, default is all .csv files
+  # filesep: file separating char of text input, default is comma. Input format is taken from the file suffix (see matrixIO)
+  # outdir: where should the files go, default is file_dir
+  # outlabel: add label to output files
+  # regress: covariates to regress out - gtex (needs meta_path and pheno_path), rosmap (needs meta_path) or None to skip
+  # meta_path: GTEx sample attributes file or preprocessed ROS/MAP metadata file
+  # pheno_path: GTEx phenotype file
+  # cache_dir: optional directory to persist parsed metadata and covariate designs in, see gtex_regress_covariates
+  # method: correlation method - spearman or pearson
+  # all_corrs: correlate all gene pairs rather than the 13 mt genes against all genes
+  # med_norm: can disable median normalisation by setting this to False
+  # write_intermediates: also write each stage's output with the label the file-based stage would give it
+  # (_0filtered, _log10_mediannorm_TPM, _masked_outliers + _mask_counts, _residuals). Default False writes only the corrs
+  # n_cores: total cores shared by all files and the gene blocks within them, default is all cores on the machine
+  # out_format: output file suffix - csv, parquet, feather or npy
+  # shared_dir: directory for memory-mapped copies of each file's matrix, see fusedPipeline
+  # incremental: skip files whose input, metadata, parameters and code are unchanged since the last run, keeping their
+  # outputs (see stageCache)
+  # report_dir: record each file's time, memory, bytes and genes a second in a run report in this directory (see runReport)
+  # profile: with report_dir, also keep a cProfile of each file
+  # each file is read once and only the _corrs, _pvals and _nobs matrices are written, as genCorrs
+  # """
+
+  import os
+  from coreBudget import runFiles
+  from matrixIO import matrixFiles, matrixPaths, writeMatrix
+  from stageCache import stageManifest, saveManifest
+  from runReport import newRunId, stageReport, writeRunReport
+  from pipelineLog import stageLogger
+
+  log = stageLogger("fusedPipeline")
+  run = newRunId()
+
+  if outdir == None:
+    outdir = file_dir
+  outdir = os.path.abspath(outdir)
+
+  # metadata is parsed once and shared by all files
+  meta, pheno = None, None
+  if regress == "gtex":
+    from gtexMetadata import loadGtexMeta
+    meta, pheno = loadGtexMeta(meta_path, pheno_path, cache_dir)
+
+  # get all file paths
+  file_paths = matrixFiles(file_dir, pattern)
+  log.info("files: %s", file_paths)
+
+  # output labels of the intermediates, as the file-based stages name them
+  norm_label = "log10_mediannorm_TPM" if med_norm == True else "log10_norm_TPM"
+  labels = {"filtered": "0filtered", "normalised": norm_label, "masked": "masked_outliers", "mask_counts": "mask_counts"}
+  if regress != None:
+    labels["residuals"] = "residuals"
+
+  def doFile(f, n_threads=1):
+
+    fn = f.replace(pattern, '')
+    log.info(fn)
+
+    prefix = os.path.join(outdir, fn + "_" + outlabel + "_")
+    out_paths = {k: prefix + method + "_" + k + "." + out_format for k in ["corrs", "pvals", "nobs"]}
+    if write_intermediates == True:
+      out_paths.update({stage: prefix + labels[stage] + "." + out_format for stage in labels})
+
+    if incremental == True:
+      in_paths = [os.path.join(file_dir, f)] + [p for p in [meta_path, pheno_path] if regress != None and p != None]
+      params = {"pattern": pattern, "filesep": filesep, "outlabel": outlabel, "regress": regress, "method": method,
+                "all_corrs": all_corrs, "med_norm": med_norm, "write_intermediates": write_intermediates, "out_format": out_format}
+      modules = ["fusedPipeline", "labelledMatrix", "log10MedNormalise", "maskGeneOutliers", "batchedOLS", "genCorrs",
+                 "gtex_regress_covariates", "gtexMetadata", "rosmap_regress_covariates", "coreBudget", "matrixIO"]
+      up_to_date, manifest = stageManifest(outdir, "runPipeline", f, in_paths, params, modules,
+                                           [p for k in out_paths for p in matrixPaths(out_paths[k])])
+      if up_to_date:
+        log.info("unchanged since the last run - keeping %s", out_paths["corrs"])
+        return
+
+    with stageReport(report_dir, "runPipeline", f, [os.path.join(file_dir, f)], [p for k in out_paths for p in matrixPaths(out_paths[k])], profile, run) as rec:
+
+      m = readTissue(os.path.join(file_dir, f), filesep)
+      log.debug("%s", m.shape)
+      rec["samples"], rec["genes"] = m.shape
+
+      regress_fn = tissueRegressFn(regress, meta_path, cache_dir, meta, pheno, pheno_path)
+
+      intermediates = {} if write_intermediates == True else None
+      out = fusedPipeline(m, regress_fn=regress_fn, method=method, all_corrs=all_corrs, med_norm=med_norm,
+                          n_threads=n_threads, intermediates=intermediates, shared_dir=shared_dir)
+
+      # write out
+      if write_intermediates == True:
+        for stage in labels:
+          if stage == "mask_counts":
+            writeMatrix(intermediates[stage], out_paths[stage])
+          else:
+            writeMatrix(intermediates[stage].toDf(), out_paths[stage])
+
+      rec["pairs"] = out["corrs"].shape[0] * out["corrs"].shape[1]
+      for k in out:
+        log.debug("%s %s", k, out[k].shape)
+        writeMatrix(out[k].toDf(), out_paths[k])
+
+    if incremental == True:
+      saveManifest(outdir, "runPipeline", f, manifest)
+
+  # files and the gene blocks within them share one core budget
+  runFiles(doFile, file_paths, n_cores)
+
+  writeRunReport(report_dir, run)
+
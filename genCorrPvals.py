@@ -0,0 +1,53 @@
+# function genCorrPvals
+# takes in correlation matrices already written by genCorrs, rows=genes, cols=genes
+# computes every two-sided p-value in one vectorised t-distribution call, using the per-pair sample counts
+# in the matching _nobs file or a fixed sample count
+# outputs p-value matrices
+
+
+def genCorrPvals(file_dir="", pattern="_corrs.csv", outdir=None, n_samples=None, float32=False):
+  
+  # """
+  # file_dir: directory containing the correlation matrices
+  # pattern: pattern to search for, default is all genCorrs .csv correlation matrices. Any matrixIO format can be read,
+  # p-values are written in the same format
+  # outdir: where should the files go, default is file_dir
+  # n_samples: number of samples every r was computed from. Default None reads the per-pair counts
+  # from the _nobs file that genCorrs writes next to each _corrs file
+  # float32: compute and write single precision p-values
+  # """
+  
+  import os
+  import pandas as pd
+  from genCorrs import corrPvals
+  from matrixIO import matrixFiles, readMatrix, writeMatrix
+  from pipelineLog import stageLogger
+  
+  log = stageLogger("genCorrPvals")
+  
+  if outdir == None:
+    outdir = file_dir
+  outdir = os.path.abspath(outdir)
+  
+  # get all file paths
+  file_paths = [file for file in matrixFiles(file_dir, pattern) if '_corrs' in file]
+  log.info("files: %s", file_paths)
+  
+  for f in file_paths:
+    
+    log.info(f)
+    
+    # import corr matrix - .npy inputs are memory-mapped rather than read into memory
+    df_corr = readMatrix(file_dir+f, mmap=True)
+    
+    if n_samples == None:
+      df_n = readMatrix(file_dir+f.replace('_corrs', '_nobs'), mmap=True)
+      # align counts to the corr matrix by gene labels
+      n_obs = df_n.reindex(index=df_corr.index, columns=df_corr.columns).values
+    else:
+      n_obs = n_samples
+    
+    df_p = pd.DataFrame(corrPvals(df_corr.values, n_obs, float32=float32), index=df_corr.index, columns=df_corr.columns)
+    
+    # write out
+    writeMatrix(df_p, os.path.join(outdir, f.replace('_corrs', '_pvals')))
@@ -1,17 +1,52 @@
 # function to read in correlation and pval matrix files of the same size
 # makes them into long-form
 # places them into a df with gene cols to indicate mt-nuc gene pairs
+# optionally adds multiple-testing adjusted pvals, per tissue and across all tissues
 
-def genCorrSummaryTable(file_dir="", outdir=None, pattern=".csv", outfile_label=""):
+# adjusted pval cols added per pvals file with adjust=True - BH and Bonferroni within the tissue, then across all tissues
+adjusted_kinds = ["pval_bh", "pval_bonferroni", "pval_bh_global", "pval_bonferroni_global"]
+
+
+def adjustSummaryPvals(pvals, outs, scratch_dir=None, bucket_rows=20000000):
+  
+  # """
+  # pvals: list of 1d pval cols, one per tissue
+  # outs: dict of adjusted kind -> list of writable 1d cols, one per tissue, see adjusted_kinds
+  # scratch_dir: directory for the BH bucket files, see multipleTesting
+  # bucket_rows: pvals sorted in memory at once for BH
+  # """
+  
+  from multipleTesting import benjaminiHochberg, bonferroni
+  
+  for j in range(0, len(pvals)):
+    benjaminiHochberg([pvals[j]], [outs["pval_bh"][j]], scratch_dir, bucket_rows)
+    bonferroni([pvals[j]], [outs["pval_bonferroni"][j]])
+  
+  # all tissues as one family
+  benjaminiHochberg(pvals, outs["pval_bh_global"], scratch_dir, bucket_rows)
+  bonferroni(pvals, outs["pval_bonferroni_global"])
+
+
+def genCorrSummaryTable(file_dir="", outdir=None, pattern=".csv", outfile_label="", out_format="csv", adjust=False):
+  
+  # """
+  # out_format: output file suffix - csv, parquet or feather. Input format is taken from the file suffix (see matrixIO)
+  # adjust: add BH and Bonferroni adjusted pval cols per tissue and across all tissues (see adjusted_kinds)
+  # """
   
   # import libs
+  import numpy as np
   import pandas as pd
   import os
   import re
+  from matrixIO import matrixFiles, readMatrix, writeMatrix
+  from pipelineLog import stageLogger
   
-  file_names = [file for file in os.listdir(file_dir) if pattern+'_pvals' in file or pattern+'_corrs' in file]
+  log = stageLogger("genCorrSummaryTable")
   
-  print(file_names)
+  file_names = [file for file in matrixFiles(file_dir, pattern) if pattern+'_pvals' in file or pattern+'_corrs' in file]
+  
+  log.info("files: %s", file_names)
   
   if outdir == None:
     outdir = file_dir
@@ -28,11 +63,11 @@ def genCorrSummaryTable(file_dir="", outdir=None, pattern=".csv", outfile_label=
     name = file_names[i]#name_match.match(file_names[i]).group(1)
     
     # import df
-    df = pd.read_csv(open(file_dir+file_names[i]), index_col=0, header=0, encoding="utf-8", engine='python')
+    df = readMatrix(file_dir+file_names[i])
     
-    # check that mt are rows
-    if 'ENSG00000198888.2' not in df.index.values:
-      print("mito not rows - transposing")
+    # check that mt are rows - with or without gene version numbers
+    if not mitoRows(df.index):
+      log.info("mito not rows - transposing")
       df = df.transpose()
     
     # store in list
@@ -63,10 +98,18 @@ def genCorrSummaryTable(file_dir="", outdir=None, pattern=".csv", outfile_label=
   corr_df = pd.concat(corrs, axis=1)
   pval_df = pd.concat(pvals, axis=1)
   summary_df = pd.concat([corr_df, pval_df], axis=1)
+  
+  if adjust == True:
+    log.info("adjusting pvals")
+    pval_cols = pval_df.columns.tolist()
+    outs = {kind: [np.empty(len(summary_df)) for c in pval_cols] for kind in adjusted_kinds}
+    adjustSummaryPvals([summary_df[c].values.astype(np.float64) for c in pval_cols], outs)
+    adjusted = pd.DataFrame({c[:-len("pval")] + kind: outs[kind][j] for kind in adjusted_kinds for j, c in enumerate(pval_cols)},
+                            index=summary_df.index)
+    summary_df = pd.concat([summary_df, adjusted], axis=1)
     
-  print("saving file...")
-  os.chdir(outdir)
-  summary_df.to_csv(outfile_label+"summary_table.csv", index=True, header=True)
+  log.info("saving file...")
+  writeMatrix(summary_df, os.path.join(os.path.abspath(outdir), outfile_label+"summary_table." + out_format))
         
     
       
@@ -80,3 +123,148 @@ def genCorrSummaryTable(file_dir="", outdir=None, pattern=".csv", outfile_label=
 
 
 
+
+
+def mitoRows(rows):
+  
+  # """
+  # rows: row labels of a corr or pval matrix
+  # returns True when the mt genes are the rows, with or without gene version numbers
+  # """
+  
+  import pandas as pd
+  from genCorrs import mito_genes
+  
+  return(bool(pd.Index(rows).astype(str).str.replace("\\..*", "", regex=True).isin(mito_genes).any()))
+
+
+def streamCorrSummaryTable(file_dir="", outdir=None, pattern=".csv", outfile_label="", out_format="parquet", chunk_rows=1000000,
+                           adjust=False, bucket_rows=20000000):
+  
+  # """
+  # file_dir: directory of the corr and pval matrix files
+  # outdir: where should the file go, default is file_dir
+  # pattern: pattern to search for, the files used are those containing pattern_corrs and pattern_pvals
+  # outfile_label: label to start the output file name with
+  # out_format: output file suffix - parquet, feather or csv. Input format is taken from the file suffix (see matrixIO)
+  # chunk_rows: number of gene pairs written at once
+  # adjust: add BH and Bonferroni adjusted pval cols per tissue and across all tissues (see adjusted_kinds) - computed
+  # on the memory-mapped cols, sorting at most bucket_rows pvals in memory at a time (see multipleTesting). Pairs
+  # missing from a file are not counted as tests
+  # bucket_rows: pvals sorted in memory at once for BH
+  # streaming version of genCorrSummaryTable - same cols (mt_gene, nuc_gene, one corr col per corrs file, then one pval
+  # col per pvals file), but each value is placed by its (mt_gene, nuc_gene) key rather than by position, and only
+  # one matrix is in memory at a time. The keys are every pair of the mt genes and nuc genes found in any file, read
+  # from the labels before any values, and pairs missing from a file are NaN. Each file's values are written as one col
+  # of a memory-mapped store, which is then written out chunk_rows pairs at a time
+  # """
+  
+  import os
+  import shutil
+  import tempfile
+  import numpy as np
+  import pandas as pd
+  from matrixIO import matrixFiles, matrixFormat, matrixLabels, readMatrix
+  from pipelineLog import stageLogger
+  
+  log = stageLogger("genCorrSummaryTable")
+  
+  if outdir == None:
+    outdir = file_dir
+  
+  out_path = os.path.join(outdir, outfile_label+"summary_table." + out_format)
+  if matrixFormat(out_path) == "npy":
+    raise ValueError("the summary table has gene name cols, use parquet, feather or csv")
+  
+  file_names = [file for file in matrixFiles(file_dir, pattern) if pattern+'_pvals' in file or pattern+'_corrs' in file]
+  log.info("files: %s", file_names)
+  
+  # corr cols first, then pval cols, as genCorrSummaryTable
+  value_files = [f for f in file_names if 'corrs' in f] + [f for f in file_names if 'pvals' in f]
+  value_cols = [f+"corr" for f in value_files if 'corrs' in f] + [f+"pval" for f in value_files if 'pvals' in f]
+  if len(value_files) == 0:
+    raise ValueError("no {}_corrs or {}_pvals files in {}".format(pattern, pattern, file_dir))
+  
+  pval_files = [f for f in value_files if 'pvals' in f]
+  out_cols = value_cols
+  if adjust == True:
+    out_cols = value_cols + [f + kind for kind in adjusted_kinds for f in pval_files]
+  
+  # key index - all mt genes x all nuc genes, from the labels only
+  mt_genes, nuc_genes = [], []
+  for f in value_files:
+    rows, cols = matrixLabels(file_dir+f)
+    if not mitoRows(rows):
+      rows, cols = cols, rows
+    mt_genes.append(rows)
+    nuc_genes.append(cols)
+  
+  mt_genes = pd.Index(np.concatenate(mt_genes)).unique()
+  nuc_genes = pd.Index(np.concatenate(nuc_genes)).unique()
+  n_pairs = len(mt_genes) * len(nuc_genes)
+  log.info("gene pairs: %d", n_pairs)
+  
+  scratch_dir = tempfile.mkdtemp(prefix=".summary_", dir=outdir)
+  
+  try:
+    
+    # one col per file, col-major so each file's col is written contiguously
+    values = np.lib.format.open_memmap(os.path.join(scratch_dir, "values.npy"), mode='w+', dtype=np.float64,
+                                       shape=(n_pairs, len(out_cols)), fortran_order=True)
+    
+    for j in range(0, len(value_files)):
+      
+      log.info(value_files[j])
+      df = readMatrix(file_dir+value_files[j])
+      if not mitoRows(df.index):
+        df = df.transpose()
+      
+      # key of each value = mt position * n nuc genes + nuc position
+      keys = mt_genes.get_indexer(df.index)[:, None] * len(nuc_genes) + nuc_genes.get_indexer(df.columns)[None, :]
+      values[:, j] = np.nan
+      values[keys.ravel(), j] = df.values.ravel()
+      values.flush()
+      del df
+    
+    if adjust == True:
+      log.info("adjusting pvals")
+      pvals = [values[:, value_cols.index(f+"pval")] for f in pval_files]
+      outs = {kind: [values[:, out_cols.index(f+kind)] for f in pval_files] for kind in adjusted_kinds}
+      adjustSummaryPvals(pvals, outs, scratch_dir, bucket_rows)
+      values.flush()
+    
+    log.info("saving file...")
+    writer = None
+    for r0 in range(0, n_pairs, chunk_rows):
+      
+      r1 = min(r0 + chunk_rows, n_pairs)
+      pos = np.arange(r0, r1)
+      chunk = pd.DataFrame(np.asarray(values[r0:r1]), index=pd.RangeIndex(r0, r1), columns=out_cols)
+      chunk.insert(0, "nuc_gene", nuc_genes[pos % len(nuc_genes)])
+      chunk.insert(0, "mt_gene", mt_genes[pos // len(nuc_genes)])
+      
+      if out_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer == None:
+          writer = pq.ParquetWriter(out_path, table.schema)
+        writer.write_table(table)
+      
+      elif out_format == "feather":
+        # feather has no index, kept as the first col as writeMatrix does
+        import pyarrow as pa
+        table = pa.Table.from_pandas(chunk.reset_index(), preserve_index=False)
+        if writer == None:
+          writer = pa.ipc.new_file(out_path, table.schema)
+        writer.write_table(table)
+      
+      else:
+        sep = "," if matrixFormat(out_path) == "csv" else "\t"
+        chunk.to_csv(out_path, sep=sep, mode="w" if r0 == 0 else "a", header=(r0 == 0), index=True)
+    
+    if writer != None:
+      writer.close()
+    
+  finally:
+    shutil.rmtree(scratch_dir, ignore_errors=True)
@@ -7,7 +7,469 @@
 # AFB 16/01/2020
 
 
-def genCorrs(file_dir="", pattern=".csv", outdir=None, outlabel="", method="pearson", random_shuffle_cols=False, all_corrs=False):
+# defining mito genes - allows generation of a nuc x mito corr matrix
+mito_genes = ['ENSG00000198888','ENSG00000198763','ENSG00000198840','ENSG00000198886',
+'ENSG00000212907','ENSG00000198786','ENSG00000198695','ENSG00000198899',
+'ENSG00000228253','ENSG00000198804','ENSG00000198712','ENSG00000198938',
+'ENSG00000198727']
+
+
+def standardiseCols(a):
+  
+  # """
+  # a: 2d array, rows=samples, cols=genes
+  # centres each column and scales it to unit length, so that the dot product of two
+  # standardised columns is their pearson r. Zero-variance columns come back as NaN
+  # """
+  
+  import numpy as np
+  
+  a = np.array(a, dtype=np.float64)
+  a -= a.mean(axis=0)
+  norms = np.sqrt((a * a).sum(axis=0))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    a /= norms
+  
+  return(a)
+
+
+def pearsonCorrMatrix(x, y):
+  
+  # """
+  # x: 2d array, rows=samples, cols=genes - becomes the rows of the corr matrix
+  # y: 2d array, rows=samples, cols=genes - becomes the cols of the corr matrix
+  # returns the x.cols by y.cols pearson r matrix from a single matrix multiply. Inputs must not contain NaNs
+  # """
+  
+  import numpy as np
+  
+  r = standardiseCols(x).T @ standardiseCols(y)
+  
+  # rounding error can push |r| fractionally past 1
+  np.clip(r, -1, 1, out=r)
+  
+  return(r)
+
+
+def pairwisePearson(x, y):
+  
+  # """
+  # x: 2d array, rows=samples, cols=genes - becomes the rows of the corr matrix
+  # y: 2d array, rows=samples, cols=genes - becomes the cols of the corr matrix
+  # pearson r over the samples observed in both genes of each pair (pairwise-complete). Per-pair n, sums and
+  # sums of squares all come from matrix products with the observed-value masks. Returns the r matrix and
+  # the matrix of per-pair sample counts
+  # """
+  
+  import numpy as np
+  
+  if not (np.isnan(x).any() or np.isnan(y).any()):
+    return(pearsonCorrMatrix(x, y), np.full((x.shape[1], y.shape[1]), float(x.shape[0])))
+  
+  mx = (~np.isnan(x)).astype(np.float64)
+  my = (~np.isnan(y)).astype(np.float64)
+  
+  # centring on the column means first keeps the sums of squares well conditioned
+  with np.errstate(invalid='ignore'):
+    x0 = np.nan_to_num(x - np.nanmean(x, axis=0))
+    y0 = np.nan_to_num(y - np.nanmean(y, axis=0))
+  
+  n = mx.T @ my
+  sx = x0.T @ my
+  sy = mx.T @ y0
+  sxx = (x0 * x0).T @ my
+  syy = mx.T @ (y0 * y0)
+  sxy = x0.T @ y0
+  
+  with np.errstate(divide='ignore', invalid='ignore'):
+    cov = sxy - sx * sy / n
+    var_x = sxx - sx * sx / n
+    var_y = syy - sy * sy / n
+    r = cov / np.sqrt(var_x * var_y)
+  
+  # zero-variance pairs are undefined rather than noise
+  r[(var_x <= 0) | (var_y <= 0)] = np.nan
+  np.clip(r, -1, 1, out=r)
+  
+  return(r, n)
+
+
+def rankCols(a):
+  
+  # """
+  # a: 2d array, rows=samples, cols=genes
+  # ranks every column once, ties get their average rank (as stats.rankdata) and NaNs stay NaN
+  # """
+  
+  import pandas as pd
+  
+  return(pd.DataFrame(a).rank(axis=0, method='average').values)
+
+
+def maskedColPearson(a, b, mask):
+  
+  # """
+  # a, b, mask: 2d arrays of the same shape, rows=samples
+  # pearson r between matching columns of a and b, using only the rows where mask is True
+  # """
+  
+  import numpy as np
+  
+  m = mask.astype(np.float64)
+  n = m.sum(axis=0)
+  a = np.where(mask, a, 0)
+  b = np.where(mask, b, 0)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    da = (a - a.sum(axis=0) / n) * m
+    db = (b - b.sum(axis=0) / n) * m
+    r = (da * db).sum(axis=0) / np.sqrt((da * da).sum(axis=0) * (db * db).sum(axis=0))
+  
+  return(np.clip(r, -1, 1))
+
+
+def pairwiseSpearman(x, y):
+  
+  # """
+  # x: 2d array, rows=samples, cols=genes - becomes the rows of the corr matrix
+  # y: 2d array, rows=samples, cols=genes - becomes the cols of the corr matrix
+  # spearman r over the samples observed in both genes of each pair, matching stats.spearmanr on NaN-filtered
+  # pairs. Returns the r matrix and the matrix of per-pair sample counts
+  # """
+  
+  import numpy as np
+  
+  obs_y = ~np.isnan(y)
+  r = np.full((x.shape[1], y.shape[1]), np.nan)
+  n_obs = np.zeros((x.shape[1], y.shape[1]))
+  
+  # y only needs re-ranking for x genes with NaNs
+  y_ranks = rankCols(y)
+  
+  for i in range(x.shape[1]):
+    
+    keep = ~np.isnan(x[:, i])
+    x_kept = x[keep, i]
+    sub_obs = obs_y[keep]
+    if keep.all():
+      sub_ranks = y_ranks
+    else:
+      sub_ranks = rankCols(y[keep])
+    
+    # genes with no NaNs among the kept samples share one set of x ranks
+    complete = sub_obs.all(axis=0)
+    x_ranks = rankCols(x_kept[:, None])
+    r[i, complete] = pearsonCorrMatrix(x_ranks, sub_ranks[:, complete])[0]
+    n_obs[i, complete] = keep.sum()
+    
+    # the rest need x re-ranked within each gene's observed samples - counting the smaller and
+    # equal x values that each gene observes gives those average ranks for all genes at once
+    cols = np.where(~complete)[0]
+    if len(cols) > 0:
+      m = sub_obs[:, cols]
+      lt = (x_kept[:, None] > x_kept[None, :]).astype(np.float64)
+      eq = (x_kept[:, None] == x_kept[None, :]).astype(np.float64)
+      x_sub_ranks = lt @ m + (eq @ m + 1) / 2
+      r[i, cols] = maskedColPearson(x_sub_ranks, sub_ranks[:, cols], m)
+      n_obs[i, cols] = m.sum(axis=0)
+  
+  return(r, n_obs)
+
+
+def corrPvals(r, n, float32=False):
+  
+  # """
+  # r: array of correlation coefficients
+  # n: number of samples each r was computed from - a single count or an array of per-pair counts
+  # float32: compute and return single precision p-values, halves memory on all_corrs-sized matrices
+  # returns two-sided p-values from the t-distribution with n-2 degrees of freedom, as stats.pearsonr and
+  # stats.spearmanr do, in a single vectorised call. |r| = 1 gives p = 0, and pairs with n < 3 have no
+  # degrees of freedom so get NaN
+  # """
+  
+  import numpy as np
+  from scipy import special
+  
+  dtype = np.float32 if float32 else np.float64
+  r = np.asarray(r, dtype=dtype)
+  dof = np.broadcast_to(np.asarray(n, dtype=dtype) - 2, r.shape)
+  
+  valid = (dof > 0) & np.isfinite(r)
+  perfect = valid & (np.abs(r) >= 1)
+  usable = valid & ~perfect
+  
+  # t = r * sqrt(dof / (1 - r^2)), only where it is finite
+  t = np.zeros(r.shape, dtype=dtype)
+  t[usable] = np.abs(r[usable]) * np.sqrt(dof[usable] / (1 - r[usable] * r[usable]))
+  
+  p = np.full(r.shape, np.nan, dtype=dtype)
+  p[usable] = 2 * special.stdtr(dof[usable], -t[usable])
+  p[perfect] = 0
+  
+  return(p)
+
+
+def sharedCorrBlock(corr_fn, ins, outs, j0, j1):
+  
+  # """
+  # computes one col block of the corr and sample count matrices from memory-mapped x and y, writing it
+  # straight into the mapped outputs. Run by runSharedBlocks
+  # """
+  
+  outs["r"][:, j0:j1], outs["n"][:, j0:j1] = corr_fn(ins["x"], ins["y"][:, j0:j1])
+
+
+def blockCorrs(corr_fn, x, y, n_threads=1, shared_dir=None):
+  
+  # """
+  # corr_fn: pairwisePearson or pairwiseSpearman
+  # x: 2d array, rows=samples, cols=genes - becomes the rows of the corr matrix
+  # y: 2d array, rows=samples, cols=genes - becomes the cols of the corr matrix
+  # n_threads: number of threads, y is split into one col block per thread
+  # shared_dir: directory for memory-mapped copies of x, y and the outputs, i.e. /dev/shm. With it, blocks run in
+  # n_threads worker processes that attach to the mapped matrices and write their own slices of the outputs,
+  # instead of threads. Default None uses threads
+  # returns the r and sample count matrices, as corr_fn(x, y)
+  # """
+  
+  import os
+  import shutil
+  import tempfile
+  import functools
+  import numpy as np
+  from coreBudget import runTasks, colBlocks, sharedArray, runSharedBlocks
+  
+  if shared_dir == None or n_threads == 1:
+    blocks = runTasks(lambda j0, j1: corr_fn(x, y[:, j0:j1]), colBlocks(y.shape[1], n_threads), n_threads)
+    return(np.hstack([b[0] for b in blocks]), np.hstack([b[1] for b in blocks]))
+  
+  # x and y are written once, every worker maps the same pages
+  tmp = tempfile.mkdtemp(dir=shared_dir)
+  try:
+    inputs = {"x": os.path.join(tmp, "x.npy"), "y": os.path.join(tmp, "y.npy")}
+    sharedArray(np.asarray(x, dtype=np.float64), inputs["x"])
+    sharedArray(np.asarray(y, dtype=np.float64), inputs["y"])
+    outputs = {"r": os.path.join(tmp, "r.npy"), "n": os.path.join(tmp, "n.npy")}
+    for k in outputs:
+      np.lib.format.open_memmap(outputs[k], mode='w+', dtype=np.float64, shape=(x.shape[1], y.shape[1]))
+    
+    runSharedBlocks(functools.partial(sharedCorrBlock, corr_fn), inputs, outputs, colBlocks(y.shape[1], n_threads), n_threads)
+    
+    r = np.load(outputs["r"])
+    n_obs = np.load(outputs["n"])
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+  
+  return(r, n_obs)
+
+
+def tiledCorrs(a, genes, out_prefix, method="pearson", tile_size=2000, float32=False, n_threads=1):
+  
+  # """
+  # a: 2d array, rows=samples, cols=genes
+  # genes: gene labels for the cols of a
+  # out_prefix: path prefix for the output files
+  # method: correlation method - spearman or pearson
+  # tile_size: number of genes per tile, peak memory scales with tile_size^2 rather than the number of genes
+  # float32: store single precision matrices
+  # n_threads: number of tiles computed at once, peak memory is n_threads tiles
+  # computes the full gene x gene corr, pval and nobs matrices one tile at a time, only for tiles on or
+  # above the diagonal, and streams each tile and its mirror into memory-mapped .npy files
+  # (out_prefix + _corrs.npy, _pvals.npy, _nobs.npy), each with the matrixIO .labels.json sidecar of its gene labels.
+  # Load with readMatrix(path, mmap=True) or np.load(path, mmap_mode='r')
+  # """
+  
+  import numpy as np
+  import pandas as pd
+  
+  from coreBudget import runTasks
+  from matrixIO import writeLabels
+  from pipelineLog import stageLogger, Progress
+  
+  log = stageLogger("genCorrs")
+  dtype = np.float32 if float32 else np.float64
+  n_genes = a.shape[1]
+  has_nan = np.isnan(a).any()
+  
+  # without NaNs, spearman is pearson on ranks computed once for the whole matrix
+  if method == "spearman" and not has_nan:
+    a = rankCols(a)
+  
+  stores = {}
+  for k in ["corrs", "pvals", "nobs"]:
+    stores[k] = np.lib.format.open_memmap(out_prefix + "_" + k + ".npy", mode='w+', dtype=dtype, shape=(n_genes, n_genes))
+  
+  def doTile(i0, j0):
+    i1 = min(i0 + tile_size, n_genes)
+    j1 = min(j0 + tile_size, n_genes)
+    
+    if method == "spearman" and has_nan:
+      r, n_obs = pairwiseSpearman(a[:, i0:i1], a[:, j0:j1])
+    else:
+      r, n_obs = pairwisePearson(a[:, i0:i1], a[:, j0:j1])
+    
+    # tiles are disjoint, so threads can write them without locking
+    tiles = {"corrs": r, "pvals": corrPvals(r, n_obs, float32=float32), "nobs": n_obs}
+    for k in stores:
+      stores[k][i0:i1, j0:j1] = tiles[k]
+      # the matrix is symmetric, so the lower triangle is the mirror of the upper
+      if j0 != i0:
+        stores[k][j0:j1, i0:i1] = tiles[k].T
+    
+    progress.update()
+  
+  tasks = [(i0, j0) for i0 in range(0, n_genes, tile_size) for j0 in range(i0, n_genes, tile_size)]
+  progress = Progress(log, len(tasks), "tiles of {} genes".format(n_genes))
+  runTasks(doTile, tasks, n_threads)
+  progress.done()
+  
+  for k in stores:
+    stores[k].flush()
+    writeLabels(out_prefix + "_" + k + ".npy", pd.Index(genes).tolist(), pd.Index(genes).tolist())
+
+
+def mergeTopK(best, pos, tile, partners, keep, k):
+  
+  # """
+  # best: dict of (genes x k) arrays - score (|r|, -inf for empty slots), partner, corr, pval, nobs
+  # pos: row positions in best that the tile rows belong to
+  # tile: dict of corr, pval and nobs tiles
+  # partners: gene index of each tile col
+  # keep: tile mask of pairs passing the thresholds
+  # k: number of partners to keep per gene
+  # keeps the k strongest partners per gene across the running best and the new tile, in place
+  # """
+  
+  import numpy as np
+  
+  score = np.hstack([best["score"][pos], np.where(keep, np.abs(tile["corr"]), -np.inf)])
+  top = np.argpartition(-score, k - 1, axis=1)[:, :k]
+  
+  best["score"][pos] = np.take_along_axis(score, top, axis=1)
+  new_partners = np.broadcast_to(partners, keep.shape)
+  best["partner"][pos] = np.take_along_axis(np.hstack([best["partner"][pos], new_partners]), top, axis=1)
+  for key in ["corr", "pval", "nobs"]:
+    best[key][pos] = np.take_along_axis(np.hstack([best[key][pos], tile[key]]), top, axis=1)
+
+
+def tiledEdges(a, genes, out_path, rows=None, method="pearson", tile_size=2000, min_abs_r=None, max_p=None, top_k=None):
+  
+  # """
+  # a: 2d array, rows=samples, cols=genes
+  # genes: gene labels for the cols of a
+  # out_path: path of the long-form edge list .csv
+  # rows: col indices of the genes to correlate against every gene, i.e. the mt genes. Default None correlates
+  # all gene pairs, computing only tiles on or above the diagonal
+  # method: correlation method - spearman or pearson
+  # tile_size: number of genes per tile
+  # min_abs_r: keep pairs with |r| >= min_abs_r
+  # max_p: keep pairs with p <= max_p
+  # top_k: of the pairs passing the thresholds, keep the top_k partners with highest |r| per gene
+  # self pairs are dropped and each pair is written once, pairs of two row genes included. Pairs are selected tile by
+  # tile, so neither the full corr matrix nor the dropped pairs are ever held in memory. Without top_k each tile's edges
+  # are appended to out_path as they are found
+  # """
+  
+  import numpy as np
+  import pandas as pd
+  
+  genes = np.asarray(genes)
+  n_genes = a.shape[1]
+  has_nan = np.isnan(a).any()
+  symmetric = rows is None
+  row_idx = np.arange(n_genes) if symmetric else np.asarray(rows)
+  is_row = np.zeros(n_genes, dtype=bool)
+  is_row[row_idx] = True
+  
+  # without NaNs, spearman is pearson on ranks computed once for the whole matrix
+  if method == "spearman" and not has_nan:
+    a = rankCols(a)
+  
+  if top_k != None:
+    best = {"score": np.full((len(row_idx), top_k), -np.inf), "partner": np.zeros((len(row_idx), top_k), dtype=np.int64)}
+    for key in ["corr", "pval", "nobs"]:
+      best[key] = np.full((len(row_idx), top_k), np.nan)
+  
+  out_cols = ["gene_1", "gene_2", "corr", "pval", "nobs"]
+  pd.DataFrame(columns=out_cols).to_csv(out_path, index=False, header=True)
+  
+  for i0 in range(0, len(row_idx), tile_size):
+    i1 = min(i0 + tile_size, len(row_idx))
+    ri = row_idx[i0:i1]
+    for j0 in range(i0 if symmetric else 0, n_genes, tile_size):
+      j1 = min(j0 + tile_size, n_genes)
+      cj = np.arange(j0, j1)
+      
+      if method == "spearman" and has_nan:
+        r, n_obs = pairwiseSpearman(a[:, ri], a[:, cj])
+      else:
+        r, n_obs = pairwisePearson(a[:, ri], a[:, cj])
+      tile = {"corr": r, "pval": corrPvals(r, n_obs), "nobs": n_obs}
+      
+      # thresholds, applied to the tile before anything is kept
+      keep = np.isfinite(r) & (ri[:, None] != cj[None, :])
+      if min_abs_r != None:
+        keep &= np.abs(r) >= min_abs_r
+      if max_p != None:
+        keep &= tile["pval"] <= max_p
+      
+      if top_k != None:
+        mergeTopK(best, np.arange(i0, i1), tile, cj, keep, top_k)
+        # off-diagonal tiles also hold the partners of the col genes
+        if symmetric and j0 != i0:
+          mergeTopK(best, cj, {key: tile[key].T for key in tile}, ri, keep.T, top_k)
+      else:
+        # each pair once - the diagonal tiles hold both orientations
+        if symmetric and j0 == i0:
+          keep &= ri[:, None] < cj[None, :]
+        # pairs of two row genes are in both their rows - kept in the row of the first
+        if not symmetric:
+          keep &= ~is_row[cj][None, :] | (ri[:, None] < cj[None, :])
+        ii, jj = np.nonzero(keep)
+        edges = pd.DataFrame({"gene_1": genes[ri[ii]], "gene_2": genes[cj[jj]], "corr": r[ii, jj],
+        "pval": tile["pval"][ii, jj], "nobs": n_obs[ii, jj]})
+        edges.to_csv(out_path, mode='a', index=False, header=False)
+  
+  if top_k != None:
+    ii, kk = np.nonzero(np.isfinite(best["score"]))
+    edges = pd.DataFrame({"gene_1": genes[row_idx[ii]], "gene_2": genes[best["partner"][ii, kk]], "corr": best["corr"][ii, kk],
+    "pval": best["pval"][ii, kk], "nobs": best["nobs"][ii, kk]})
+    # a pair in the top_k of both its genes (all pairs, or two row genes) is written once
+    first = np.minimum(row_idx[ii], best["partner"][ii, kk])
+    second = np.maximum(row_idx[ii], best["partner"][ii, kk])
+    edges = edges[~pd.DataFrame({"a": first, "b": second}).duplicated().values]
+    edges.to_csv(out_path, mode='a', index=False, header=False)
+
+
+def matrixCorrs(a, rows, method="pearson", n_threads=1, shared_dir=None):
+  
+  # """
+  # a: 2d array, rows=samples, cols=genes
+  # rows: col indices of the genes making up the rows of the corr matrix, i.e. the mt genes
+  # method: correlation method - spearman or pearson
+  # n_threads: number of threads, the gene cols are split into one block per thread
+  # shared_dir: run the blocks in worker processes attached to memory-mapped copies of the matrix, see blockCorrs
+  # returns the rows x genes corr, pval and sample count matrices, pairwise-complete over NaNs
+  # """
+  
+  import numpy as np
+  
+  a = np.asarray(a, dtype=np.float64)
+  
+  if method == "spearman" and np.isnan(a).any():
+    # re-ranks within the samples each pair has in common
+    r, n_obs = blockCorrs(pairwiseSpearman, a[:, rows], a, n_threads, shared_dir)
+  else:
+    # rank every gene once, then spearman r is pearson r on the ranks
+    if method == "spearman":
+      a = rankCols(a)
+    r, n_obs = blockCorrs(pairwisePearson, a[:, rows], a, n_threads, shared_dir)
+  
+  return(r, corrPvals(r, n_obs), n_obs)
+
+
+def genCorrs(file_dir="", pattern=".csv", outdir=None, outlabel="", method="pearson", random_shuffle_cols=False, all_corrs=False, engine="matrix", tile_size=None, float32=False,
+             edges=False, min_abs_r=None, max_p=None, top_k=None, n_cores=None, out_format="csv", shared_dir=None, incremental=False,
+             report_dir=None, profile=False):
   
   # """
   # file_dir: directory containing the rpkms
@@ -19,6 +481,24 @@ def genCorrs(file_dir="", pattern=".csv", outdir=None, outlabel="", method="pear
   # analyses, normally should remain False
   # all_corrs: performs pairwise correlations between all gene pairs as opposed to all gene pairs * 13 mt genes. Takes considerably longer. 
   # Not useful for generation of a simple nuc-mt correlation matrix. 
+  # engine: matrix - builds the whole corr block from one matrix multiply on the standardised expression matrix
+  # (on column ranks for spearman), using only the samples observed in both genes of each pair, and also writes the
+  # per-pair sample counts to _nobs.csv. loop - correlates gene pairs one at a time
+  # tile_size: with all_corrs only - compute the gene x gene matrices in tiles of this many genes and write them to
+  # memory-mapped _corrs.npy, _pvals.npy and _nobs.npy files with matrixIO label sidecars instead of csv. Default None keeps csv output
+  # float32: store the tiled .npy matrices in single precision
+  # edges: instead of matrices, write a long-form _edges.csv (gene_1, gene_2, corr, pval, nobs) of the pairs passing
+  # min_abs_r (|r| >= min_abs_r), max_p (p <= max_p) and top_k (the top_k partners per gene by |r|), selected while the
+  # tiles are computed. Uses tile_size, default 2000 genes
+  # n_cores: total cores shared by all files and the gene blocks within them, default is all cores on the machine
+  # out_format: output file suffix of the corr, pval and nobs matrices - csv, parquet, feather or npy. Input format is
+  # taken from the file suffix (see matrixIO), .npy inputs are memory-mapped rather than read
+  # shared_dir: matrix engine only - directory for memory-mapped copies of each file's matrix, i.e. /dev/shm. With it the
+  # gene blocks of a file run in worker processes attached zero-copy to the mapped matrix rather than in threads
+  # incremental: skip files whose input, parameters and code are unchanged since the last run, keeping their outputs
+  # (see stageCache). Never skips with random_shuffle_cols
+  # report_dir: record each file's time, memory, bytes and gene pairs a second in a run report in this directory (see runReport)
+  # profile: with report_dir, also keep a cProfile of each file
   # """
 
   # import libs
@@ -26,117 +506,174 @@ def genCorrs(file_dir="", pattern=".csv", outdir=None, outlabel="", method="pear
   import numpy as np
   import pandas as pd
   from scipy import stats
-  import re
-  import multiprocessing
-  from joblib import Parallel, delayed
+  from coreBudget import runFiles
+  from matrixIO import matrixFiles, matrixPaths, readMatrix, writeMatrix
+  from stageCache import stageManifest, saveManifest
+  from runReport import newRunId, stageReport, writeRunReport
+  from pipelineLog import stageLogger, Progress
+
+  log = stageLogger("genCorrs")
+  run = newRunId()
 
   if outdir == None:
     outdir = file_dir
+  outdir = os.path.abspath(outdir)
 
   # get all file paths
-  file_paths = [file for file in os.listdir(file_dir) if pattern in file]
-  print(file_paths)
-  
-  # define num of cores, here it's one core per file
-  num_cores = len(file_paths)
-  
-  # defining mito genes - allows generation of a nuc x mito corr matrix
-  mito_genes = ['ENSG00000198888','ENSG00000198763','ENSG00000198840','ENSG00000198886',
-  'ENSG00000212907','ENSG00000198786','ENSG00000198695','ENSG00000198899',
-  'ENSG00000228253','ENSG00000198804','ENSG00000198712','ENSG00000198938',
-  'ENSG00000198727']
+  file_paths = matrixFiles(file_dir, pattern)
+  log.info("files: %s", file_paths)
 
-  def dofilesInParallel(__file__):
+  def outPaths(fn):
+    
+    # every file written for one input file, depends on the output mode
+    prefix = os.path.join(outdir, fn + "_" + outlabel + "_" + method)
+    if edges == True:
+      return([prefix + "_edges.csv"])
+    if all_corrs == True and tile_size != None:
+      return(matrixPaths(prefix + "_corrs.npy") + matrixPaths(prefix + "_pvals.npy") + matrixPaths(prefix + "_nobs.npy"))
+    out_paths = matrixPaths(prefix + "_corrs." + out_format) + matrixPaths(prefix + "_pvals." + out_format)
+    if engine == "matrix":
+      out_paths = out_paths + matrixPaths(prefix + "_nobs." + out_format)
+    return(out_paths)
+  
+  def dofilesInParallel(__file__, n_threads=1):
     
     fn = __file__.replace(pattern, '')
+    
+    if incremental == True and random_shuffle_cols == False:
+      params = {"pattern": pattern, "outlabel": outlabel, "method": method, "all_corrs": all_corrs, "engine": engine,
+                "tile_size": tile_size, "float32": float32, "edges": edges, "min_abs_r": min_abs_r, "max_p": max_p,
+                "top_k": top_k, "out_format": out_format}
+      up_to_date, manifest = stageManifest(outdir, "genCorrs", __file__, [file_dir+__file__], params,
+                                           ["genCorrs", "coreBudget", "matrixIO"], outPaths(fn))
+      if up_to_date:
+        log.info("%s unchanged since the last run - keeping its outputs", fn)
+        return
+      corrFile(__file__, fn, n_threads)
+      saveManifest(outdir, "genCorrs", __file__, manifest)
+    else:
+      corrFile(__file__, fn, n_threads)
+  
+  def corrFile(__file__, fn, n_threads=1):
 
-    print(fn)
+    with stageReport(report_dir, "genCorrs", __file__, [file_dir+__file__], outPaths(fn), profile, run) as rec:
 
-    # import df
-    df = pd.read_csv(open(file_dir+__file__), sep=',', encoding="utf-8", engine='python', index_col=0, header=0) # genes cols, samples rows
+      log.info(fn)
+
+      # import df
+      df = readMatrix(file_dir+__file__, mmap=True) # genes cols, samples rows
   
-    if len(df.columns.values) < len(df.index): # 
-      df = df.T
+      if len(df.columns.values) < len(df.index): # 
+        df = df.T
+      
+      log.debug("%s\n%s", df.shape, df.head())
       
-    print(df.head())
+      ## if random shuffle ###
+      if random_shuffle_cols == True:
+        import random
+        cols = df.columns.tolist()
+        random.shuffle(cols)
+        df.columns = cols
+      ########################
       
-    ## if random shuffle ###
-    if random_shuffle_cols == True:
-      import random
-      cols = df.columns.tolist()
-      random.shuffle(cols)
-      df.columns = cols
-    ########################
+      df.columns = df.columns.str.replace("\\..*", "", regex=True)
+      df.index = df.index.str.replace("\\..*", "", regex=True)
+    
+      # choice about whether to generate all correlations possible, or to generate mt-nuc only. The latter is considerably quicker
+      if all_corrs == False:
+        corr_matrix_rows = mito_genes
+      elif all_corrs == True:
+        corr_matrix_rows = df.columns
       
-    df.columns = df.columns.str.replace("\\..*", "")
-    df.index = df.index.str.replace("\\..*", "")
-    
-    # choice about whether to generate all correlations possible, or to generate mt-nuc only. The latter is considerably quicker
-    if all_corrs == False:
-      corr_matrix_rows = mito_genes
-    elif all_corrs == True:
-      corr_matrix_rows = df.columns
-    
-    if method == "pearson":
-      # generate pairwise corrs
-      df_corr = pd.DataFrame() # Correlation matrix
-      df_p = pd.DataFrame()  # Matrix of p-values
-      counter=0
-      for x in corr_matrix_rows:
-        for y in df.columns:
-          print(counter)
+      rec["samples"], rec["genes"] = df.shape
+      rec["pairs"] = len(corr_matrix_rows) * df.shape[1]
+    
+      # sparse output - only the selected pairs of each tile are kept
+      if edges == True:
+        rows = None if all_corrs == True else [df.columns.get_loc(g) for g in mito_genes]
+        tiledEdges(df.values, df.columns, os.path.join(outdir, fn + "_" + outlabel + "_" + method + "_edges.csv"), rows=rows, method=method,
+        tile_size=2000 if tile_size == None else tile_size, min_abs_r=min_abs_r, max_p=max_p, top_k=top_k)
+        return
+    
+      # out-of-core all_corrs - tiles go straight to disk rather than into DataFrames
+      if all_corrs == True and tile_size != None:
+        tiledCorrs(df.values, df.columns, os.path.join(outdir, fn + "_" + outlabel + "_" + method), method=method, tile_size=tile_size, float32=float32, n_threads=n_threads)
+        return
+    
+      # per-pair observed sample counts, only produced by the matrix engine
+      df_n = None
+    
+      if engine == "matrix":
+        # generate all pairwise-complete corrs in one go
+        r, p, n_obs = matrixCorrs(df.values, [df.columns.get_loc(g) for g in corr_matrix_rows], method=method, n_threads=n_threads, shared_dir=shared_dir)
+        df_corr = pd.DataFrame(r, index=corr_matrix_rows, columns=df.columns) # Correlation matrix
+        df_p = pd.DataFrame(p, index=corr_matrix_rows, columns=df.columns) # Matrix of p-values
+        df_n = pd.DataFrame(n_obs, index=corr_matrix_rows, columns=df.columns) # Matrix of sample counts
+    
+      elif method == "pearson":
+        # generate pairwise corrs
+        df_corr = pd.DataFrame() # Correlation matrix
+        df_p = pd.DataFrame()  # Matrix of p-values
+        progress = Progress(log, len(corr_matrix_rows) * len(df.columns), fn + " gene pairs")
+        for x in corr_matrix_rows:
+          for y in df.columns:
           
-          # get gene value lists
-          x_ls = df[x]
-          y_ls = df[y]
+            # get gene value lists
+            x_ls = df[x]
+            y_ls = df[y]
           
-          # list of indices where NaNs are in both
-          nan_in_both = sorted(list(set(list(np.where(np.isnan(x_ls))[0]) + list(np.where(np.isnan(y_ls))[0]))), reverse=True)
+            # list of indices where NaNs are in both
+            nan_in_both = sorted(list(set(list(np.where(np.isnan(x_ls))[0]) + list(np.where(np.isnan(y_ls))[0]))), reverse=True)
           
-          # remove these elements of both 
-          x_ls = [i for j, i in enumerate(x_ls) if j not in nan_in_both]
-          y_ls = [i for j, i in enumerate(y_ls) if j not in nan_in_both] 
+            # remove these elements of both 
+            x_ls = [i for j, i in enumerate(x_ls) if j not in nan_in_both]
+            y_ls = [i for j, i in enumerate(y_ls) if j not in nan_in_both] 
           
-          # perform corr on cleaned value lists
-          corr = stats.pearsonr(x_ls, y_ls) # calculate the spearman r of col x and col y
-          df_corr.loc[x,y] = corr[0] # assign corrs to df_corr
-          df_p.loc[x,y] = corr[1] # assign pvals to df_p
-          counter+=1
+            # perform corr on cleaned value lists
+            corr = stats.pearsonr(x_ls, y_ls) # calculate the spearman r of col x and col y
+            df_corr.loc[x,y] = corr[0] # assign corrs to df_corr
+            df_p.loc[x,y] = corr[1] # assign pvals to df_p
+            progress.update()
+        progress.done()
           
-    elif method == "spearman":
-      # generate pairwise corrs
-      df_corr = pd.DataFrame() # Correlation matrix
-      df_p = pd.DataFrame()  # Matrix of p-values
-      counter=0
-      for x in corr_matrix_rows:
-        for y in df.columns:
-          print(counter)
-
-          # get gene value lists
-          x_ls = df[x]
-          y_ls = df[y]
+      elif method == "spearman":
+        # generate pairwise corrs
+        df_corr = pd.DataFrame() # Correlation matrix
+        df_p = pd.DataFrame()  # Matrix of p-values
+        progress = Progress(log, len(corr_matrix_rows) * len(df.columns), fn + " gene pairs")
+        for x in corr_matrix_rows:
+          for y in df.columns:
+
+            # get gene value lists
+            x_ls = df[x]
+            y_ls = df[y]
           
-          # list of indices where NaNs are in both
-          nan_in_both = sorted(list(set(list(np.where(np.isnan(x_ls))[0]) + list(np.where(np.isnan(y_ls))[0]))), reverse=True)
+            # list of indices where NaNs are in both
+            nan_in_both = sorted(list(set(list(np.where(np.isnan(x_ls))[0]) + list(np.where(np.isnan(y_ls))[0]))), reverse=True)
           
-          # remove these elements of both 
-          x_ls = [i for j, i in enumerate(x_ls) if j not in nan_in_both]
-          y_ls = [i for j, i in enumerate(y_ls) if j not in nan_in_both] 
+            # remove these elements of both 
+            x_ls = [i for j, i in enumerate(x_ls) if j not in nan_in_both]
+            y_ls = [i for j, i in enumerate(y_ls) if j not in nan_in_both] 
           
-          # perform corr on cleaned value lists
-          corr = stats.spearmanr(x_ls, y_ls) # calculate the spearman r of col x and col y
-          df_corr.loc[x,y] = corr[0] # assign corrs to df_corr
-          df_p.loc[x,y] = corr[1] # assign pvals to df_p
-          counter+=1
+            # perform corr on cleaned value lists
+            corr = stats.spearmanr(x_ls, y_ls) # calculate the spearman r of col x and col y
+            df_corr.loc[x,y] = corr[0] # assign corrs to df_corr
+            df_p.loc[x,y] = corr[1] # assign pvals to df_p
+            progress.update()
+        progress.done()
     
-    print(df_corr.shape)
-    print(df_p.shape)
+      log.debug("corrs %s pvals %s", df_corr.shape, df_p.shape)
     
-    # write out
-    os.chdir(outdir)
-    df_corr.to_csv(fn + "_" + outlabel +"_" + method + "_corrs.csv", index=True, header=True)
-    df_p.to_csv(fn + "_" + outlabel +"_" + method + "_pvals.csv", index=True, header=True)
+      # write out
+      prefix = os.path.join(outdir, fn + "_" + outlabel +"_" + method)
+      writeMatrix(df_corr, prefix + "_corrs." + out_format)
+      writeMatrix(df_p, prefix + "_pvals." + out_format)
+      if df_n is not None:
+        writeMatrix(df_n, prefix + "_nobs." + out_format)
     
-  Parallel(n_jobs=num_cores)(delayed(dofilesInParallel)(__file__=i) for i in file_paths)
+  # files and the gene blocks within them share one core budget
+  runFiles(dofilesInParallel, file_paths, n_cores)
+  
+  writeRunReport(report_dir, run)
     
 
@@ -0,0 +1,150 @@
+#!/usr/bin python
+
+# function genPermutationNull
+# takes in a matrix of TPMs, rows=samples , cols=genes
+# shuffles the sample labels of the mt genes many times and correlates each shuffle against every gene,
+# with many permutations per matrix multiply
+# outputs empirical p-value and null quantile matrices
+
+
+def permutedCorrs(x, y, perms, standardised=False):
+
+  # """
+  # x: 2d array, rows=samples, cols=genes - the genes whose sample labels get shuffled, rows of the corr matrices
+  # y: 2d array, rows=samples, cols=genes - cols of the corr matrices
+  # perms: 2d int array, one row of shuffled sample indices per permutation
+  # standardised: x and y are NaN-free and already passed through standardiseCols, so they are not redone
+  # returns a perms x x.cols x y.cols array of permuted pearson correlations (pass ranks for spearman), all from
+  # one matrix multiply. With NaNs, each permutation uses the samples observed in both genes of a pair
+  # """
+
+  import numpy as np
+  from genCorrs import standardiseCols, pairwisePearson
+
+  n_perms, n_samps = perms.shape
+
+  if not standardised and (np.isnan(x).any() or np.isnan(y).any()):
+    # masks move with the shuffled values, so the masked products are redone per permutation
+    x_perm = x[perms].transpose(1, 0, 2).reshape(n_samps, -1)
+    r = pairwisePearson(x_perm, y)[0]
+  else:
+    # shuffling the rows of a standardised matrix leaves it standardised, so every
+    # permutation is just a row gather
+    if not standardised:
+      x = standardiseCols(x)
+      y = standardiseCols(y)
+    x_perm = x[perms].transpose(1, 0, 2).reshape(n_samps, -1)
+    r = np.clip(x_perm.T @ y, -1, 1)
+
+  return(r.reshape(n_perms, x.shape[1], y.shape[1]))
+
+
+def genPermutationNull(file_dir="", pattern=".csv", outdir=None, outlabel="", method="pearson", n_perms=1000, seed=None,
+                       batch_size=50, gene_block_size=2000, quantiles=[0.025, 0.5, 0.975], n_cores=None, out_format="csv"):
+
+  # """
+  # file_dir: directory containing the rpkms
+  # pattern: pattern to search for, default is all .csv files
+  # outdir: where should the files go, default is file_dir
+  # outlabel: add label to output files
+  # method: correlation method - spearman or pearson
+  # n_perms: number of sample label permutations
+  # seed: random seed, the same seed gives the same permutations and so the same outputs
+  # batch_size: number of permutations correlated per matrix multiply
+  # gene_block_size: number of nuclear genes whose null distributions are held in memory at once
+  # quantiles: null distribution quantiles to write out per gene pair
+  # n_cores: total cores shared by all files and the permutation batches within them, default is all cores on the machine
+  # out_format: output file suffix - csv, parquet, feather or npy. Input format is taken from the file suffix (see matrixIO)
+  # outputs _perm_pvals.csv - two-sided empirical p-values, (1 + #|null r| >= |observed r|) / (1 + n_perms) - the
+  # observed r they were tested against in _perm_observed.csv, and one _null_q<quantile>.csv per quantile, all mt genes
+  # x genes. The observed and permuted corrs are the same statistic - with NaNs, spearman ranks each gene over its own
+  # observed samples before the pairwise-complete pearson, so its observed r can differ slightly from genCorrs' r, which
+  # re-ranks each pair over the samples observed in both genes
+  # """
+
+  # import libs
+  import os
+  import numpy as np
+  import pandas as pd
+  from genCorrs import mito_genes, standardiseCols, rankCols
+  from coreBudget import runFiles, runTasks
+  from matrixIO import matrixFiles, readMatrix, writeMatrix
+  from pipelineLog import stageLogger, Progress
+
+  log = stageLogger("genPermutationNull")
+
+  if outdir == None:
+    outdir = file_dir
+  outdir = os.path.abspath(outdir)
+
+  # get all file paths
+  file_paths = matrixFiles(file_dir, pattern)
+  log.info("files: %s", file_paths)
+
+  def dofilesInParallel(__file__, n_threads=1):
+
+    fn = __file__.replace(pattern, '')
+
+    log.info(fn)
+
+    # import df
+    df = readMatrix(file_dir+__file__) # genes cols, samples rows
+
+    if len(df.columns.values) < len(df.index):
+      df = df.T
+
+    df.columns = df.columns.str.replace("\\..*", "", regex=True)
+    df.index = df.index.str.replace("\\..*", "", regex=True)
+
+    x = df[mito_genes].values
+    y = df.values
+
+    # rank and standardise once, every permutation batch reuses them
+    if method == "spearman":
+      x = rankCols(x)
+      y = rankCols(y)
+    standardised = not np.isnan(y).any()
+    if standardised:
+      x = standardiseCols(x)
+      y = standardiseCols(y)
+
+    # the same permutations are used for every gene block
+    rng = np.random.default_rng(seed)
+    perms = np.array([rng.permutation(len(df.index)) for i in range(n_perms)])
+    identity = np.arange(len(df.index))[None, :]
+
+    emp_p = np.zeros((len(mito_genes), y.shape[1]))
+    obs_r = np.zeros((len(mito_genes), y.shape[1]))
+    null_q = np.zeros((len(quantiles), len(mito_genes), y.shape[1]))
+
+    progress = Progress(log, y.shape[1], fn + " permuted genes")
+    for j0 in range(0, y.shape[1], gene_block_size):
+      j1 = min(j0 + gene_block_size, y.shape[1])
+
+      # observed corrs use the same kernel as the null
+      observed = permutedCorrs(x, y[:, j0:j1], identity, standardised=standardised)[0]
+      obs_r[:, j0:j1] = observed
+
+      null = np.empty((n_perms, len(mito_genes), j1 - j0), dtype=np.float32)
+
+      def doBatch(b0, b1):
+        null[b0:b1] = permutedCorrs(x, y[:, j0:j1], perms[b0:b1], standardised=standardised)
+
+      runTasks(doBatch, [(b0, min(b0 + batch_size, n_perms)) for b0 in range(0, n_perms, batch_size)], n_threads)
+
+      # small tolerance so that ties with the observed r are counted after float32 storage
+      exceed = (np.abs(null) >= np.abs(observed) - 1e-6).sum(axis=0)
+      emp_p[:, j0:j1] = np.where(np.isnan(observed), np.nan, (1 + exceed) / (1 + n_perms))
+      null_q[:, :, j0:j1] = np.nanquantile(null, quantiles, axis=0)
+
+      progress.update(j1 - j0)
+    progress.done()
+
+    # write out
+    writeMatrix(pd.DataFrame(emp_p, index=mito_genes, columns=df.columns), os.path.join(outdir, fn + "_" + outlabel + "_" + method + "_perm_pvals." + out_format))
+    writeMatrix(pd.DataFrame(obs_r, index=mito_genes, columns=df.columns), os.path.join(outdir, fn + "_" + outlabel + "_" + method + "_perm_observed." + out_format))
+    for q in range(0, len(quantiles)):
+      writeMatrix(pd.DataFrame(null_q[q], index=mito_genes, columns=df.columns), os.path.join(outdir, fn + "_" + outlabel + "_" + method + "_null_q" + str(quantiles[q]) + "." + out_format))
+
+  # files and the permutation batches within them share one core budget
+  runFiles(dofilesInParallel, file_paths, n_cores)
@@ -0,0 +1,68 @@
+# function loadGtexMeta
+# parses the GTEx sample attributes and phenotype files once with the C parser and vectorised string ops
+# and caches the parsed tables in a binary file keyed on the checksums of the source files,
+# so later runs load the cache instead of reparsing
+
+
+def gtexShortIds(long_ids, pattern=r"(GTEX-\w+)-.+"):
+
+  # """
+  # long_ids: GTEx sample ids, i.e. GTEX-1117F-0226-SM-5GZZ7
+  # pattern: regex with the donor id as group 1
+  # returns the donor (short) ids, ids that don't match are returned unchanged
+  # """
+
+  import pandas as pd
+
+  return(pd.Series(long_ids, dtype=object).str.replace(pattern, r"\g<1>", regex=True).values)
+
+
+def loadGtexMeta(meta_path, pheno_path, cache_dir=None):
+
+  # """
+  # meta_path: path to metadata file, downloadable from GTEx i.e. GTEx_Data_V6_Annotations_SampleAttributesDS.txt
+  # pheno_path: path to phenotype file, downloadable from GTEx, gives age, sex, COD associated with patient samples
+  # cache_dir: directory to keep the parsed cache in, default None parses every time
+  # returns meta (short_id, long_id, then the sample attribute cols) and pheno (short_id, then the phenotype cols)
+  # """
+
+  import os
+  import pickle
+  import pandas as pd
+  from stageCache import fileChecksum
+  from pipelineLog import stageLogger
+
+  log = stageLogger("gtexMetadata")
+
+  cache_path = None
+  if cache_dir != None:
+    key = fileChecksum(meta_path)[:16] + "_" + fileChecksum(pheno_path)[:16]
+    cache_path = os.path.join(cache_dir, "gtex_meta_" + key + ".pkl")
+    if os.path.exists(cache_path):
+      log.info("loading parsed GTEx metadata from %s", cache_path)
+      with open(cache_path, "rb") as f:
+        return(pickle.load(f))
+
+  # prepping metadata file --------------------------------------------------------------------------------
+
+  meta = pd.read_csv(meta_path, encoding="utf-8", sep="\t", index_col=0, header=0, low_memory=False)
+
+  # index to col
+  meta.index.name = 'long_id'
+  meta.reset_index(inplace=True)
+
+  # adding short ids
+  meta.insert(0, 'short_id', gtexShortIds(meta['long_id'], r"(GTEX-\w+)-\w+-\w+-.+"))
+
+  # prepping pheno file --------------------------------------------------------------------------------
+
+  pheno = pd.read_csv(pheno_path, encoding="utf-8", sep="\t", index_col=0, header=0, low_memory=False)
+
+  pheno.index.name = 'short_id'
+  pheno.reset_index(inplace=True)
+
+  if cache_path != None:
+    with open(cache_path, "wb") as f:
+      pickle.dump((meta, pheno), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+  return(meta, pheno)
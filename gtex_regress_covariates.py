@@ -1,5 +1,72 @@
+# sample attribute cols kept from the GTEx metadata
+gtex_meta_cols = ["short_id", "long_id", "SMRIN", "SMNABTCHT", "SMNABTCH", "SMGEBTCH", "SMGEBTCHD", "SMCENTER"]
+# was previously just "SMCENTER" - changed 24/04/20
 
-def gtex_regress_covariates(tpm_dir, pattern, meta_path, pheno_path, out_dir=None, outlabel=""):
+
+def gtexDesign(long_ids, meta, pheno, cache_dir=None, sources=()):
+
+    """
+    :param long_ids: GTEx sample ids (long ids) of the samples in the expression matrix
+    :param meta: parsed sample attributes from loadGtexMeta
+    :param pheno: parsed phenotypes from loadGtexMeta
+    :param cache_dir: optional directory to persist the design in, see cachedDesign
+    :param sources: metadata and phenotype files meta and pheno were parsed from - their checksums are part of the design key
+    :return: design key and design dict from cachedDesign - index holds the short ids in the row order of the encoded covs
+    """
+
+    import pandas as pd
+    from sklearn import preprocessing
+    from batchedOLS import designKey, cachedDesign
+
+    # extracting variables from meta table
+    meta = meta[gtex_meta_cols]
+
+    def buildDesign():
+
+        """
+        merges and encodes the covariates for the samples in this tpm file
+        returns the sample order and the encoded covariates
+        """
+
+        # joining meta and pheno by short_id
+        covs = pd.merge(meta, pheno, on="short_id")
+
+        # getting covs for ids present in tpm file
+        covs = covs[covs['long_id'].isin(long_ids)]
+
+        # set index cols for covs
+        covs = covs.set_index('short_id')
+
+        # encoding covariates  --------------------------------------------------------------------------------
+
+        # separating the numeric and textual covs - by dtype kind, so pandas string cols count as textual too
+        covs_with_labels = covs.select_dtypes(exclude="number")
+        covs_with_nums = covs.select_dtypes(include="number")
+
+        encoder = preprocessing.LabelEncoder()
+
+        # fit the transformer - the codes go into new int cols, as string cols do not take ints in place
+        covs_with_labels = pd.DataFrame({c: encoder.fit_transform(covs_with_labels[c]) for c in covs_with_labels.columns},
+                                        index=covs_with_labels.index)
+
+        encoded_covs = pd.merge(covs_with_nums, covs_with_labels, on="short_id")
+
+        # fill encoded covs with mean for tissues without data for these - doesn't do any filling for brain, but does 
+        # limited filling for other GTEx tissues i.e. wholeblood
+        # fills with most common value for the variable in question - should make very little difference to the correction 
+        encoded_covs = encoded_covs.fillna(encoded_covs.mean())
+
+        return(covs.index, encoded_covs)
+
+    design_key = designKey(sorted(long_ids), meta.columns.tolist() + pheno.columns.tolist(), sources)
+
+    return(design_key, cachedDesign(design_key, buildDesign, cache_dir))
+
+
+
+def gtex_regress_covariates(tpm_dir, pattern, meta_path, pheno_path, out_dir=None, outlabel="", cache_dir=None,
+                            diagnostics=True, n_cores=None, diagnostic_genes=None, out_format="csv", incremental=False,
+                            report_dir=None, profile=False):
 
     """
     :param tpm_dir: directory containing the TPM files - genes are cols, samples are rows
@@ -8,6 +75,17 @@ def gtex_regress_covariates(tpm_dir, pattern, meta_path, pheno_path, out_dir=Non
     :param pheno_path: path to phenotype file, downloadable from GTEx, gives age, sex, COD associated with patient samples
     :param out_dir: directory to save residual files into
     :param outlabel: optional label to add to output files
+    :param cache_dir: optional directory to persist encoded covariates and their factorisations in, keyed by sample set and
+    covariate list - later runs over the same samples skip covariate setup. They are always cached in memory for this session.
+    Parsed metadata and pheno files are also cached here, keyed on the source file checksums
+    :param diagnostics: test residual normality per gene after the regression and write a _residual_diagnostics.csv table
+    :param n_cores: number of worker processes for the diagnostics, default is all cores on the machine
+    :param diagnostic_genes: only test a random subsample of this many genes, default None tests all genes
+    :param out_format: output file suffix - csv, parquet, feather or npy. Input format is taken from the file suffix (see matrixIO)
+    :param incremental: skip files whose input, metadata, parameters and code are unchanged since the last run, keeping their
+    outputs (see stageCache)
+    :param report_dir: record each file's time, memory, bytes and genes a second in a run report in this directory (see runReport)
+    :param profile: with report_dir, also keep a cProfile of each file
     :return: residuals df
     
     Corrects for the following hardcoded covs: RIN, SMNABTCHT, SMNABTCH, SMGEBTCH, SMGEBTCHD, SMCENTER, AGE, GENDER, DTHHRDY
@@ -20,47 +98,32 @@ def gtex_regress_covariates(tpm_dir, pattern, meta_path, pheno_path, out_dir=Non
     # import libs
     import pandas as pd
     import re
-    import numpy as np
-    from sklearn import preprocessing
-    from sklearn.linear_model import LinearRegression
-    from scipy.stats import shapiro
     import os
-    #from tqdm import tqdm, tqdm_notebook
-
-    # prepping metadata file --------------------------------------------------------------------------------
-
-    # importing metadata file
-    meta = pd.read_csv(open(meta_path),encoding="utf-8",sep="\t",engine='python',index_col=0,header=0)
+    from batchedOLS import batchedResiduals, saveDesign
+    from residualDiagnostics import residualNormality
+    from gtexMetadata import loadGtexMeta, gtexShortIds
+    from matrixIO import matrixFiles, matrixPaths, readMatrix, writeMatrix
+    from stageCache import stageManifest, saveManifest
+    from runReport import newRunId, stageReport, writeRunReport
+    from pipelineLog import stageLogger
 
-    del meta.index.name
+    log = stageLogger("gtex_regress_covariates")
+    run = newRunId()
 
-    # index to col
-    meta.index.name = 'long_id'
-    meta.reset_index(inplace=True)
+    out_dir = os.path.abspath(out_dir)
 
-    # adding short ids
-    meta_ids = meta['long_id'].tolist()
-    for i in range(0, len(meta_ids)):
-        meta_ids[i] = re.sub(r"(GTEX-\w+)-\w+-\w+-.+", r"\g<1>", meta_ids[i])
+    # prepping metadata and pheno files --------------------------------------------------------------------------------
 
-    # adding short id
-    meta.insert(0, 'short_id', meta_ids)
-
-    # prepping pheno file --------------------------------------------------------------------------------
-
-    # importing phenotype data file
-    pheno = pd.read_csv(open(pheno_path), encoding="utf-8", sep="\t", engine='python', index_col=0, header=0)
-
-    pheno.index.name = 'short_id'
-    pheno.reset_index(inplace=True)
+    # parsed once and reused from cache_dir while the source files are unchanged
+    meta, pheno = loadGtexMeta(meta_path, pheno_path, cache_dir)
 
     # looping over TPM files --------------------------------------------------------------------------------
 
     # get full file paths and file names
-    file_paths = [tpm_dir + file for file in os.listdir(tpm_dir) if pattern in file]
-    file_names = [file for file in os.listdir(tpm_dir) if pattern in file]
+    file_names = matrixFiles(tpm_dir, pattern)
+    file_paths = [tpm_dir + file for file in file_names]
     
-    print(len(file_names))
+    log.info("%d files", len(file_names))
 
     for i in range(0, len(file_paths)):
 
@@ -68,150 +131,77 @@ def gtex_regress_covariates(tpm_dir, pattern, meta_path, pheno_path, out_dir=Non
 
         # get file name
         fn = re.sub("_.*", "", file_names[i])
-        print(i, fn)
+        log.info("%d %s", i, fn)
+
+        out_paths = matrixPaths(os.path.join(out_dir, fn + "_" + outlabel + "_residuals." + out_format))
+        if diagnostics == True:
+            out_paths = out_paths + matrixPaths(os.path.join(out_dir, fn + "_" + outlabel + "_residual_diagnostics." + out_format))
 
-        # importing tpm file
-        TPM = pd.read_csv(open(file_paths[i]),
-                          encoding="utf-8",
-                          engine='python',
-                          index_col=0,
-                          header=0)
+        if incremental == True:
+            up_to_date, manifest = stageManifest(out_dir, "gtex_regress_covariates", file_names[i], [file_paths[i], meta_path, pheno_path],
+                                                 {"pattern": pattern, "outlabel": outlabel, "covariates": gtex_meta_cols, "diagnostics": diagnostics,
+                                                  "diagnostic_genes": diagnostic_genes, "out_format": out_format},
+                                                 ["gtex_regress_covariates", "gtexMetadata", "batchedOLS", "residualDiagnostics", "matrixIO"], out_paths)
+            if up_to_date:
+                log.info("unchanged since the last run - keeping %s", out_paths[0])
+                continue
 
-        del TPM.index.name
+        with stageReport(report_dir, "gtex_regress_covariates", file_names[i], [file_paths[i]], out_paths, profile, run) as rec:
+
+            # importing tpm file
+            TPM = readMatrix(file_paths[i])
+
+            TPM.index.name = None
         
-        TPM.index = TPM.index.str.replace(r'\.', '-', regex=True)
+            TPM.index = TPM.index.str.replace(r'\.', '-', regex=True)
         
-        print(TPM.head(n=5))
+            log.debug("%s\n%s", TPM.shape, TPM.head(n=5))
         
-        # index to col
-        TPM.index.name = 'long_id'
-        TPM.reset_index(inplace=True)
+            # long ids to short ids - swapping the index once rather than adding id cols to the wide frame
+            long_ids = pd.Series(TPM.index, name='long_id')
+            TPM.index = pd.Index(gtexShortIds(long_ids), name='short_id')
 
-        # adding short ids
-        TPM_ids = TPM['long_id'].tolist()
-        for j in range(0, len(TPM_ids)):
-            TPM_ids[j] = re.sub(r"(GTEX-\w+)-.+", r"\g<1>", TPM_ids[j])
+            # cleaning covs --------------------------------------------------------------------------------
 
-        # adding short id
-        TPM.insert(0, 'short_id', TPM_ids)
+            # reuse the encoded covariates if this sample set has been seen before
+            design_key, design = gtexDesign(long_ids, meta, pheno, cache_dir, [meta_path, pheno_path])
+            encoded_covs = design["covs"]
 
-        # cleaning covs --------------------------------------------------------------------------------
+            # order tpm and cov tables the same
+            TPM = TPM.reindex(design["index"])
 
-        # extracting variables from meta table
-        meta = meta[["short_id", "long_id", "SMRIN", "SMNABTCHT", "SMNABTCH", "SMGEBTCH", "SMGEBTCHD", "SMCENTER"]]
-        # was previously just "SMCENTER" - changed 24/04/20
-        
-        # joining meta and pheno by short_id
-        covs = pd.merge(meta, pheno, on="short_id")
+            rec["samples"], rec["genes"] = TPM.shape
 
-        # getting covs for ids present in tpm file
-        covs = covs[covs['long_id'].isin(TPM['long_id'])]
+            # performing mlr across genes --------------------------------------------------------------------------------
 
-        # set index cols for covs
-        covs = covs.set_index('short_id')
+            # regressing covs out of all genes at once - genes with no NaNs share one least-squares solve,
+            # masked genes are solved in groups with the same NaN pattern, reusing cached factorisations
+            residual_df = pd.DataFrame(batchedResiduals(TPM.values, encoded_covs.values, factors=design["factors"]),
+                                       index=TPM.index,
+                                       columns=TPM.columns)
 
-        # set index cols for tpm table
-        TPM = TPM.set_index('short_id')
-        TPM = TPM.drop('long_id', axis='columns')
+            if cache_dir != None:
+                saveDesign(design_key, design, cache_dir)
 
-        # order tpm and cov tables the same
-        TPM = TPM.reindex(covs.index)
+            # export output --------------------------------------------------------------------------------
 
-        # encoding covariates  --------------------------------------------------------------------------------
-        
-        # separating the numeric and textual covs
-        covs_with_labels = covs.loc[:,covs.columns.isin(covs.columns[covs.dtypes == 'object'].tolist())]
-        covs_with_nums = covs.filter(covs.columns[covs.dtypes != 'object'].tolist())
-        
-        encoder = preprocessing.LabelEncoder()
+            # export filtered file
+            writeMatrix(residual_df, out_paths[0])
 
-        # fit the transformer
-        for i in range(0, len(covs_with_labels.columns)):
-            encoder.fit(covs_with_labels.iloc[:,i])
-            covs_with_labels.iloc[:,i] = encoder.transform(covs_with_labels.iloc[:,i])
-        
-        encoded_covs = pd.merge(covs_with_nums, covs_with_labels, on="short_id")
-        
-        # fill encoded covs with mean for tissues without data for these - doesn't do any filling for brain, but does 
-        # limited filling for other GTEx tissues i.e. wholeblood
-        # fills with most common value for the variable in question - should make very little difference to the correction 
-        encoded_covs = encoded_covs.fillna(encoded_covs.mean())
-        
-        # performing mlr across genes --------------------------------------------------------------------------------
-
-        # defining empty array to hold predicted tpm values
-        residual_df = pd.DataFrame(np.zeros(shape=(len(TPM.index.values), len(TPM.columns.values))),
-                                   index=TPM.index,
-                                   columns=TPM.columns)
-        # defining empty array to hold shapiro pvals
-        shapiro_df = pd.DataFrame(np.zeros(shape=(len(TPM.columns.values), 1)),
-                                  index=TPM.columns,
-                                  columns=['shapiro_pval'])
-
-        # initiating the lm
-        lm = LinearRegression()
-
-        # define fn. to apply column-wise
-        def regress_covs_from_gene(y):
-
-            """
-            function to regress out covariates from each gene - apply over gene axis
-            inserts residuals into predefined residual dataframe with correct row (sample id) and col (gene) labels
-            """
-            gene_name = y.name
-
-            # predictors
-            X = encoded_covs
-
-            # response var
-            y = np.array(y)
-
-            # get list of locations where gene has nan values
-            nan_locs = np.where(np.isnan(y))[0]
-
-            # masking NAs
-            finiteYmask = np.isfinite(y)
-            
-            # cleaning NAs from predictors and response vars
-            Yclean = y[finiteYmask]
-            Xclean = X[finiteYmask]
-            
-            # fit the model 
-            lm.fit(Xclean, Yclean)
-
-            # make predictions from covs - i.e. expected TPMs
-            predictions = lm.predict(Xclean)
-            
-            # reinsert removed nan values one-by-one to make y and predictions the same length
-            for i in range(0, len(nan_locs)):
-                predictions = np.insert(predictions, nan_locs[i], np.nan)
-
-            # residuals = observations - predictions, normalising so they're normally distributed
-            residuals = y - predictions
-
-            # adding residuals to residual df
-            residual_df[gene_name] = residuals
-            
-            # cleaning residuals of NaNs for shapiro fn. 
-            shapiro_resids = residuals[np.logical_not(np.isnan(residuals))]
-
-            # get shapiro pvals and add to shapiro_df
-            shapiro_pval = shapiro(shapiro_resids)[1]
-            shapiro_df.loc[gene_name, 'shapiro_pval'] = shapiro_pval
-
-        # initiate progress bar
-        #tqdm.pandas(tqdm_notebook)
-
-        # applying regress_covs_from_gene fn. across genes
-        TPM.apply(regress_covs_from_gene, axis=0);
-
-        # find % genes with normally distributed residuals
-        sig_norm_gene_count = (int(shapiro_df[shapiro_df <= 0.05].count()) / len(shapiro_df.index.values)) * 100
-        print(round(sig_norm_gene_count, 2), "% of gene residuals have a significantly normal distribution")
-
-        # export output --------------------------------------------------------------------------------
-
-        # export filtered file
-        os.chdir(out_dir)
-        residual_df.to_csv(fn + "_" + outlabel + "_residuals.csv", index=True, header=True)
+            # residual diagnostics --------------------------------------------------------------------------------
+
+            if diagnostics == True:
+
+                # shapiro test per gene, in parallel chunks of genes
+                diag = residualNormality(residual_df, n_cores=n_cores, n_genes=diagnostic_genes)
+
+                # % of tested genes whose residuals depart significantly from normal
+                sig_nonnorm_gene_count = (diag['shapiro_pval'] <= 0.05).mean() * 100
+                log.info("%.2f%% of genes have significantly non-normal residuals (shapiro p <= 0.05)", sig_nonnorm_gene_count)
+
+                writeMatrix(diag, os.path.join(out_dir, fn + "_" + outlabel + "_residual_diagnostics." + out_format))
+
+        if incremental == True:
+            saveManifest(out_dir, "gtex_regress_covariates", file_names[i], manifest)
 
+    writeRunReport(report_dir, run)
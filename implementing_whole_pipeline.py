@@ -39,6 +39,14 @@ from cov_regression_gtex import *
 from cov_regression_rosmap import *
 from genCorrs import *
 from genCorrSummaryTable import *
+from log10MedNormalise import *
+from fusedPipeline import *
+from scheduledPipeline import *
+from summaryStore import *
+from pipelineLog import setLogLevel
+
+# pipeline logs go to stderr - DEBUG adds matrix shapes and previews, WARNING keeps only problems
+setLogLevel("INFO")
 
 ################# pipeline ######################################
 
@@ -95,13 +103,23 @@ from genCorrSummaryTable import *
 
 ##################### log10 median norm #########################
 
-# #importing R script log10MedNormalise.R
+# # python port of log10MedNormalise.R - runs in-process, no R/rpy2/beadarray needed
 # print("log10 median normalising")
+# log10MedNormalise(
+#   file_dir=pwd,
+#   pattern="_0filtered.csv",
+#   filesep=",",
+#   outdir=None,
+#   outlabel="",
+#   med_norm=True)
+# # # out label = log10_mediannorm_TPM.csv
+
+# # original R version via rpy2
 # import rpy2.robjects as robjects # to allow calling R script
 # r_source = robjects.r['source']
 # r_source("""/home/abrowne/Scripts/data_processing/log10MedNormalise.R""")
-# log10MedNormalise = robjects.globalenv["log10MedNormalise"]
-# log10MedNormalise(
+# log10MedNormaliseR = robjects.globalenv["log10MedNormalise"]
+# log10MedNormaliseR(
 #   file_dir=pwd,
 #   pattern="*_0filtered.csv",
 #   filesep=",",
@@ -177,10 +195,48 @@ genCorrs(
   method="spearman",
   outlabel="",
   random_shuffle_cols = False,
-  all_corrs = False
+  all_corrs = False,
+  incremental = False # True skips tissues unchanged since the last run
   )
 # out label = _spearman_corrs.csv, _spearman_pvals.csv
 
+################# fused in-memory pipeline #####################
+
+# # runs filter -> log10 median norm -> mask outliers -> regress covs -> mt-nuc corrs
+# # per tissue in one process, without the intermediate csvs
+# print("running fused pipeline")
+# runPipeline(
+#   file_dir=pwd,
+#   pattern="_preprocessed.csv",
+#   filesep=",",
+#   outdir=None,
+#   outlabel="",
+#   regress="gtex",
+#   meta_path="/home/abrowne/projects/GTEx_6p/gtex_metadata/GTEx_Data_V6_Annotations_SampleAttributesDS.txt",
+#   pheno_path="/home/abrowne/projects/GTEx_6p/gtex_metadata/pheno6p.txt",
+#   method="spearman",
+#   write_intermediates=False,
+#   report_dir=None # i.e. pwd + "run_report/" - time, memory and genes a second per file, add profile=True for cProfile stats
+#   )
+# # out label = _spearman_corrs.csv, _spearman_pvals.csv, _spearman_nobs.csv
+
+# # same stages as one graph of (tissue, stage) tasks under a global core and memory budget
+# print("running scheduled pipeline")
+# runScheduledPipeline(
+#   file_dir=pwd,
+#   pattern="_preprocessed.csv",
+#   filesep=",",
+#   outdir=None,
+#   outlabel="",
+#   regress="gtex",
+#   meta_path="/home/abrowne/projects/GTEx_6p/gtex_metadata/GTEx_Data_V6_Annotations_SampleAttributesDS.txt",
+#   pheno_path="/home/abrowne/projects/GTEx_6p/gtex_metadata/pheno6p.txt",
+#   method="spearman",
+#   max_cores=16,
+#   max_mem=64e9
+#   )
+# # out label = _spearman_corrs.csv, _spearman_pvals.csv, _spearman_nobs.csv
+
 ################# generate summary table ########################
 
 # # generate summary_table for correlations + pvalues
@@ -192,8 +248,34 @@ genCorrs(
 #   outfile_label=""
 #   )
 
+# # same table built one tissue at a time, aligned on (mt_gene, nuc_gene)
+# streamCorrSummaryTable(
+#   file_dir=pwd,
+#   outdir=None,
+#   pattern="spearman",
+#   outfile_label="",
+#   out_format="parquet",
+#   adjust=True # BH and Bonferroni adjusted pvals per tissue and across all tissues
+#   )
+
+# # index the summary table, then query it without loading it whole
+# store = SummaryStore(buildSummaryStore(pwd + "summary_table.parquet"))
+# store.query(mt_gene="ENSG00000198804", tissues=["Brain_Cortex", "Brain_Hippocampus"], max_pval=1e-6, pval_kind="pval_bh")
 
 
 
 
 
+
+
+################# benchmarks ####################################
+
+# # time every stage on synthetic data - save a baseline once, later runs flag cases slower than it
+# from benchmarkPipeline import runBenchmarks
+# runBenchmarks(
+#   bench_dir="/home/abrowne/benchmarks/",
+#   n_samples=(100, 400),
+#   n_genes=(5000, 20000),
+#   nan_fracs=(0, 0.05),
+#   save_baseline=False
+#   )
@@ -0,0 +1,72 @@
+# class LabelledMatrix
+# a 2d float array plus its row and col labels - what the in-memory pipeline stages take and return,
+# so a matrix moves between stages without a DataFrame or a csv round trip
+
+
+class LabelledMatrix:
+
+  # """
+  # values: 2d float array, i.e. rows=samples, cols=genes
+  # rows: labels of the rows
+  # cols: labels of the cols
+  # """
+
+  def __init__(self, values, rows, cols):
+
+    import numpy as np
+    import pandas as pd
+
+    self.values = np.asarray(values, dtype=np.float64)
+    self.rows = pd.Index(rows)
+    self.cols = pd.Index(cols)
+
+    if self.values.shape != (len(self.rows), len(self.cols)):
+      raise ValueError("values of shape {} do not match {} row and {} col labels".format(self.values.shape, len(self.rows), len(self.cols)))
+
+  @property
+  def shape(self):
+    return(self.values.shape)
+
+  @classmethod
+  def fromDf(cls, df):
+
+    # """
+    # df: DataFrame to take the values and labels from
+    # """
+
+    return(cls(df.values, df.index, df.columns))
+
+  def toDf(self):
+
+    # """
+    # returns the matrix as a DataFrame, index=rows, columns=cols
+    # """
+
+    import pandas as pd
+
+    return(pd.DataFrame(self.values, index=self.rows, columns=self.cols))
+
+  def subset(self, rows=None, cols=None):
+
+    # """
+    # rows: boolean mask or positions of the rows to keep, default keeps all
+    # cols: boolean mask or positions of the cols to keep, default keeps all
+    # returns a new LabelledMatrix
+    # """
+
+    import numpy as np
+
+    rows = np.arange(self.shape[0]) if rows is None else np.asarray(rows)
+    cols = np.arange(self.shape[1]) if cols is None else np.asarray(cols)
+
+    # masks to positions, so both can go through one fancy index
+    if rows.dtype == bool:
+      rows = np.flatnonzero(rows)
+    if cols.dtype == bool:
+      cols = np.flatnonzero(cols)
+
+    return(LabelledMatrix(self.values[np.ix_(rows, cols)], self.rows[rows], self.cols[cols]))
+
+  def transpose(self):
+
+    return(LabelledMatrix(self.values.T, self.cols, self.rows))
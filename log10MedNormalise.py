@@ -0,0 +1,139 @@
+# function log10MedNormalise
+# python port of log10MedNormalise.R - runs in-process, without R, rpy2 or beadarray
+# log10 transformation to make sample distributions normal prior to median normalisation
+# median normalisation to make the sample expression medians the same for inter-sample comparability
+# runs all files in parallel
+# takes a dataframe in the form samples = cols, genes = rows
+
+
+def medianNormalise(a):
+
+  # """
+  # a: 2d float array, rows=genes, cols=samples
+  # equivalent of beadarray's medianNormalise(exprs, log=FALSE): every sample (col) has its median subtracted,
+  # then the median of the whole matrix is added back, so all samples share the same median. NaNs are ignored
+  # """
+
+  import numpy as np
+
+  return(a - np.nanmedian(a, axis=0) + np.nanmedian(a))
+
+
+def log10MedNormaliseMatrix(df, med_norm=True):
+
+  # """
+  # df: DataFrame, rows=genes, cols=samples
+  # med_norm: can disable median normalisation by setting this to False
+  # applies the filtering and normalisation steps of log10MedNormalise to one matrix and returns it
+  # """
+
+  import logging
+  import numpy as np
+  import pandas as pd
+  from pipelineLog import stageLogger
+
+  log = stageLogger("log10MedNormalise")
+
+  # counting NAs is a pass over the matrix, only done when it is logged
+  if log.isEnabledFor(logging.DEBUG):
+    log.debug("NA in df: %d", df.isna().values.sum())
+
+  # remove individuals that have zero reads
+  df = df.loc[:, (df > 0).any(axis=0)]
+
+  # remove genes that have zero reads
+  df = df.loc[(df > 0).all(axis=1)]
+
+  # remove genes that are all NA
+  df = df.loc[df.isna().sum(axis=1) != df.shape[1]]
+  log.debug("%s", df.shape)
+
+  # log10 normalising
+  a = np.log10(df.values.astype(np.float64) + 1)
+
+  if med_norm == True:
+    a = medianNormalise(a)
+
+  return(pd.DataFrame(a, index=df.index, columns=df.columns))
+
+
+def log10MedNormalise(file_dir="", pattern=".csv", filesep=",", outdir=None, outlabel="", med_norm=True, n_cores=None, out_format="csv",
+                      incremental=False, report_dir=None, profile=False):
+
+  # """
+  # file_dir: directory where input file is stored
+  # pattern: pattern to search for - if using one file, simply give full file name. Input format is taken from the file suffix
+  # filesep: separator of text input (i.e. \t or ,)
+  # outdir: where should the files go, default is file_dir
+  # outlabel: label to add to the output file. Allows next pipeline fn. to find it easily
+  # med_norm: can disable median normalisation by setting this to False
+  # n_cores: total cores shared by all files, default is all cores on the machine
+  # out_format: output file suffix - csv, parquet, feather or npy
+  # incremental: skip files whose input, parameters and code are unchanged since the last run, keeping their outputs (see stageCache)
+  # report_dir: record each file's time, memory, bytes and genes a second in a run report in this directory (see runReport)
+  # profile: with report_dir, also keep a cProfile of each file
+  # outputs _log10_mediannorm_TPM.csv (or _log10_norm_TPM.csv without median normalisation), rows=genes, cols=samples,
+  # as the R version does
+  # """
+
+  import os
+  import re
+  from coreBudget import runFiles
+  from matrixIO import matrixFiles, matrixPaths, readMatrix, writeMatrix
+  from stageCache import stageManifest, saveManifest
+  from runReport import newRunId, stageReport, writeRunReport
+  from pipelineLog import stageLogger
+
+  log = stageLogger("log10MedNormalise")
+  run = newRunId()
+
+  if outdir == None:
+    outdir = file_dir
+  outdir = os.path.abspath(outdir)
+
+  # get all file paths
+  file_paths = matrixFiles(file_dir, pattern)
+  log.info("files: %s", file_paths)
+
+  def doNormalisation(f, n_threads=1):
+
+    file_name = re.sub("__.*", "", f)
+
+    log.info(file_name)
+
+    if med_norm == True:
+      out_path = os.path.join(outdir, file_name.replace(pattern, "") + "_" + outlabel + "_log10_mediannorm_TPM." + out_format)
+    else:
+      out_path = os.path.join(outdir, file_name.replace(pattern, "") + "_" + outlabel + "_log10_norm_TPM." + out_format)
+
+    if incremental == True:
+      up_to_date, manifest = stageManifest(outdir, "log10MedNormalise", f, [file_dir+f],
+                                           {"pattern": pattern, "filesep": filesep, "outlabel": outlabel, "med_norm": med_norm, "out_format": out_format},
+                                           ["log10MedNormalise", "matrixIO"], matrixPaths(out_path))
+      if up_to_date:
+        log.info("unchanged since the last run - keeping %s", out_path)
+        return
+
+    with stageReport(report_dir, "log10MedNormalise", f, [file_dir+f], matrixPaths(out_path), profile, run) as rec:
+
+      df = readMatrix(file_dir+f, sep=filesep)
+
+      # samples to cols
+      if len(df.columns) > len(df.index):
+        df = df.T
+
+      log.debug("loaded df %s", df.shape)
+      rec["genes"], rec["samples"] = df.shape
+
+      df = log10MedNormaliseMatrix(df, med_norm=med_norm)
+
+      log.debug("writing outfiles")
+      writeMatrix(df, out_path)
+
+    if incremental == True:
+      saveManifest(outdir, "log10MedNormalise", f, manifest)
+
+  # parallelise normalisation over all files
+  runFiles(doNormalisation, file_paths, n_cores)
+
+  writeRunReport(report_dir, run)
@@ -3,76 +3,198 @@
 # outputs files with outliers masked as Na values
 # AFB 16/01/2020
 
-def maskGeneOutliers(file_dir="", pattern=".csv", filesep=",", outdir=None, outlabel=""):
+
+def nanQuantiles(a, qs):
+  
+  # """
+  # a: 2d float array, rows=samples, cols=genes
+  # qs: list of quantiles
+  # returns a len(qs) x genes array of per-gene quantiles ignoring NaNs, from one sort of the whole matrix.
+  # Uses the same linear interpolation as np.quantile, NaN for all-NaN genes
+  # """
+  
+  import numpy as np
+  
+  # NaNs sort to the end of each column
+  s = np.sort(a, axis=0)
+  n = np.logical_not(np.isnan(a)).sum(axis=0)
+  
+  out = np.full((len(qs), a.shape[1]), np.nan)
+  has_vals = n > 0
+  for i in range(0, len(qs)):
+    pos = (n[has_vals] - 1) * qs[i]
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, n[has_vals] - 1)
+    t = pos - lo
+    v_lo = np.take_along_axis(s[:, has_vals], lo[None, :], axis=0)[0]
+    v_hi = np.take_along_axis(s[:, has_vals], hi[None, :], axis=0)[0]
+    # same lerp as numpy, so cut-offs match np.quantile exactly
+    diff = v_hi - v_lo
+    out[i, has_vals] = np.where(t >= 0.5, v_hi - diff * (1 - t), v_lo + diff * t)
+  
+  return(out)
+
+
+def maskOutliers(a, k=3):
+  
+  # """
+  # a: 2d float array, rows=samples, cols=genes - masked in place
+  # k: outliers are below Q1 - k*IQR or above Q3 + k*IQR
+  # masks the outliers of every gene with NaN in one broadcast comparison
+  # returns the per-gene lower cut-off, upper cut-off and number of values masked below and above
+  # """
+  
+  import numpy as np
+  
+  q1, q3 = nanQuantiles(a, [0.25, 0.75])
+  iqr = q3 - q1
+  lower_lim = q1 - (iqr*k) # lower outlier cut-off
+  upper_lim = q3 + (iqr*k) # upper outlier cut-off
+  
+  low = a < lower_lim
+  high = a > upper_lim
+  a[low | high] = np.nan
+  
+  return(lower_lim, upper_lim, low.sum(axis=0), high.sum(axis=0))
+
+
+def sharedMaskBlock(ins, outs, j0, j1):
+  
+  # """
+  # masks one col block of the memory-mapped matrix in place. Run by runSharedBlocks
+  # """
+  
+  return(maskOutliers(outs["a"][:, j0:j1]))
+
+
+def maskMatrix(a, genes, n_threads=1, shared_dir=None):
+  
+  # """
+  # a: 2d float array, rows=samples, cols=genes - masked in place
+  # genes: gene labels for the cols of a
+  # n_threads: number of threads, genes are split into one col block per thread
+  # shared_dir: directory for a memory-mapped copy of a, i.e. /dev/shm. With it, blocks are masked by n_threads worker
+  # processes attached to the mapped matrix, each writing only its own cols, instead of threads. Default None uses threads
+  # masks the outliers of every gene as maskOutliers, returns a DataFrame of each gene's cut-offs and number of masked values
+  # """
+  
+  import os
+  import shutil
+  import tempfile
+  import numpy as np
+  import pandas as pd
+  from coreBudget import runTasks, colBlocks, sharedArray, runSharedBlocks
+  
+  if shared_dir == None or n_threads == 1:
+    blocks = runTasks(lambda j0, j1: maskOutliers(a[:, j0:j1]), colBlocks(a.shape[1], n_threads), n_threads)
+  else:
+    tmp = tempfile.mkdtemp(dir=shared_dir)
+    try:
+      path = os.path.join(tmp, "a.npy")
+      sharedArray(a, path)
+      blocks = runSharedBlocks(sharedMaskBlock, {}, {"a": path}, colBlocks(a.shape[1], n_threads), n_threads)
+      a[:] = np.load(path, mmap_mode='r')
+    finally:
+      shutil.rmtree(tmp, ignore_errors=True)
+  
+  # per-gene cut-offs and mask counts
+  counts = pd.DataFrame(np.hstack([np.vstack(b) for b in blocks]).T,
+                        index=genes,
+                        columns=['lower_lim', 'upper_lim', 'n_masked_low', 'n_masked_high'])
+  counts[['n_masked_low', 'n_masked_high']] = counts[['n_masked_low', 'n_masked_high']].astype(int)
+  counts['n_masked'] = counts['n_masked_low'] + counts['n_masked_high']
+  
+  return(counts)
+
+
+def maskGeneOutliers(file_dir="", pattern=".csv", filesep=",", outdir=None, outlabel="", n_cores=None, out_format="csv", shared_dir=None,
+                     incremental=False, report_dir=None, profile=False):
   
   # """
   # file_dir: directory containing the rpkms
   # pattern: pattern to search for, default is all .csv files
   # outdir: where should the files go, default is file_dir
-  # filesep: file separating char, default is comma
+  # filesep: file separating char of text input, default is comma
   # outlabel: add label to output files
+  # n_cores: total cores shared by all files and the gene blocks within them, default is all cores on the machine
+  # out_format: output file suffix - csv, parquet, feather or npy. Input format is taken from the file suffix (see matrixIO),
+  # .npy inputs are memory-mapped rather than read
+  # shared_dir: directory for memory-mapped copies of each file's matrix, i.e. /dev/shm. With it the gene blocks of a file are
+  # masked by worker processes attached zero-copy to the mapped matrix rather than by threads
+  # incremental: skip files whose input, parameters and code are unchanged since the last run, keeping their outputs (see stageCache)
+  # report_dir: record each file's time, memory, bytes and genes a second in a run report in this directory (see runReport)
+  # profile: with report_dir, also keep a cProfile of each file
+  # also writes a _mask_counts file per file with each gene's cut-offs and number of masked values
   # """
   
   import os 
   import pandas as pd
-  from scipy import stats
   import numpy as np
-  import re
-  import multiprocessing
-  from joblib import Parallel, delayed
+  from coreBudget import runFiles
+  from matrixIO import matrixFiles, matrixPaths, readMatrix, writeMatrix
+  from stageCache import stageManifest, saveManifest
+  from runReport import newRunId, stageReport, writeRunReport
+  from pipelineLog import stageLogger
+  
+  log = stageLogger("maskGeneOutliers")
+  run = newRunId()
   
   if outdir == None:
     outdir = file_dir
+  outdir = os.path.abspath(outdir)
   
   # get all file paths
-  file_paths = [file for file in os.listdir(file_dir) if pattern in file]
-  print(file_paths)
+  file_paths = matrixFiles(file_dir, pattern)
+  log.info("files: %s", file_paths)
   
-  num_cores = len(file_paths)
-  
-  def dofilesInParallel(__file__):
+  def dofilesInParallel(__file__, n_threads=1):
     
-    print(__file__)
+    log.info(__file__)
     
-    # import df
-    df = pd.read_csv(open(file_dir+__file__), sep=filesep, encoding="utf-8", engine='python', index_col=0, header=0) # genes cols, samples rows
+    fname = __file__.replace(pattern, '')
+    out_paths = [os.path.join(outdir, fname + "_" + outlabel + "_masked_outliers." + out_format),
+                 os.path.join(outdir, fname + "_" + outlabel + "_mask_counts." + out_format)]
     
-    # genes to cols 
-    if len(df.index.values) > len(df.columns.values):
-      df = df.transpose()
+    if incremental == True:
+      up_to_date, manifest = stageManifest(outdir, "maskGeneOutliers", __file__, [file_dir+__file__],
+                                           {"pattern": pattern, "filesep": filesep, "outlabel": outlabel, "out_format": out_format},
+                                           ["maskGeneOutliers", "matrixIO", "coreBudget"], matrixPaths(out_paths[0]) + matrixPaths(out_paths[1]))
+      if up_to_date:
+        log.info("unchanged since the last run - keeping %s", out_paths[0])
+        return
     
-    if 'brain_region' in df.columns.values:
-      df.drop('brain_region', axis='columns', inplace=True)
+    with stageReport(report_dir, "maskGeneOutliers", __file__, [file_dir+__file__], matrixPaths(out_paths[0]) + matrixPaths(out_paths[1]), profile, run) as rec:
+
+      # import df
+      df = readMatrix(file_dir+__file__, sep=filesep, mmap=True) # genes cols, samples rows
     
-    def doMaskOutliers(gene):
+      # genes to cols 
+      if len(df.index.values) > len(df.columns.values):
+        df = df.transpose()
     
-      gene_clean = gene[np.logical_not(np.isnan(gene))]
-      
-      # get gene iqr
-      iqr = stats.iqr(gene_clean) # inter-quartile range
-      
-      # upper and lower outlier cut-offs - quartile +/- 3*iqr
-      lower_lim = np.quantile(gene_clean, 0.25) - (iqr*3) # lower outlier cut-off
-      upper_lim = np.quantile(gene_clean, 0.75) + (iqr*3) # upper outlier cut-off
-      
-      # masking outliers with NaN
-      gene.values[gene.values > upper_lim] = np.nan
-      gene.values[gene.values < lower_lim] = np.nan
-      
-      # returning outlier-masked row
-      return(gene)
+      if 'brain_region' in df.columns.values:
+        df.drop('brain_region', axis='columns', inplace=True)
+    
+      rec["samples"], rec["genes"] = df.shape
       
-    # applying across genes
-    df = df.apply(doMaskOutliers, axis=0)
+      # masking outliers in place on one float array, in col blocks shared between this file's threads
+      a = df.values.astype(np.float64)
+      counts = maskMatrix(a, df.columns, n_threads, shared_dir)
     
-    print("total NaN: ", df.isna().sum().sum())
+      df = pd.DataFrame(a, index=df.index, columns=df.columns)
     
-    # write out
-    os.chdir(outdir)
-    fname = __file__.replace(pattern, '')
-    df.to_csv(fname + "_" + outlabel + "_masked_outliers.csv", index=True, header=True)
+      log.info("total NaN: %d masked: %d genes with masked values: %d", np.isnan(a).sum(), counts['n_masked'].sum(), (counts['n_masked'] > 0).sum())
+    
+      # write out
+      writeMatrix(df, out_paths[0])
+      writeMatrix(counts, out_paths[1])
+    
+    if incremental == True:
+      saveManifest(outdir, "maskGeneOutliers", __file__, manifest)
 
-  # run files in parallel
-  Parallel(n_jobs=num_cores)(delayed(dofilesInParallel)(__file__=i) for i in file_paths)
+  # run files in parallel - files and the gene blocks within them share one core budget
+  runFiles(dofilesInParallel, file_paths, n_cores)
+  
+  writeRunReport(report_dir, run)
 
     
@@ -0,0 +1,223 @@
+# functions readMatrix and writeMatrix
+# one reader and writer for the matrices passed between pipeline stages, with the format chosen from the file suffix:
+# .csv (or .tsv/.txt) text for interop, .parquet and .feather columnar binary (need pyarrow), or .npy raw float64
+# values with the row and col labels in a .labels.json sidecar - .npy files can be memory-mapped
+# text files are parsed with the C engine
+
+
+# file suffix -> format
+matrix_formats = {".csv": "csv", ".tsv": "tsv", ".txt": "tsv", ".parquet": "parquet", ".feather": "feather", ".npy": "npy"}
+
+
+def matrixFormat(path):
+
+  # """
+  # path: matrix file path
+  # returns the format of the file from its suffix
+  # """
+
+  import os
+
+  suffix = os.path.splitext(path)[1].lower()
+  if suffix not in matrix_formats:
+    raise ValueError("unknown matrix format '{}', use one of {}".format(suffix, ", ".join(matrix_formats)))
+
+  return(matrix_formats[suffix])
+
+
+def labelsPath(path):
+
+  # """
+  # path: .npy matrix file path
+  # returns the path of its row and col labels sidecar
+  # """
+
+  import os
+
+  return(os.path.splitext(path)[0] + ".labels.json")
+
+
+def writeLabels(path, rows, cols, rows_name=None, cols_name=None):
+
+  # """
+  # path: .npy matrix file path
+  # rows, cols: row and col labels of the matrix
+  # rows_name, cols_name: names of the row and col index
+  # writes the labels sidecar readMatrix and matrixLabels read - for .npy matrices written without writeMatrix,
+  # i.e. filled in place through a memmap
+  # """
+
+  import json
+
+  labels = {"rows": list(rows), "rows_name": rows_name, "cols": list(cols), "cols_name": cols_name}
+  with open(labelsPath(path), "w", encoding="utf-8") as f:
+    json.dump(labels, f)
+
+
+def matrixPaths(path):
+
+  # """
+  # path: matrix file path
+  # returns every file writeMatrix writes for path - the matrix, plus the labels sidecar for .npy
+  # """
+
+  if matrixFormat(path) == "npy":
+    return([path, labelsPath(path)])
+
+  return([path])
+
+
+def matrixFiles(file_dir, pattern):
+
+  # """
+  # file_dir: directory to search
+  # pattern: pattern to search for
+  # returns the names of the files in file_dir containing pattern, leaving out .npy label sidecars
+  # """
+
+  import os
+
+  return([file for file in os.listdir(file_dir) if pattern in file and not file.endswith(".labels.json")])
+
+
+def readMatrix(path, sep=None, mmap=False):
+
+  # """
+  # path: matrix file path, the suffix sets the format
+  # sep: separator of text files, default is comma for .csv and tab for .tsv/.txt
+  # mmap: .npy only - memory-map the values read-only instead of reading them into memory
+  # returns a DataFrame, index=row labels, columns=col labels
+  # """
+
+  import json
+  import numpy as np
+  import pandas as pd
+
+  fmt = matrixFormat(path)
+
+  if fmt == "csv" or fmt == "tsv":
+    if sep == None:
+      sep = "," if fmt == "csv" else "\t"
+    return(pd.read_csv(path, sep=sep, encoding="utf-8", index_col=0, header=0))
+
+  if fmt == "parquet":
+    return(pd.read_parquet(path))
+
+  if fmt == "feather":
+    # feather has no index, writeMatrix stores it as the first col
+    df = pd.read_feather(path)
+    df = df.set_index(df.columns[0])
+    if df.index.name == "index":
+      df.index.name = None
+    return(df)
+
+  values = np.load(path, mmap_mode='r' if mmap else None)
+  with open(labelsPath(path), encoding="utf-8") as f:
+    labels = json.load(f)
+
+  return(pd.DataFrame(values,
+                      index=pd.Index(labels["rows"], name=labels["rows_name"]),
+                      columns=pd.Index(labels["cols"], name=labels["cols_name"]),
+                      copy=False))
+
+
+def writeMatrix(df, path, sep=None):
+
+  # """
+  # df: DataFrame to write, index=row labels, columns=col labels
+  # path: output path, the suffix sets the format
+  # sep: separator of text files, default is comma for .csv and tab for .tsv/.txt
+  # .npy holds numeric matrices only, use a text or columnar format for tables with text cols. It keeps the values'
+  # dtype, i.e. float32 stays float32
+  # """
+
+  import numpy as np
+
+  fmt = matrixFormat(path)
+
+  if fmt == "csv" or fmt == "tsv":
+    if sep == None:
+      sep = "," if fmt == "csv" else "\t"
+    df.to_csv(path, sep=sep, index=True, header=True)
+
+  elif fmt == "parquet":
+    df.to_parquet(path, index=True)
+
+  elif fmt == "feather":
+    df.reset_index().to_feather(path)
+
+  else:
+    np.save(path, np.asarray(df.values))
+    writeLabels(path, df.index.tolist(), df.columns.tolist(), df.index.name, df.columns.name)
+
+
+def matrixShape(path, sep=None):
+
+  # """
+  # path: matrix file path, the suffix sets the format
+  # sep: separator of text files, default is comma for .csv and tab for .tsv/.txt
+  # returns (rows, cols) of the stored matrix without reading its values - text files are only scanned for line ends,
+  # columnar and .npy files report it from their metadata
+  # """
+
+  import numpy as np
+
+  fmt = matrixFormat(path)
+
+  if fmt == "csv" or fmt == "tsv":
+    if sep == None:
+      sep = "," if fmt == "csv" else "\t"
+    with open(path, "rb") as f:
+      n_cols = f.readline().count(sep.encode("utf-8"))
+      n_rows = sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b""))
+    return((n_rows, n_cols))
+
+  if fmt == "parquet":
+    import pyarrow.parquet as pq
+    meta = pq.ParquetFile(path).metadata
+    return((meta.num_rows, meta.num_columns - 1))
+
+  if fmt == "feather":
+    import pyarrow.feather as feather
+    table = feather.read_table(path, memory_map=True)
+    return((table.num_rows, table.num_columns - 1))
+
+  return(np.load(path, mmap_mode='r').shape)
+
+
+def matrixLabels(path, sep=None):
+
+  # """
+  # path: matrix file path, the suffix sets the format
+  # sep: separator of text files, default is comma for .csv and tab for .tsv/.txt
+  # returns (rows, cols) label Indexes of the stored matrix without reading its values - only the first col of text
+  # and feather files is parsed, parquet and .npy labels come from the index col and the sidecar
+  # """
+
+  import json
+  import pandas as pd
+
+  fmt = matrixFormat(path)
+
+  if fmt == "csv" or fmt == "tsv":
+    if sep == None:
+      sep = "," if fmt == "csv" else "\t"
+    cols = pd.read_csv(path, sep=sep, encoding="utf-8", index_col=0, nrows=0).columns
+    rows = pd.read_csv(path, sep=sep, encoding="utf-8", index_col=0, usecols=[0]).index
+    return((rows, cols))
+
+  if fmt == "parquet":
+    import pyarrow.parquet as pq
+    schema = pq.read_schema(path)
+    index_cols = [c for c in schema.pandas_metadata["index_columns"] if isinstance(c, str)]
+    return((pd.read_parquet(path, columns=[]).index, pd.Index([c for c in schema.names if c not in index_cols])))
+
+  if fmt == "feather":
+    import pyarrow.feather as feather
+    names = feather.read_table(path, memory_map=True).schema.names
+    return((pd.Index(pd.read_feather(path, columns=[names[0]]).iloc[:, 0]), pd.Index(names[1:])))
+
+  with open(labelsPath(path), encoding="utf-8") as f:
+    labels = json.load(f)
+
+  return((pd.Index(labels["rows"]), pd.Index(labels["cols"])))
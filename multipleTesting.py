@@ -0,0 +1,138 @@
+# functions for multiple-testing correction of p-value cols too large to sort in memory
+# a family is one or more 1d p-value arrays (i.e. memory-mapped cols of a summary table) adjusted together - one
+# tissue's pvals, or all tissues' pvals for a global correction. NaNs are left as NaN and not counted, as R's p.adjust
+# Bonferroni works chunk by chunk. Benjamini-Hochberg is sort based: the values are split into buckets of p-value
+# ranges on disk, each bucket is sorted in memory in turn from the largest p-values down, and the running minimum
+# of m * p / rank is carried from one bucket to the next - the result is exact, as sorting the whole family at once
+
+
+def countValid(columns, chunk_rows=1000000):
+
+  # """
+  # columns: list of 1d p-value arrays
+  # chunk_rows: values read at once
+  # returns the number of non-NaN values, the m of the family
+  # """
+
+  import numpy as np
+
+  return(int(sum(np.count_nonzero(~np.isnan(col[r0:r0 + chunk_rows])) for col in columns for r0 in range(0, len(col), chunk_rows))))
+
+
+def bonferroni(columns, outs, chunk_rows=1000000):
+
+  # """
+  # columns: list of 1d p-value arrays, adjusted as one family
+  # outs: list of writable 1d arrays of the same lengths, i.e. memory-mapped cols, for the adjusted values
+  # chunk_rows: values read at once
+  # writes min(1, m * p) to outs
+  # """
+
+  import numpy as np
+
+  m = countValid(columns, chunk_rows)
+
+  for col, out in zip(columns, outs):
+    for r0 in range(0, len(col), chunk_rows):
+      out[r0:r0 + chunk_rows] = np.minimum(1, m * np.asarray(col[r0:r0 + chunk_rows], dtype=np.float64))
+
+
+def bucketEdges(columns, n_buckets, sample_size=1000000, seed=0):
+
+  # """
+  # columns: list of 1d p-value arrays
+  # n_buckets: number of p-value ranges wanted
+  # sample_size: values sampled to place the range edges
+  # seed: seed of the sample
+  # returns the inner edges of n_buckets ranges holding about the same number of values each
+  # """
+
+  import numpy as np
+
+  if n_buckets <= 1:
+    return(np.array([]))
+
+  rng = np.random.default_rng(seed)
+  n = sum(len(col) for col in columns)
+  sample = np.concatenate([np.asarray(col[np.sort(rng.integers(0, len(col), max(1, sample_size * len(col) // n)))]) for col in columns if len(col) > 0])
+  sample = sample[~np.isnan(sample)]
+  if len(sample) == 0:
+    return(np.array([]))
+
+  return(np.unique(np.quantile(sample, np.linspace(0, 1, n_buckets + 1)[1:-1])))
+
+
+def benjaminiHochberg(columns, outs, scratch_dir=None, bucket_rows=20000000, chunk_rows=1000000, seed=0):
+
+  # """
+  # columns: list of 1d p-value arrays, adjusted as one family
+  # outs: list of writable 1d arrays of the same lengths, i.e. memory-mapped cols, for the adjusted values
+  # scratch_dir: directory for the bucket files, default is the system temp dir
+  # bucket_rows: values per bucket - each bucket is sorted in memory, so this sets peak memory (~ 24 bytes a value)
+  # chunk_rows: values read at once when splitting into buckets
+  # seed: seed of the sample that places the bucket edges
+  # writes the BH adjusted values to outs, as p.adjust(p, "BH"): for the i-th smallest of m p-values,
+  # min(1, min over j >= i of m * p(j) / j)
+  # """
+
+  import os
+  import shutil
+  import tempfile
+  import numpy as np
+
+  m = countValid(columns, chunk_rows)
+  for out in outs:
+    out[:] = np.nan
+  if m == 0:
+    return
+
+  edges = bucketEdges(columns, -(-m // bucket_rows), seed=seed)
+  n_buckets = len(edges) + 1
+
+  # bucket files of (col, position, p) records
+  record = np.dtype([("col", np.int32), ("pos", np.int64), ("p", np.float64)])
+  work_dir = tempfile.mkdtemp(prefix=".bh_", dir=scratch_dir)
+
+  try:
+
+    counts = np.zeros(n_buckets, dtype=np.int64)
+    files = [open(os.path.join(work_dir, "bucket_{}.bin".format(b)), "wb") for b in range(n_buckets)]
+    try:
+      for c, col in enumerate(columns):
+        for r0 in range(0, len(col), chunk_rows):
+          p = np.asarray(col[r0:r0 + chunk_rows], dtype=np.float64)
+          pos = np.flatnonzero(~np.isnan(p))
+          rec = np.empty(len(pos), dtype=record)
+          rec["col"], rec["pos"], rec["p"] = c, pos + r0, p[pos]
+
+          # equal p-values always fall in the same bucket
+          bucket = np.searchsorted(edges, rec["p"], side="right")
+          order = np.argsort(bucket, kind="stable")
+          bounds = np.searchsorted(bucket[order], np.arange(n_buckets + 1))
+          for b in range(n_buckets):
+            if bounds[b + 1] > bounds[b]:
+              rec[order[bounds[b]:bounds[b + 1]]].tofile(files[b])
+          counts += np.diff(bounds)
+    finally:
+      for f in files:
+        f.close()
+
+    # largest p-values first, ranks of each bucket start after all smaller p-values
+    first_rank = np.concatenate([[0], np.cumsum(counts)[:-1]]) + 1
+    carry = 1.0
+    for b in range(n_buckets - 1, -1, -1):
+      rec = np.fromfile(os.path.join(work_dir, "bucket_{}.bin".format(b)), dtype=record)
+      if len(rec) == 0:
+        continue
+      rec = rec[np.argsort(rec["p"], kind="stable")]
+
+      adj = m * rec["p"] / np.arange(first_rank[b], first_rank[b] + len(rec))
+      adj = np.minimum(np.minimum.accumulate(adj[::-1])[::-1], carry)
+      carry = adj[0]
+
+      for c in np.unique(rec["col"]):
+        in_col = rec["col"] == c
+        outs[c][rec["pos"][in_col]] = adj[in_col]
+
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
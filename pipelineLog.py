@@ -0,0 +1,124 @@
+# logging for the pipeline stages
+# every module logs through stageLogger under one "mitonuc" logger. Each record is a single write of one line (or one
+# block, for tables) to stderr, prefixed with the time, level, process id and module, so records from joblib, loky and
+# scheduler worker processes stay whole and can be told apart
+# the level is set with setLogLevel, or the MITONUC_LOG_LEVEL environment variable, default INFO - it is kept in the
+# environment, so worker processes started afterwards log at the same level. Shapes and table previews are DEBUG
+# Progress reports a loop's count, rate and ETA at most once every few seconds rather than on every iteration
+
+import logging
+
+level_var = "MITONUC_LOG_LEVEL"
+
+
+class StageLogger(logging.LoggerAdapter):
+
+  # """
+  # logger of one module, see stageLogger - logs as the module's logging.Logger does. It pickles as a call to
+  # stageLogger with the current level, so a logger captured by a function sent to a worker process (i.e. by joblib)
+  # sets up the handler and level there as well, even in workers kept from before a setLogLevel, rather than arriving
+  # as a bare logger that drops INFO records
+  # """
+
+  def __init__(self, name):
+    logging.LoggerAdapter.__init__(self, logging.getLogger("mitonuc").getChild(name), {})
+    self.module = name
+
+  def __reduce__(self):
+    return(stageLogger, (self.module, logging.getLogger("mitonuc").level))
+
+
+def stageLogger(name, level=None):
+
+  # """
+  # name: module name, i.e. genCorrs
+  # level: set the level of this process's pipeline loggers, default None leaves it as it is
+  # returns the module's StageLogger - the stderr handler is added to the parent "mitonuc" logger once per process
+  # """
+
+  import os
+  import sys
+
+  parent = logging.getLogger("mitonuc")
+
+  if len(parent.handlers) == 0:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s", "%H:%M:%S"))
+    parent.addHandler(handler)
+    parent.propagate = False
+    parent.setLevel(os.environ.get(level_var, "INFO").upper())
+
+  if level != None:
+    parent.setLevel(level)
+
+  return(StageLogger(name))
+
+
+def setLogLevel(level):
+
+  # """
+  # level: DEBUG, INFO, WARNING or ERROR (or a logging level number)
+  # sets the level of every pipeline logger in this process and in worker processes started afterwards
+  # """
+
+  import os
+
+  if isinstance(level, int):
+    level = logging.getLevelName(level)
+  level = level.upper()
+
+  os.environ[level_var] = level
+  stageLogger("pipelineLog")
+  logging.getLogger("mitonuc").setLevel(level)
+
+
+class Progress:
+
+  # """
+  # log: logger from stageLogger
+  # total: number of iterations expected, None if not known
+  # label: what is being counted, i.e. the file name and "gene pairs"
+  # every: seconds between reports
+  # call update after each iteration (or batch of iterations) - the count, rate and ETA are logged at INFO at most once
+  # every `every` seconds, so a loop of millions of iterations logs a handful of lines. done logs the final count and time
+  # """
+
+  def __init__(self, log, total=None, label="", every=10.0):
+
+    import time
+
+    self.log = log
+    self.total = total
+    self.label = label
+    self.every = every
+    self.count = 0
+    self.start = time.perf_counter()
+    self.last = self.start
+
+  def update(self, n=1):
+
+    import time
+
+    self.count += n
+    now = time.perf_counter()
+    if now - self.last >= self.every:
+      self.last = now
+      self.log.info(self.message(now))
+
+  def message(self, now):
+
+    elapsed = now - self.start
+    rate = self.count / elapsed if elapsed > 0 else 0
+
+    if self.total == None:
+      return("{}: {} in {:.0f}s, {:.1f}/s".format(self.label, self.count, elapsed, rate))
+
+    eta = (self.total - self.count) / rate if rate > 0 else float("nan")
+    return("{}: {} / {} ({:.1f}%) in {:.0f}s, {:.1f}/s, ETA {:.0f}s".format(self.label, self.count, self.total,
+                                                                        100 * self.count / max(self.total, 1), elapsed, rate, eta))
+
+  def done(self):
+
+    import time
+
+    self.log.info("{}: {} done in {:.1f}s".format(self.label, self.count, time.perf_counter() - self.start))
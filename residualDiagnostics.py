@@ -0,0 +1,111 @@
+# function residualDiagnostics
+# takes in covariate-corrected residual matrices, rows=samples , cols=genes
+# tests the residuals of every gene (or a random subsample of genes) for normality, in parallel chunks of genes
+# outputs a per-gene diagnostics table
+
+
+def shapiroChunk(a):
+
+  # """
+  # a: 2d array, rows=samples, cols=genes
+  # returns a genes x 2 array of shapiro W and p-value for each gene's non-NaN values, NaN for genes with < 3 values
+  # """
+
+  import numpy as np
+  from scipy.stats import shapiro
+
+  out = np.full((a.shape[1], 2), np.nan)
+
+  for j in range(0, a.shape[1]):
+    x = a[:, j][np.logical_not(np.isnan(a[:, j]))]
+    if len(x) >= 3:
+      out[j] = shapiro(x)
+
+  return(out)
+
+
+def residualNormality(residual_df, n_cores=None, n_genes=None, seed=None, chunk_size=500):
+
+  # """
+  # residual_df: residuals DataFrame, rows=samples, cols=genes
+  # n_cores: number of worker processes, default is all cores on the machine
+  # n_genes: test a random subsample of this many genes, default None tests all genes
+  # seed: random seed for the subsample
+  # chunk_size: genes per shapiro task
+  # returns a DataFrame indexed by gene with n_obs, mean, sd, skew, kurtosis (excess), shapiro_W and shapiro_pval
+  # """
+
+  import os
+  import numpy as np
+  import pandas as pd
+  from joblib import Parallel, delayed
+
+  if n_cores == None:
+    n_cores = os.cpu_count()
+
+  genes = residual_df.columns
+  if n_genes != None and n_genes < len(genes):
+    rng = np.random.default_rng(seed)
+    genes = genes[np.sort(rng.choice(len(genes), n_genes, replace=False))]
+
+  df = residual_df[genes]
+  a = df.values.astype(np.float64)
+
+  # moments are vectorised over all genes, only shapiro needs a per-gene call
+  chunks = [(j0, min(j0 + chunk_size, a.shape[1])) for j0 in range(0, a.shape[1], chunk_size)]
+  sw = Parallel(n_jobs=min(n_cores, max(1, len(chunks))))(delayed(shapiroChunk)(a[:, j0:j1]) for j0, j1 in chunks)
+  sw = np.vstack(sw) if len(sw) > 0 else np.zeros((0, 2))
+
+  diag = pd.DataFrame({"n_obs": df.count(),
+                       "mean": df.mean(),
+                       "sd": df.std(),
+                       "skew": df.skew(),
+                       "kurtosis": df.kurt(),
+                       "shapiro_W": sw[:, 0],
+                       "shapiro_pval": sw[:, 1]},
+                      index=genes)
+
+  return(diag)
+
+
+def residualDiagnostics(file_dir="", pattern="_residuals.csv", outdir=None, outlabel="", n_cores=None, n_genes=None, seed=None, out_format="csv"):
+
+  # """
+  # file_dir: directory containing the residual files
+  # pattern: pattern to search for, default is all residual files
+  # outdir: where should the files go, default is file_dir
+  # outlabel: add label to output files
+  # n_cores: number of worker processes, default is all cores on the machine
+  # n_genes: test a random subsample of this many genes per file, default None tests all genes
+  # seed: random seed for the subsample
+  # out_format: output file suffix - csv, parquet, feather or npy. Input format is taken from the file suffix (see matrixIO)
+  # """
+
+  import os
+  from matrixIO import matrixFiles, readMatrix, writeMatrix
+  from pipelineLog import stageLogger
+
+  log = stageLogger("residualDiagnostics")
+
+  if outdir == None:
+    outdir = file_dir
+  outdir = os.path.abspath(outdir)
+
+  # get all file paths
+  file_paths = matrixFiles(file_dir, pattern)
+  log.info("files: %s", file_paths)
+
+  for f in file_paths:
+
+    log.info(f)
+
+    # import df
+    df = readMatrix(file_dir+f) # genes cols, samples rows
+
+    diag = residualNormality(df, n_cores=n_cores, n_genes=n_genes, seed=seed)
+
+    # % of tested genes whose residuals depart significantly from normal
+    log.info("%.2f%% of genes have significantly non-normal residuals (shapiro p <= 0.05)", (diag['shapiro_pval'] <= 0.05).mean() * 100)
+
+    # write out
+    writeMatrix(diag, os.path.join(outdir, f.replace(pattern, '') + "_" + outlabel + "_residual_diagnostics." + out_format))
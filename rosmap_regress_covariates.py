@@ -1,5 +1,85 @@
 
-def rosmap_regress_covariates(tpm_dir, pattern, meta_path, out_dir=None, outlabel=""):  
+# covs to regress out
+rosmap_cov_names = ['pmi', 'RIN', 'library_batch', 'race', 'msex', 'study', 'age_death', 
+'age_at_visit_max', 'Unknown', 'InNeurons', 'Oligodendrocytes', 'Endothelial', 'Microglia', 
+'Astrocytes', 'OPC', 'ExNeurons']
+
+
+def rosmapDesign(samples, meta_path, cache_dir=None):
+  
+  """
+  :param samples: ROS/MAP sample ids of the samples in the expression matrix, in row order
+  :param meta_path: path to the preprocessed ROS/MAP metadata file
+  :param cache_dir: optional directory to persist the design in, see cachedDesign
+  :return: design key and design dict from cachedDesign - index holds the sample ids in the row order of the prepared covs
+  """
+  
+  import pandas as pd
+  from sklearn.preprocessing import StandardScaler
+  from batchedOLS import designKey, cachedDesign
+  from pipelineLog import stageLogger
+  
+  log = stageLogger("rosmap_regress_covariates")
+  
+  def buildDesign():
+    
+    """
+    reads, subsets and scales the metadata for the samples in this tpm file
+    returns the sample order and the prepared covariates
+    """
+    
+    # importing metadata file
+    meta = pd.read_csv(meta_path, encoding="utf-8", engine="python", index_col=0, header=0)
+    
+    # subset metadata
+    if meta.shape[0] != len(samples):
+      meta = meta[meta.index.isin(samples)]
+    
+    # filter for covs to regress out
+    meta = meta[rosmap_cov_names]
+    
+    # scaling the age cols
+    scaler = StandardScaler()
+    scaler.fit(meta.loc[:,['age_death', 'age_at_visit_max']])
+    meta_transformed = pd.DataFrame(scaler.transform(meta.loc[:,['age_death', 'age_at_visit_max']]))
+    meta_transformed.index = meta.index
+    meta_transformed.columns = ['age_death', 'age_at_visit_max']
+    
+    # replacing unscaled cols with scaled cols
+    meta.loc[:,['age_death', 'age_at_visit_max']] = meta_transformed.loc[:,['age_death', 'age_at_visit_max']]
+    
+    # setting correct datatypes
+    meta['library_batch'] = meta['library_batch'].astype(int)
+    
+    log.debug("covariates\n%s", meta.head(n=10))
+    
+    return(meta.index, meta)
+  
+  # covs are matched to samples by position, so the key keeps the sample order
+  design_key = designKey(list(samples), rosmap_cov_names, [meta_path])
+  
+  return(design_key, cachedDesign(design_key, buildDesign, cache_dir))
+
+
+def rosmapSampleIds(samples):
+  
+  """
+  :param samples: sample ids as read from a ROS/MAP expression file
+  :return: the ids with the preceding X added by R (make.names) removed
+  """
+  
+  import pandas as pd
+  
+  samples = pd.Index(samples)
+  if 'X' in samples[0]:
+    samples = pd.Index(samples.str.extract(r'X(.*)').iloc[:,0].tolist())
+  
+  return(samples)
+
+
+def rosmap_regress_covariates(tpm_dir, pattern, meta_path, out_dir=None, outlabel="", cache_dir=None,
+                              diagnostics=True, n_cores=None, diagnostic_genes=None, out_format="csv", incremental=False,
+                              report_dir=None, profile=False):  
   
   """
   :param tpm_dir: directory containing the TPM files - genes are cols, samples are rows
@@ -8,6 +88,16 @@ def rosmap_regress_covariates(tpm_dir, pattern, meta_path, out_dir=None, outlabe
   :param pheno_path: path to phenotype file, downloadable from GTEx, gives age, sex, COD associated with patient samples
   :param out_dir: directory to save residual files into
   :param outlabel: optional label to add to output files
+  :param cache_dir: optional directory to persist prepared covariates and their factorisations in, keyed by sample set and
+  covariate list - later runs over the same samples skip covariate setup. They are always cached in memory for this session
+  :param diagnostics: test residual normality per gene after the regression and write a _residual_diagnostics.csv table
+  :param n_cores: number of worker processes for the diagnostics, default is all cores on the machine
+  :param diagnostic_genes: only test a random subsample of this many genes, default None tests all genes
+  :param out_format: output file suffix - csv, parquet, feather or npy. Input format is taken from the file suffix (see matrixIO)
+  :param incremental: skip files whose input, metadata, parameters and code are unchanged since the last run, keeping their
+  outputs (see stageCache)
+  :param report_dir: record each file's time, memory, bytes and genes a second in a run report in this directory (see runReport)
+  :param profile: with report_dir, also keep a cProfile of each file
   :return: residuals df
   
   corrects out the following covars: ['pmi', 'RIN', 'library_batch', 'race', 'msex', 'study', 'age_death', 'age_at_visit_max']
@@ -19,148 +109,97 @@ def rosmap_regress_covariates(tpm_dir, pattern, meta_path, out_dir=None, outlabe
   # import libs
   import pandas as pd
   import re
-  import numpy as np
-  from sklearn import preprocessing
-  from sklearn.preprocessing import StandardScaler
-  from sklearn.linear_model import LinearRegression
-  from scipy.stats import shapiro
   import os
-  #from tqdm import tqdm, tqdm_notebook
+  from batchedOLS import batchedResiduals, saveDesign
+  from residualDiagnostics import residualNormality
+  from matrixIO import matrixFiles, matrixPaths, readMatrix, writeMatrix
+  from stageCache import stageManifest, saveManifest
+  from runReport import newRunId, stageReport, writeRunReport
+  from pipelineLog import stageLogger
   
-  # get full file paths and file names
-  file_names = [file for file in os.listdir(tpm_dir) if pattern in file]
+  log = stageLogger("rosmap_regress_covariates")
+  run = newRunId()
+  
+  out_dir = os.path.abspath(out_dir)
   
-  print(file_names)
+  # get full file paths and file names
+  file_names = matrixFiles(tpm_dir, pattern)
   
-  print(len(file_names))
+  log.info("%d files: %s", len(file_names), file_names)
 
   for i in range(0, len(file_names)): 
     
     # get file name
     fn = re.sub("__.*", "", file_names[i])
-    print(i, file_names[i])
-    
-    # prepping tpm file --------------------------------------------------------------------------------
+    log.info("%d %s", i, file_names[i])
+    
+    out_paths = matrixPaths(os.path.join(out_dir, fn + "_" + outlabel + "_residuals." + out_format))
+    if diagnostics == True:
+      out_paths = out_paths + matrixPaths(os.path.join(out_dir, fn + "_" + outlabel + "_residual_diagnostics." + out_format))
+    
+    if incremental == True:
+      up_to_date, manifest = stageManifest(out_dir, "rosmap_regress_covariates", file_names[i], [tpm_dir+file_names[i], meta_path],
+                                           {"pattern": pattern, "outlabel": outlabel, "covariates": rosmap_cov_names, "diagnostics": diagnostics,
+                                            "diagnostic_genes": diagnostic_genes, "out_format": out_format},
+                                           ["rosmap_regress_covariates", "batchedOLS", "residualDiagnostics", "matrixIO"], out_paths)
+      if up_to_date:
+        log.info("unchanged since the last run - keeping %s", out_paths[0])
+        continue
+    
+    with stageReport(report_dir, "rosmap_regress_covariates", file_names[i], [tpm_dir+file_names[i]], out_paths, profile, run) as rec:
+
+      # prepping tpm file --------------------------------------------------------------------------------
     
-    TPM = pd.read_csv(open(tpm_dir+file_names[i]), encoding="utf-8", engine='python', index_col=0, header=0)
+      TPM = readMatrix(tpm_dir+file_names[i])
   
-    if 'ENS' in TPM.index[0]:
-      TPM = TPM.transpose()
+      if 'ENS' in TPM.index[0]:
+        TPM = TPM.transpose()
 
-    # clean preceding X from sample 
-    if 'X' in TPM.index[0]:
-      TPM.index = TPM.index.str.extract(r'X(.*)').iloc[:,0].tolist()
+      # clean preceding X from sample 
+      TPM.index = rosmapSampleIds(TPM.index)
     
-    # prepping metadata file --------------------------------------------------------------------------------
-
-    # importing metadata file
-    meta = pd.read_csv(open(meta_path),encoding="utf-8",engine='python',index_col=0,header=0)
+      # prepping metadata file --------------------------------------------------------------------------------
     
-    # subset metadata
-    if meta.shape[0] != TPM.shape[0]:
-      meta = meta[meta.index.isin(TPM.index)]
+      # reuse the prepared covariates if this sample set has been seen before
+      design_key, design = rosmapDesign(TPM.index, meta_path, cache_dir)
+      meta = design["covs"]
     
-    # filter for covs to regress out
-    meta = meta = meta[['pmi', 'RIN', 'library_batch', 'race', 'msex', 'study', 'age_death', 
-    'age_at_visit_max', 'Unknown', 'InNeurons', 'Oligodendrocytes', 'Endothelial', 'Microglia', 
-    'Astrocytes', 'OPC', 'ExNeurons']]
+      log.debug("covariates %s TPM %s", meta.shape, TPM.shape)
+      rec["samples"], rec["genes"] = TPM.shape
       
-    # scaling the age cols
-    scaler = StandardScaler()
-    scaler.fit(meta.loc[:,['age_death', 'age_at_visit_max']])
-    meta_transformed = pd.DataFrame(scaler.transform(meta.loc[:,['age_death', 'age_at_visit_max']]))
-    meta_transformed.index = meta.index
-    meta_transformed.columns = ['age_death', 'age_at_visit_max']
-    meta_transformed.head()  
+      # performing mlr across genes --------------------------------------------------------------------------------
     
-    # replacing unscaled cols with scaled cols
-    meta.loc[:,['age_death', 'age_at_visit_max']] = meta_transformed.loc[:,['age_death', 'age_at_visit_max']]
-      
-    # setting correct datatypes
-    meta['library_batch'] = meta['library_batch'].astype(int)
+      # regressing covs out of all genes at once - genes with no NaNs share one least-squares solve,
+      # masked genes are solved in groups with the same NaN pattern, reusing cached factorisations
+      residual_df = pd.DataFrame(batchedResiduals(TPM.values, meta.values, factors=design["factors"]), 
+                              index = TPM.index, 
+                              columns = TPM.columns)
     
-    print(meta.head(n=10))
-  
-    print(meta.shape)
-    print(TPM.shape)
-      
-    # performing mlr across genes --------------------------------------------------------------------------------
+      if cache_dir != None:
+        saveDesign(design_key, design, cache_dir)
     
-    # defining empty array to hold residual tpm values
-    residual_df = pd.DataFrame(np.zeros(shape=(len(TPM.index.values), len(TPM.columns.values))), 
-                            index = TPM.index, 
-                            columns = TPM.columns)
-
-    shapiro_df = pd.DataFrame(np.zeros(shape=(len(TPM.columns.values), 1)), 
-                            index = TPM.columns, 
-                            columns = ['shapiro_pval'])
-                            
-    # initiating the lm
-    lm = LinearRegression()
+      # export output --------------------------------------------------------------------------------
 
-    def regress_covs_from_gene(y):
-
-      """
-      function to regress out covariates from each gene - apply over gene axis
-      inserts residuals into predefined residual dataframe with correct row (sample id) and col (gene) labels
-      """
-      gene_name = y.name
-      
-      # predictors
-      X = meta
-      
-      # response var
-      y = np.array(y)
-      
-      # get list of locations where gene has nan values
-      nan_locs = np.where(np.isnan(y))[0]
-      
-      # masking NAs
-      finiteYmask = np.isfinite(y)
-      
-      # cleaning NAs from predictors and response vars
-      Yclean = y[finiteYmask]
-      Xclean = X[finiteYmask]
-      
-      # fit the model 
-      lm.fit(Xclean, Yclean)
-      
-      # make predictions from covs - i.e. expected TPMs
-      predictions = lm.predict(Xclean)
-      
-      # reinsert removed nan values one-by-one to make y and predictions the same length
-      for i in range(0, len(nan_locs)):
-        predictions = np.insert(predictions, nan_locs[i], np.nan)
+      # export filtered file
+      writeMatrix(residual_df, out_paths[0])
+    
+      # residual diagnostics --------------------------------------------------------------------------------
+    
+      if diagnostics == True:
       
-      # residuals = observations - predictions
-      residuals = y - predictions
+        # shapiro test per gene, in parallel chunks of genes
+        diag = residualNormality(residual_df, n_cores=n_cores, n_genes=diagnostic_genes)
       
-      # adding residuals to residual df
-      residual_df[gene_name] = residuals
+        # % of tested genes whose residuals depart significantly from normal
+        sig_nonnorm_gene_count = (diag['shapiro_pval'] <= 0.05).mean() * 100
+        log.info("%.2f%% of genes have significantly non-normal residuals (shapiro p <= 0.05)", sig_nonnorm_gene_count)
       
-      # # cleaning residuals of NaNs for shapiro fn. 
-      # shapiro_resids = residuals[np.logical_not(np.isnan(residuals))]
-      # 
-      # # get shapiro pvals and add to shapiro_df
-      # shapiro_pval = shapiro(shapiro_resids)[1]
-      # shapiro_df.loc[gene_name, 'shapiro_pval'] = shapiro_pval
-    
-    # import progress bar
-    from tqdm import tqdm, tqdm_notebook
-    tqdm.pandas(tqdm_notebook)
-
-    # applying regress_covs_from_gene fn. across genes
-    TPM.progress_apply(regress_covs_from_gene, axis=0);
+        writeMatrix(diag, os.path.join(out_dir, fn + "_" + outlabel + "_residual_diagnostics." + out_format))
     
-    # # find % genes with normally distributed residuals
-    # sig_norm_gene_count = (int(shapiro_df[shapiro_df <= 0.05].count()) / len(shapiro_df.index.values)) * 100
-    # print(round(sig_norm_gene_count, 2), "% of gene residuals have a significantly normal distribution")
-
-    # export output --------------------------------------------------------------------------------
-
-    # export filtered file
-    os.chdir(out_dir)
-    residual_df.to_csv(fn + "_" + outlabel + "_residuals.csv", index=True, header=True)
+    if incremental == True:
+      saveManifest(out_dir, "rosmap_regress_covariates", file_names[i], manifest)
+  
+  writeRunReport(report_dir, run)
         
       
                             
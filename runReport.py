@@ -0,0 +1,186 @@
+# functions to instrument the pipeline stages
+# with a report_dir, each stage records one row per file it processes: wall and cpu time, peak RSS, bytes read and
+# written, and genes (or gene pairs) a second. Rows are appended to report_dir/run_report.jsonl by whichever process runs
+# the file, so files run in joblib or scheduler workers report too, and writeRunReport collects them into
+# run_report.json and run_report.csv. Each stage or pipeline call is one run with its own id (see newRunId) - the jsonl
+# keeps the rows of every run, the json and csv only those of the run that wrote them. profile=True also runs each
+# file under cProfile, keeping its stats in report_dir/profiles for snakeviz or pstats
+# without a report_dir nothing is measured
+
+
+def peakRss():
+
+  # """
+  # returns the peak resident memory of this process in bytes since the last resetPeakRss - read from
+  # /proc/self/status on linux, else the lifetime peak from getrusage
+  # """
+
+  import resource
+
+  try:
+    with open("/proc/self/status") as f:
+      for line in f:
+        if line.startswith("VmHWM:"):
+          return(int(line.split()[1]) * 1024)
+  except OSError:
+    pass
+
+  # ru_maxrss is in KB on linux, bytes on macOS
+  return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+def resetPeakRss():
+
+  # """
+  # resets the peak resident memory of this process to its current size, where the kernel allows it, so peakRss
+  # measures one file rather than everything the worker process ran before
+  # """
+
+  try:
+    with open("/proc/self/clear_refs", "w") as f:
+      f.write("5")
+  except OSError:
+    pass
+
+
+def pathBytes(paths):
+
+  # """
+  # paths: files
+  # returns their total size in bytes, ignoring missing files
+  # """
+
+  import os
+
+  return(int(sum(os.path.getsize(p) for p in paths if p != None and os.path.exists(p))))
+
+
+def newRunId():
+
+  # """
+  # returns an id for one call of a stage or pipeline - its start time and a random suffix, i.e. 20261018-071409-3fa2b1c0.
+  # The stage passes it to stageReport for each file and to writeRunReport, so reruns into the same report_dir are kept apart
+  # """
+
+  import time
+  import uuid
+
+  return(time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8])
+
+
+def stageReport(report_dir, stage, name, in_paths=(), out_paths=(), profile=False, run=None):
+
+  # """
+  # report_dir: directory of the run report, None measures nothing
+  # stage: stage name, i.e. the stage function
+  # name: input file name, or any name identifying the unit of work
+  # in_paths: files the stage reads for this unit, their size is bytes_read
+  # out_paths: files the stage writes for this unit, their size once written is bytes_written
+  # profile: run the unit under cProfile and write its stats to report_dir/profiles/<stage>__<name>.prof
+  # run: id of the run the unit belongs to, from newRunId
+  # returns a context manager giving a dict - the stage adds counts of what it processed to it (samples, genes, pairs),
+  # which become genes_per_s and pairs_per_s in the report
+  # """
+
+  import contextlib
+
+  @contextlib.contextmanager
+  def record():
+
+    import os
+    import time
+    import json
+    import resource
+    import cProfile
+
+    if report_dir == None:
+      yield({})
+      return
+
+    rec = {}
+    resetPeakRss()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start, cpu, wall = time.time(), time.process_time(), time.perf_counter()
+
+    profiler = None
+    if profile == True:
+      profiler = cProfile.Profile()
+      profiler.enable()
+
+    error = None
+    try:
+      yield(rec)
+    except BaseException as e:
+      error = repr(e)
+      raise
+    finally:
+
+      if profiler != None:
+        profiler.disable()
+
+      wall = time.perf_counter() - wall
+      cpu = time.process_time() - cpu
+      children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+      cpu += (children_after.ru_utime - children.ru_utime) + (children_after.ru_stime - children.ru_stime)
+
+      row = {"run": run, "stage": stage, "file": name, "pid": os.getpid(), "start": start, "wall_s": wall, "cpu_s": cpu,
+             "peak_rss_mb": peakRss() / 2**20, "bytes_read": pathBytes(in_paths), "bytes_written": pathBytes(out_paths)}
+      row.update(rec)
+      if "genes" in rec:
+        row["genes_per_s"] = rec["genes"] / wall if wall > 0 else None
+      if "pairs" in rec:
+        row["pairs_per_s"] = rec["pairs"] / wall if wall > 0 else None
+      row["error"] = error
+
+      if profiler != None:
+        os.makedirs(os.path.join(report_dir, "profiles"), exist_ok=True)
+        row["profile"] = os.path.join(report_dir, "profiles", stage + "__" + name + ".prof")
+        profiler.dump_stats(row["profile"])
+
+      # one line per write, appends from several processes do not interleave
+      os.makedirs(report_dir, exist_ok=True)
+      with open(os.path.join(report_dir, "run_report.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(row, default=str) + "\n")
+
+  return(record())
+
+
+def writeRunReport(report_dir, run=None):
+
+  # """
+  # report_dir: directory of the run report, None does nothing
+  # run: id of the run to report, from newRunId. Default None reports every row in run_report.jsonl
+  # collects the run's rows into run_report.json and run_report.csv and logs the time and peak memory
+  # of each stage - stages call it once their files are done. Returns the rows as a DataFrame
+  # """
+
+  import os
+  import json
+  import pandas as pd
+  from pipelineLog import stageLogger
+
+  log = stageLogger("runReport")
+
+  if report_dir == None or not os.path.exists(os.path.join(report_dir, "run_report.jsonl")):
+    return(None)
+
+  with open(os.path.join(report_dir, "run_report.jsonl"), encoding="utf-8") as f:
+    rows = [json.loads(line) for line in f if line.strip() != ""]
+
+  # rows of earlier runs into the same report_dir stay in the jsonl only
+  if run != None:
+    rows = [row for row in rows if row.get("run") == run]
+  if len(rows) == 0:
+    return(None)
+
+  with open(os.path.join(report_dir, "run_report.json"), "w", encoding="utf-8") as f:
+    json.dump(rows, f, indent=1)
+
+  report = pd.DataFrame(rows)
+  report.to_csv(os.path.join(report_dir, "run_report.csv"), index=False)
+
+  summary = report.groupby("stage", sort=False).agg(files=("file", "size"), wall_s=("wall_s", "sum"), cpu_s=("cpu_s", "sum"),
+                                                   peak_rss_mb=("peak_rss_mb", "max")).round(2)
+  log.info("run report %s\n%s", os.path.join(report_dir, "run_report.csv"), summary)
+
+  return(report)
@@ -0,0 +1,217 @@
+# function runScheduledPipeline
+# runs filter -> log10 median normalise -> mask outliers -> regress covariates -> mt-nuc corrs for all tissues as one
+# graph of (tissue, stage) tasks under a global core and memory budget (see dagScheduler), so tissue A can be
+# correlating while tissue B is still regressing
+# stages hand their output to the next one as a .npy file (memory-mapped on read), or as the usual intermediate
+# files with write_intermediates=True
+# takes in a matrix of TPMs, rows=samples , cols=genes
+
+
+# stages in run order
+pipeline_stages = ["filter", "normalise", "mask", "regress", "corrs"]
+
+# rough peak memory of each stage in copies of the float64 matrix - the matrix read in, the stage's working arrays
+# and its output
+stage_copies = {"filter": 3, "normalise": 4, "mask": 3, "regress": 4, "corrs": 3}
+
+
+def stageMemory(stage, n_rows, n_cols, all_corrs=False):
+
+  # """
+  # stage: stage name, one of pipeline_stages
+  # n_rows, n_cols: shape of the tissue's input matrix
+  # all_corrs: correlate all gene pairs rather than the 13 mt genes against all genes
+  # returns the estimated peak memory of the stage in bytes
+  # """
+
+  from genCorrs import mito_genes
+
+  mem = stage_copies[stage] * n_rows * n_cols * 8
+
+  # corrs, pvals and nobs of every mt gene (or gene) against every gene
+  if stage == "corrs":
+    n_genes = max(n_rows, n_cols)
+    mem += 3 * (n_genes if all_corrs == True else len(mito_genes)) * n_genes * 8
+
+  return(mem)
+
+
+def pipelineStage(stage, in_path, out_paths, opts, n_threads=1):
+
+  # """
+  # stage: stage name, one of pipeline_stages
+  # in_path: the tissue's TPM file for filter, the previous stage's output for the others
+  # out_paths: dict of output name -> path the stage writes, see runScheduledPipeline
+  # opts: dict of the pipeline options the stage needs (filesep, med_norm, regress, meta_path, pheno_path, cache_dir, meta, pheno,
+  # method, all_corrs, shared_dir, report_dir, profile, run)
+  # n_threads: threads for the masking and correlation blocks, set by runDag from the task's cores
+  # runs one stage of one tissue in a dagScheduler worker
+  # """
+
+  import os
+  from fusedPipeline import readTissue, tissueRegressFn, filterStage, normaliseStage, maskStage, corrStage
+  from labelledMatrix import LabelledMatrix
+  from matrixIO import matrixPaths, readMatrix, writeMatrix
+  from runReport import stageReport
+  from pipelineLog import stageLogger
+
+  log = stageLogger("scheduledPipeline")
+
+  out_files = [p for k in out_paths for p in matrixPaths(out_paths[k])]
+  with stageReport(opts["report_dir"], stage, os.path.basename(in_path), [in_path], out_files, opts["profile"], opts["run"]) as rec:
+
+    log.info("%s %s", stage, in_path)
+
+    if stage == "filter":
+      m = filterStage(readTissue(in_path, opts["filesep"]))
+      rec["samples"], rec["genes"] = m.shape
+      writeMatrix(m.toDf(), out_paths["filtered"])
+      return(m.shape)
+
+    m = LabelledMatrix.fromDf(readMatrix(in_path, mmap=True))
+    rec["samples"], rec["genes"] = m.shape
+
+    if stage == "normalise":
+      m = normaliseStage(m, med_norm=opts["med_norm"])
+      writeMatrix(m.toDf(), out_paths["normalised"])
+
+    elif stage == "mask":
+      m, counts = maskStage(m, n_threads, opts["shared_dir"])
+      log.info("masked: %d genes with masked values: %d", counts['n_masked'].sum(), (counts['n_masked'] > 0).sum())
+      writeMatrix(m.toDf(), out_paths["masked"])
+      if "mask_counts" in out_paths:
+        writeMatrix(counts, out_paths["mask_counts"])
+
+    elif stage == "regress":
+      regress_fn = tissueRegressFn(opts["regress"], opts["meta_path"], opts["cache_dir"], opts["meta"], opts["pheno"], opts["pheno_path"])
+      m = regress_fn(m)
+      writeMatrix(m.toDf(), out_paths["residuals"])
+
+    else:
+      out = corrStage(m, method=opts["method"], all_corrs=opts["all_corrs"], n_threads=n_threads, shared_dir=opts["shared_dir"])
+      rec["pairs"] = out["corrs"].shape[0] * out["corrs"].shape[1]
+      for k in out:
+        writeMatrix(out[k].toDf(), out_paths[k])
+
+    return(m.shape)
+
+
+def runScheduledPipeline(file_dir="", pattern=".csv", filesep=",", outdir=None, outlabel="", regress=None, meta_path=None, pheno_path=None,
+                         cache_dir=None, method="pearson", all_corrs=False, med_norm=True, write_intermediates=False, max_cores=None,
+                         max_mem=None, block_cores=None, out_format="csv", shared_dir=None, report_dir=None, profile=False):
+
+  # """
+  # file_dir: directory containing the TPM files
+  # pattern: pattern to search for, default is all .csv files
+  # filesep: file separating char of text input, default is comma. Input format is taken from the file suffix (see matrixIO)
+  # outdir: where should the files go, default is file_dir
+  # outlabel: add label to output files
+  # regress: covariates to regress out - gtex (needs meta_path and pheno_path), rosmap (needs meta_path) or None to skip
+  # meta_path: GTEx sample attributes file or preprocessed ROS/MAP metadata file
+  # pheno_path: GTEx phenotype file
+  # cache_dir: optional directory to persist parsed metadata and covariate designs in, see gtex_regress_covariates
+  # method: correlation method - spearman or pearson
+  # all_corrs: correlate all gene pairs rather than the 13 mt genes against all genes
+  # med_norm: can disable median normalisation by setting this to False
+  # write_intermediates: hand each stage's output on as the file the file-based stage would write (_0filtered,
+  # _log10_mediannorm_TPM, _masked_outliers + _mask_counts, _residuals) and keep them. Default False hands them on as
+  # .npy files in a temporary dir inside outdir, removed once all tasks are done
+  # max_cores: total cores shared by all running tasks, default is all cores on the machine
+  # max_mem: total bytes shared by the running tasks' memory estimates (see stageMemory), default is the machine's memory
+  # block_cores: cores of each masking, regression and correlation task, default is an even share of max_cores per file.
+  # Filtering and normalising get one core
+  # out_format: output file suffix - csv, parquet, feather or npy
+  # shared_dir: directory for memory-mapped copies of each matrix for the masking and correlation blocks, see fusedPipeline
+  # report_dir: record each task's time, memory, bytes and genes a second in a run report in this directory (see runReport)
+  # profile: with report_dir, also keep a cProfile of each task
+  # outputs the same _corrs, _pvals and _nobs matrices as runPipeline
+  # """
+
+  import os
+  import shutil
+  import tempfile
+  from coreBudget import splitCores
+  from dagScheduler import Task, runDag
+  from matrixIO import matrixFiles, matrixShape
+  from runReport import newRunId, writeRunReport
+  from pipelineLog import stageLogger
+
+  log = stageLogger("scheduledPipeline")
+  run = newRunId()
+
+  if outdir == None:
+    outdir = file_dir
+  outdir = os.path.abspath(outdir)
+
+  if max_cores == None:
+    max_cores = os.cpu_count()
+
+  # metadata is parsed once and shared by all files
+  meta, pheno = None, None
+  if regress == "gtex":
+    from gtexMetadata import loadGtexMeta
+    meta, pheno = loadGtexMeta(meta_path, pheno_path, cache_dir)
+
+  # get all file paths
+  file_paths = matrixFiles(file_dir, pattern)
+  log.info("files: %s", file_paths)
+
+  if block_cores == None:
+    block_cores = splitCores(len(file_paths), max_cores)[1]
+
+  opts = {"filesep": filesep, "med_norm": med_norm, "regress": regress, "meta_path": meta_path, "pheno_path": pheno_path, "cache_dir": cache_dir,
+          "meta": meta, "pheno": pheno, "method": method, "all_corrs": all_corrs, "shared_dir": shared_dir,
+          "report_dir": report_dir, "profile": profile, "run": run}
+
+  # output labels of the intermediates, as the file-based stages name them
+  norm_label = "log10_mediannorm_TPM" if med_norm == True else "log10_norm_TPM"
+  labels = {"filtered": "0filtered", "normalised": norm_label, "masked": "masked_outliers", "residuals": "residuals"}
+
+  stages = [s for s in pipeline_stages if regress != None or s != "regress"]
+  stage_outs = {"filter": ["filtered"], "normalise": ["normalised"], "mask": ["masked"], "regress": ["residuals"],
+                "corrs": ["corrs", "pvals", "nobs"]}
+
+  work_dir = None
+  if write_intermediates == False:
+    work_dir = tempfile.mkdtemp(prefix=".scheduled_", dir=outdir)
+
+  # tasks are listed tissue by tissue, so a tissue's later stages start before the next tissue's earlier ones
+  tasks = []
+  for f in file_paths:
+
+    fn = f.replace(pattern, '')
+    prefix = os.path.join(outdir, fn + "_" + outlabel + "_")
+    in_path = os.path.join(file_dir, f)
+    n_rows, n_cols = matrixShape(in_path, sep=filesep)
+
+    out_paths = {k: prefix + method + "_" + k + "." + out_format for k in ["corrs", "pvals", "nobs"]}
+    for k in labels:
+      if write_intermediates == True:
+        out_paths[k] = prefix + labels[k] + "." + out_format
+      else:
+        out_paths[k] = os.path.join(work_dir, fn + "_" + labels[k] + ".npy")
+    if write_intermediates == True:
+      out_paths["mask_counts"] = prefix + "mask_counts." + out_format
+
+    prev = None
+    for stage in stages:
+      stage_paths = {k: out_paths[k] for k in stage_outs[stage]}
+      if stage == "mask" and "mask_counts" in out_paths:
+        stage_paths["mask_counts"] = out_paths["mask_counts"]
+
+      cores = 1 if stage == "filter" or stage == "normalise" else block_cores
+      tasks.append(Task((fn, stage), pipelineStage,
+                        args=(stage, in_path, stage_paths, opts),
+                        deps=[] if prev == None else [(fn, prev)],
+                        cores=cores,
+                        mem=stageMemory(stage, n_rows, n_cols, all_corrs)))
+      in_path = out_paths[stage_outs[stage][0]]
+      prev = stage
+
+  try:
+    runDag(tasks, max_cores=max_cores, max_mem=max_mem)
+  finally:
+    if work_dir != None:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  writeRunReport(report_dir, run)
@@ -0,0 +1,134 @@
+# functions for incremental re-runs of the pipeline stages
+# each stage records a manifest per input file next to its outputs - the checksums of the inputs, the stage parameters
+# and the version of the stage code. A later run that finds the same manifest, with the outputs still in place,
+# skips that file and keeps its outputs, so only new or changed files are processed
+
+
+def fileChecksum(path):
+
+  # """
+  # path: file to hash
+  # returns the sha1 hex digest of the file contents
+  # """
+
+  import hashlib
+
+  h = hashlib.sha1()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(1 << 20), b""):
+      h.update(block)
+
+  return(h.hexdigest())
+
+
+def fileState(path, known=None):
+
+  # """
+  # path: file to describe
+  # known: the state recorded for path by an earlier manifest, if any - its checksum is reused while the file's
+  # size and modification time are unchanged, so unchanged inputs are not rehashed
+  # returns a dict of size, mtime and sha1
+  # """
+
+  import os
+
+  st = os.stat(path)
+  if known != None and known["size"] == st.st_size and known["mtime"] == st.st_mtime_ns:
+    return(known)
+
+  return({"size": st.st_size, "mtime": st.st_mtime_ns, "sha1": fileChecksum(path)})
+
+
+def codeVersion(modules):
+
+  # """
+  # modules: names of the modules a stage's outputs depend on
+  # returns a hash of their source files
+  # """
+
+  import hashlib
+  import importlib
+
+  h = hashlib.sha1()
+  for name in sorted(modules):
+    with open(importlib.import_module(name).__file__, "rb") as f:
+      h.update(f.read())
+
+  return(h.hexdigest())
+
+
+def manifestPath(outdir, stage, name):
+
+  # """
+  # outdir: output directory of the stage
+  # stage: stage name
+  # name: input file name, or any name identifying the unit of work
+  # returns the path of the manifest - manifests are kept in a .manifests dir inside outdir
+  # """
+
+  import os
+
+  return(os.path.join(outdir, ".manifests", stage + "__" + name + ".json"))
+
+
+def stageManifest(outdir, stage, name, in_paths, params, modules, out_paths):
+
+  # """
+  # outdir: output directory of the stage
+  # stage: stage name
+  # name: input file name, or any name identifying the unit of work
+  # in_paths: every file the outputs are computed from, i.e. the input matrix and metadata files
+  # params: dict of the parameters that change the outputs (pattern, method, outlabel, covariates ...), must be json-able
+  # modules: names of the modules whose code the outputs depend on
+  # out_paths: every file the stage writes for this unit
+  # returns (up_to_date, manifest) - up_to_date is True when the recorded manifest has the same input checksums,
+  # parameters and code version and all outputs are still as written. Pass the manifest to saveManifest once the
+  # outputs are written
+  # """
+
+  import os
+  import json
+
+  path = manifestPath(outdir, stage, name)
+  old = None
+  if os.path.exists(path):
+    with open(path, encoding="utf-8") as f:
+      old = json.load(f)
+
+  known = {} if old == None else old["inputs"]
+  manifest = {"inputs": {os.path.abspath(p): fileState(p, known.get(os.path.abspath(p))) for p in in_paths},
+              "params": json.loads(json.dumps(params, sort_keys=True, default=str)),
+              "code": codeVersion(modules),
+              "outputs": {os.path.abspath(p): None for p in out_paths}}
+
+  if old == None:
+    return(False, manifest)
+
+  same_inputs = {p: old["inputs"][p]["sha1"] for p in old["inputs"]} == {p: manifest["inputs"][p]["sha1"] for p in manifest["inputs"]}
+  same_outputs = set(old["outputs"]) == set(manifest["outputs"]) and all(os.path.exists(p) and
+                 [os.stat(p).st_size, os.stat(p).st_mtime_ns] == old["outputs"][p] for p in old["outputs"])
+
+  up_to_date = same_inputs and old["params"] == manifest["params"] and old["code"] == manifest["code"] and same_outputs
+
+  return(up_to_date, manifest)
+
+
+def saveManifest(outdir, stage, name, manifest):
+
+  # """
+  # outdir: output directory of the stage
+  # stage: stage name
+  # name: input file name, or any name identifying the unit of work
+  # manifest: manifest from stageManifest - the size and modification time of the outputs is recorded now
+  # """
+
+  import os
+  import json
+
+  for p in manifest["outputs"]:
+    manifest["outputs"][p] = [os.stat(p).st_size, os.stat(p).st_mtime_ns]
+
+  path = manifestPath(outdir, stage, name)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, "w", encoding="utf-8") as f:
+    json.dump(manifest, f, indent=1)
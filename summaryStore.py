@@ -0,0 +1,239 @@
+# function buildSummaryStore and class SummaryStore
+# indexed store of the corr summary table for fast lookups - one parquet partition per mt gene, sorted by nuc gene
+# in small row groups, plus an index.json of the partitions and the corr and pval col of each tissue
+# index.json also maps each corr / pval file of the table to its tissue
+# queries open only the partitions of the requested mt gene and, through the sorted row groups, only the part
+# holding the requested nuc gene, so a gene's rows are fetched without scanning the table
+# needs pyarrow
+
+
+def summaryChunks(path, chunk_rows=1000000):
+
+  # """
+  # path: summary table from genCorrSummaryTable or streamCorrSummaryTable - .parquet, .feather or .csv/.tsv
+  # chunk_rows: rows per chunk
+  # yields the mt_gene, nuc_gene and value cols of the table chunk by chunk, without the index col
+  # """
+
+  import pandas as pd
+  from matrixIO import matrixFormat
+
+  fmt = matrixFormat(path)
+  index_cols = ["index", "__index_level_0__"]
+
+  if fmt == "parquet":
+    import pyarrow.parquet as pq
+    table = pq.ParquetFile(path)
+    cols = [c for c in table.schema_arrow.names if c not in index_cols]
+    for batch in table.iter_batches(batch_size=chunk_rows, columns=cols):
+      yield(batch.to_pandas())
+
+  elif fmt == "feather":
+    import pyarrow as pa
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    cols = [c for c in reader.schema.names if c not in index_cols]
+    for i in range(reader.num_record_batches):
+      batch = reader.get_batch(i).select(cols)
+      for r0 in range(0, batch.num_rows, chunk_rows):
+        yield(batch.slice(r0, chunk_rows).to_pandas())
+
+  elif fmt == "csv" or fmt == "tsv":
+    sep = "," if fmt == "csv" else "\t"
+    for chunk in pd.read_csv(path, sep=sep, encoding="utf-8", index_col=0, chunksize=chunk_rows):
+      yield(chunk.reset_index(drop=True))
+
+  else:
+    raise ValueError("the summary table has gene name cols, it is never .npy")
+
+
+def summaryColumns(cols):
+
+  # """
+  # cols: value cols of the summary table, the corr or pval file name + corr / pval (or an adjusted pval kind)
+  # returns a dict of col -> {"file": file name, "tissue": tissue, "kind": corr, pval or the adjusted kind}. genCorrs
+  # names its files tissue_outlabel_method_corrs / _pvals, so the tissue is the file name without its suffix, the
+  # _corrs / _pvals and the method - the corr and pval files of one tissue and outlabel share it
+  # """
+
+  import os
+  import re
+  from genCorrSummaryTable import adjusted_kinds
+
+  columns = {}
+  for c in cols:
+    kind = max([k for k in ["corr", "pval"] + adjusted_kinds if c.endswith(k)], key=len)
+    file_name = c[:-len(kind)]
+    tissue = re.sub("_(corrs|pvals)$", "", os.path.splitext(file_name)[0])
+    tissue = re.sub("_(pearson|spearman)$", "", tissue).rstrip("_")
+    columns[c] = {"file": file_name, "tissue": tissue, "kind": kind}
+
+  return(columns)
+
+
+def summaryTissues(cols):
+
+  # """
+  # cols: value cols of the summary table
+  # returns a dict of tissue -> {"corr": col, "pval": col, ...}, see summaryColumns
+  # """
+
+  tissues = {}
+  for c, col in summaryColumns(cols).items():
+    tissues.setdefault(col["tissue"], {})[col["kind"]] = c
+
+  return(tissues)
+
+
+def buildSummaryStore(table_path, store_dir=None, chunk_rows=1000000, row_group_rows=8192):
+
+  # """
+  # table_path: summary table from genCorrSummaryTable or streamCorrSummaryTable
+  # store_dir: directory to build the store in, default is the table path without its suffix + _store
+  # chunk_rows: rows of the table read at once
+  # row_group_rows: rows per parquet row group - smaller groups let a nuc gene lookup read less
+  # reads the table chunk by chunk and writes each mt gene's rows, sorted by nuc gene, to its own partition. The tables
+  # the summary functions write hold each mt gene's rows together, so only one mt gene is in memory at a time - an mt
+  # gene whose rows come back later in the table gets a second partition file
+  # returns store_dir
+  # """
+
+  import os
+  import json
+  import pandas as pd
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+  from pipelineLog import stageLogger
+
+  log = stageLogger("summaryStore")
+
+  if store_dir == None:
+    store_dir = os.path.splitext(table_path)[0] + "_store"
+  os.makedirs(store_dir, exist_ok=True)
+
+  partitions = {}
+  value_cols = None
+  n_rows = 0
+
+  def writePartition(gene, frames):
+    part = pd.concat(frames, ignore_index=True).sort_values("nuc_gene", kind="stable", ignore_index=True)
+    file_name = "part_{:06d}.parquet".format(sum(len(p) for p in partitions.values()))
+    pq.write_table(pa.Table.from_pandas(part, preserve_index=False), os.path.join(store_dir, file_name),
+                   row_group_size=row_group_rows)
+    partitions.setdefault(str(gene), []).append(file_name)
+
+  gene, frames = None, []
+  for chunk in summaryChunks(table_path, chunk_rows):
+
+    if value_cols == None:
+      value_cols = [c for c in chunk.columns if c not in ["mt_gene", "nuc_gene"]]
+      log.info("tissues: %s", list(summaryTissues(value_cols)))
+
+    n_rows += len(chunk)
+    for g, rows in chunk.groupby("mt_gene", sort=False):
+      if g != gene and len(frames) > 0:
+        writePartition(gene, frames)
+        frames = []
+      gene = g
+      frames.append(rows)
+
+  if len(frames) > 0:
+    writePartition(gene, frames)
+
+  columns = summaryColumns(value_cols)
+  index = {"table": os.path.abspath(table_path), "n_rows": n_rows, "value_cols": value_cols,
+           "files": {col["file"]: col["tissue"] for col in columns.values()},
+           "tissues": summaryTissues(value_cols), "partitions": partitions}
+  with open(os.path.join(store_dir, "index.json"), "w", encoding="utf-8") as f:
+    json.dump(index, f, indent=1)
+
+  log.info("partitions: %d rows: %d", sum(len(p) for p in partitions.values()), n_rows)
+
+  return(store_dir)
+
+
+class SummaryStore:
+
+  # """
+  # store_dir: directory written by buildSummaryStore
+  # tissues: dict of tissue -> {"corr": col, "pval": col, ...}
+  # mt_genes: mt genes in the store
+  # """
+
+  def __init__(self, store_dir):
+
+    import os
+    import json
+
+    self.store_dir = store_dir
+    with open(os.path.join(store_dir, "index.json"), encoding="utf-8") as f:
+      self.index = json.load(f)
+
+    self.tissues = self.index["tissues"]
+    self.mt_genes = list(self.index["partitions"])
+
+  def query(self, mt_gene=None, nuc_gene=None, tissues=None, max_pval=None, min_abs_corr=None, all_tissues=False, pval_kind="pval"):
+
+    # """
+    # mt_gene: mt gene (or list of them) to fetch, default is all - each one reads only its own partition
+    # nuc_gene: nuc gene (or list of them) to fetch, default is all - found through the sorted row groups
+    # tissues: tissues (or list of them) to return the corr and pval cols of, default is all
+    # max_pval: keep pairs with pval <= max_pval
+    # min_abs_corr: keep pairs with |corr| >= min_abs_corr
+    # all_tissues: pairs must pass the thresholds in all the requested tissues, default is in any of them
+    # pval_kind: pval col max_pval applies to - pval, or an adjusted kind of tables built with adjust=True, i.e. pval_bh.
+    # With max_pval, every requested tissue must have it
+    # returns a DataFrame of mt_gene, nuc_gene and the requested tissues' corr and pval cols
+    # """
+
+    import os
+    import numpy as np
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    if isinstance(mt_gene, str):
+      mt_gene = [mt_gene]
+    if isinstance(nuc_gene, str):
+      nuc_gene = [nuc_gene]
+    if isinstance(tissues, str):
+      tissues = [tissues]
+
+    if tissues == None:
+      tissues = list(self.tissues)
+    missing = [t for t in tissues if t not in self.tissues]
+    if len(missing) > 0:
+      raise ValueError("tissues {} are not in the store, use one of {}".format(missing, list(self.tissues)))
+
+    # a pval kind the tissues do not have would leave max_pval unapplied
+    if max_pval != None:
+      missing = [t for t in tissues if pval_kind not in self.tissues[t]]
+      if len(missing) > 0:
+        kinds = sorted(set(k for t in tissues for k in self.tissues[t] if k != "corr"))
+        raise ValueError("pval_kind {} is not in tissues {}, use one of {}".format(pval_kind, missing, kinds))
+
+    tissue_cols = [self.tissues[t][k] for t in tissues for k in self.tissues[t]]
+    cols = ["mt_gene", "nuc_gene"] + [c for c in self.index["value_cols"] if c in tissue_cols]
+
+    genes = self.mt_genes if mt_gene == None else [g for g in mt_gene if g in self.index["partitions"]]
+    filters = None if nuc_gene == None else [("nuc_gene", "in", list(nuc_gene))]
+
+    parts = []
+    for g in genes:
+      for file_name in self.index["partitions"][g]:
+        parts.append(pq.read_table(os.path.join(self.store_dir, file_name), columns=cols, filters=filters).to_pandas())
+
+    if len(parts) == 0:
+      return(pd.DataFrame(columns=cols))
+
+    df = pd.concat(parts, ignore_index=True)
+
+    # a tissue passes when its pval and corr both pass, the pair is kept when any (or all) of the tissues pass
+    if max_pval != None or min_abs_corr != None:
+      passed = np.ones((len(df), len(tissues)), dtype=bool)
+      for i, t in enumerate(tissues):
+        if max_pval != None:
+          passed[:, i] &= df[self.tissues[t][pval_kind]].values <= max_pval
+        if min_abs_corr != None and "corr" in self.tissues[t]:
+          passed[:, i] &= np.abs(df[self.tissues[t]["corr"]].values) >= min_abs_corr
+      df = df[passed.all(axis=1) if all_tissues == True else passed.any(axis=1)]
+
+    return(df.reset_index(drop=True))
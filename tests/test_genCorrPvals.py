@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+from genCorrPvals import genCorrPvals
+from matrixIO import readMatrix, writeMatrix
+
+
+def corrInputs(tmp_path, n_samples=30):
+
+  # a corr matrix and its per-pair counts as genCorrs writes them, in .npy
+  rng = np.random.default_rng(0)
+  genes = ["G%d" % i for i in range(8)]
+  r = np.clip(rng.uniform(-1, 1, (4, len(genes))), -0.99, 0.99)
+  writeMatrix(pd.DataFrame(r, index=genes[:4], columns=genes), str(tmp_path / "Liver__pearson_corrs.npy"))
+  writeMatrix(pd.DataFrame(np.full(r.shape, float(n_samples)), index=genes[:4], columns=genes), str(tmp_path / "Liver__pearson_nobs.npy"))
+  return(str(tmp_path) + "/")
+
+
+def test_float32_pvals_written_as_float32(tmp_path):
+
+  file_dir = corrInputs(tmp_path)
+  genCorrPvals(file_dir, pattern="_corrs.npy", float32=True)
+
+  assert np.load(tmp_path / "Liver__pearson_pvals.npy").dtype == np.float32
+  assert readMatrix(file_dir + "Liver__pearson_pvals.npy").dtypes.eq(np.float32).all()
+
+
+def test_float64_pvals_by_default(tmp_path):
+
+  file_dir = corrInputs(tmp_path)
+  genCorrPvals(file_dir, pattern="_corrs.npy")
+  p64 = np.load(tmp_path / "Liver__pearson_pvals.npy")
+
+  assert p64.dtype == np.float64
+
+  # the fixed sample count gives the same pvals as the _nobs file
+  genCorrPvals(file_dir, pattern="_corrs.npy", n_samples=30, float32=True)
+  assert np.allclose(np.load(tmp_path / "Liver__pearson_pvals.npy"), p64, rtol=1e-4)
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from genCorrs import mito_genes, tiledEdges
+
+
+def edgeInputs(n_samps=30, n_nuc=40, seed=0):
+
+  rng = np.random.default_rng(seed)
+  genes = np.array(list(mito_genes) + ["G%d" % i for i in range(n_nuc)])
+  return(rng.normal(size=(n_samps, len(genes))), genes)
+
+
+def pairKeys(edges):
+
+  return(pd.Series([tuple(sorted(p)) for p in zip(edges["gene_1"], edges["gene_2"])]))
+
+
+def test_mt_edges_write_each_pair_once(tmp_path):
+
+  a, genes = edgeInputs()
+  rows = list(range(len(mito_genes)))
+  n_mt, n_nuc = len(mito_genes), len(genes) - len(mito_genes)
+
+  tiledEdges(a, genes, str(tmp_path / "edges.csv"), rows=rows, tile_size=7)
+  edges = pd.read_csv(tmp_path / "edges.csv")
+
+  # every mt-nuc pair, and every mt-mt pair once
+  assert not pairKeys(edges).duplicated().any()
+  assert len(edges) == n_mt * n_nuc + n_mt * (n_mt - 1) // 2
+
+
+def test_mt_edges_top_k_write_each_pair_once(tmp_path):
+
+  a, genes = edgeInputs()
+  # mt genes strongly correlated with each other, so they are in each other's top_k
+  a[:, :len(mito_genes)] += 5 * a[:, [0]]
+  rows = list(range(len(mito_genes)))
+
+  tiledEdges(a, genes, str(tmp_path / "edges.csv"), rows=rows, tile_size=7, top_k=3)
+  edges = pd.read_csv(tmp_path / "edges.csv")
+
+  assert not pairKeys(edges).duplicated().any()
+  assert edges["gene_2"].isin(mito_genes).all()
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+from genCorrs import mito_genes
+from genPermutationNull import genPermutationNull
+
+
+def nullInputs(tmp_path, seed=0, n_samps=40, n_genes=60, nan_frac=0.1):
+
+  # independent genes with NaNs - every mt-nuc pair is under H0
+  rng = np.random.default_rng(seed)
+  genes = list(mito_genes) + ["G%d" % i for i in range(n_genes)]
+  a = rng.normal(size=(n_samps, len(genes)))
+  a[rng.random(a.shape) < nan_frac] = np.nan
+  in_dir = tmp_path / "in"
+  in_dir.mkdir()
+  pd.DataFrame(a, index=["S%d" % i for i in range(n_samps)], columns=genes).to_csv(in_dir / "Liver_f.csv")
+  return(str(in_dir) + "/", genes[len(mito_genes):])
+
+
+def test_spearman_observed_within_own_null_under_h0(tmp_path):
+
+  in_dir, nuc = nullInputs(tmp_path)
+  out_dir = tmp_path / "out"
+  out_dir.mkdir()
+  n_perms = 199
+  genPermutationNull(in_dir, pattern="_f.csv", outdir=str(out_dir), method="spearman", n_perms=n_perms, seed=1,
+                     quantiles=[0.0, 1.0], n_cores=1)
+
+  observed = pd.read_csv(out_dir / "Liver__spearman_perm_observed.csv", index_col=0)[nuc].values
+  lo = pd.read_csv(out_dir / "Liver__spearman_null_q0.0.csv", index_col=0)[nuc].values
+  hi = pd.read_csv(out_dir / "Liver__spearman_null_q1.0.csv", index_col=0)[nuc].values
+  pvals = pd.read_csv(out_dir / "Liver__spearman_perm_pvals.csv", index_col=0)[nuc].values
+
+  # each observed r falls outside its n_perms null draws with probability 2 / (n_perms + 1)
+  outside = ((observed < lo) | (observed > hi)).mean()
+  assert outside < 0.03
+
+  # and the empirical p-values are close to uniform
+  assert pvals.min() >= 1 / (n_perms + 1)
+  assert 0.02 < (pvals <= 0.05).mean() < 0.09
+  assert 0.4 < pvals.mean() < 0.6
+
+
+def test_spearman_observed_is_the_null_statistic(tmp_path):
+
+  from genCorrs import rankCols
+  from genPermutationNull import permutedCorrs
+
+  in_dir, nuc = nullInputs(tmp_path, nan_frac=0.3)
+  out_dir = tmp_path / "out"
+  out_dir.mkdir()
+  genPermutationNull(in_dir, pattern="_f.csv", outdir=str(out_dir), method="spearman", n_perms=20, seed=1, n_cores=1)
+
+  # the unshuffled permutation of the null kernel gives back the observed r
+  df = pd.read_csv(in_dir + "Liver_f.csv", index_col=0)
+  identity = np.arange(len(df.index))[None, :]
+  expected = permutedCorrs(rankCols(df[mito_genes].values), rankCols(df.values), identity)[0]
+  observed = pd.read_csv(out_dir / "Liver__spearman_perm_observed.csv", index_col=0)[df.columns].values
+
+  assert np.allclose(observed, expected, equal_nan=True)
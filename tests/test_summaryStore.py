@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from genCorrs import mito_genes
+from summaryStore import buildSummaryStore, SummaryStore
+
+
+def smallStore(tmp_path):
+
+  # a two-tissue summary table with raw and BH-adjusted pvals
+  rng = np.random.default_rng(0)
+  nuc = ["G%d" % i for i in range(10)]
+  pairs = pd.DataFrame([(m, n) for m in mito_genes[:3] for n in nuc], columns=["mt_gene", "nuc_gene"])
+  for t in ["Liver", "Brain"]:
+    pairs[t + "_pearson_corrs.csvcorr"] = rng.uniform(-1, 1, len(pairs))
+  for t in ["Liver", "Brain"]:
+    pairs[t + "_pearson_pvals.csvpval"] = rng.random(len(pairs))
+    pairs[t + "_pearson_pvals.csvpval_bh"] = np.minimum(pairs[t + "_pearson_pvals.csvpval"] * 2, 1)
+  pairs.to_parquet(tmp_path / "summary_table.parquet")
+  return(SummaryStore(buildSummaryStore(str(tmp_path / "summary_table.parquet"))))
+
+
+def test_query_filters_on_pval_kind(tmp_path):
+
+  store = smallStore(tmp_path)
+  raw = store.query(tissues="Liver", max_pval=0.3)
+  bh = store.query(tissues="Liver", max_pval=0.3, pval_kind="pval_bh")
+
+  assert (raw["Liver_pearson_pvals.csvpval"] <= 0.3).all()
+  assert (bh["Liver_pearson_pvals.csvpval_bh"] <= 0.3).all()
+  assert 0 < len(bh) < len(raw) < len(store.query())
+
+
+def test_query_rejects_unknown_pval_kind(tmp_path):
+
+  store = smallStore(tmp_path)
+  with pytest.raises(ValueError, match="pval_typo"):
+    store.query(max_pval=0.05, pval_kind="pval_typo")
+
+  # without max_pval the kind is not used
+  assert len(store.query(pval_kind="pval_typo")) == len(store.query())